@@ -0,0 +1,233 @@
+"""
+Content-addressed file cache shared across requests.
+
+Entries are stored under a sub-directory of `config.cache_path()` and named
+after a hash of the parameters that produced them. The least recently used
+entries are removed when the total size of the cache exceeds its limit.
+"""
+
+from contextlib import contextmanager
+import datetime as dt
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import tempfile
+
+import numpy as np
+
+from flyingpigeon import config
+from flyingpigeon._compat import urlparse
+
+LOGGER = logging.getLogger("PYWPS")
+
+# Suffixes of the files being written or locked, which are not cache entries.
+_TRANSIENT = ('.tmp', '.part', '.lock')
+
+
+def make_key(*parts):
+    """
+    Return a hash identifying the given parts.
+
+    :param parts: strings, numbers, sequences or numpy arrays
+
+    :return str: hexadecimal digest
+    """
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(str(part.dtype).encode('utf-8'))
+            h.update(str(part.shape).encode('utf-8'))
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(repr(part).encode('utf-8'))
+    return h.hexdigest()
+
+
+def file_signature(path):
+    """
+    Return the identity of a file: absolute path, modification time and size.
+
+    :param path: file path
+
+    :return tuple: (path, mtime, size)
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return path, st.st_mtime, st.st_size
+
+
+def source_signature(source):
+    """
+    Return the identity of a dataset.
+
+    Local files are identified by their path, modification time and size,
+    remote resources by their URL.
+
+    :param source: file path or URL
+
+    :return tuple: signature
+    """
+    parsed = urlparse.urlparse(source)
+    if parsed.scheme in ('', 'file') and os.path.isfile(parsed.path):
+        return file_signature(parsed.path)
+    return (source,)
+
+
+def canonical(obj):
+    """
+    Return a representation of an argument that does not depend on dict
+    ordering or object identity, suitable for `make_key`.
+
+    :param obj: None, string, number, date, geometry, or list, tuple or dict of those
+
+    :return: canonical representation
+    :raises TypeError: if the object has no canonical representation
+    """
+    if obj is None or isinstance(obj, (bool, int, float, str, type(u''))):
+        return obj
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (dt.date, dt.time)):
+        return obj.isoformat()
+    if isinstance(obj, (list, tuple)):
+        return tuple(canonical(o) for o in obj)
+    if isinstance(obj, dict):
+        return tuple(sorted((canonical(k), canonical(v)) for k, v in obj.items()))
+    if hasattr(obj, 'wkt'):
+        # Shapely geometries
+        return obj.wkt
+    raise TypeError('No canonical representation for {}'.format(type(obj)))
+
+
+def link(source, dest):
+    """
+    Hard-link a file, or copy it if the destination is on another file system.
+
+    :param source: existing file
+    :param dest: path of the new file
+
+    :return str: destination path
+    """
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+    except (OSError, AttributeError):
+        shutil.copyfile(source, dest)
+    return dest
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on a file, shared between threads and processes.
+
+    :param path: lock file, created if it does not exist
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class FileCache(object):
+    """
+    Directory of cached files with least recently used eviction.
+
+    :param name: name of the cache sub-directory in the cache path
+    :param max_size: maximum total size of the cache in bytes
+    :param path: cache directory, defaults to `config.cache_path()`
+    """
+
+    def __init__(self, name, max_size, path=None):
+        if path is None:
+            path = config.cache_path()
+        self.dir = os.path.join(path, name)
+        self.max_size = max_size
+        if not os.path.isdir(self.dir):
+            try:
+                os.makedirs(self.dir)
+            except OSError:
+                # Created concurrently by another process.
+                if not os.path.isdir(self.dir):
+                    raise
+
+    def path(self, key, suffix='.nc'):
+        """Return the path of the cache entry for the key."""
+        return os.path.join(self.dir, key + suffix)
+
+    def get(self, key, suffix='.nc'):
+        """
+        Return the path of the cached file for the key, or None if it is not
+        in the cache.
+        """
+        path = self.path(key, suffix)
+        try:
+            # Mark the entry as recently used.
+            os.utime(path, None)
+        except OSError:
+            return None
+        LOGGER.info('Cache hit: {}'.format(path))
+        return path
+
+    def put(self, key, source, suffix='.nc', move=False):
+        """
+        Copy a file into the cache and return the path of the cache entry.
+
+        The file is first copied to a temporary name then renamed so that
+        concurrent readers never see a partial entry. Entries are read-only,
+        since they may be hard-linked elsewhere. With `move`, a file on the
+        same file system as the cache is moved instead of copied.
+        """
+        path = self.path(key, suffix)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            if move:
+                os.rename(source, tmp)
+            else:
+                shutil.copyfile(source, tmp)
+            os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        LOGGER.info('Cache store: {}'.format(path))
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits its maximum size.
+
+        :param keep: path of an entry never removed, such as the entry being returned by `put`
+        """
+        entries = []
+        for name in os.listdir(self.dir):
+            if name.endswith(_TRANSIENT):
+                continue
+            path = os.path.join(self.dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if path == keep:
+                continue
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                LOGGER.debug('Cache eviction: {}'.format(path))
+            except OSError:
+                pass
+            total -= size
@@ -9,6 +9,13 @@ import logging
 LOGGER = logging.getLogger("PYWPS")
 
 
+def anomalies_processes():
+    processes = configuration.get_config_value("extra", "anomalies_processes")
+    if not processes:
+        processes = 4
+    return int(processes)
+
+
 def cache_path():
     cache_path = configuration.get_config_value("cache", "cache_path")
     if not cache_path:
@@ -21,6 +28,20 @@ def data_path():
     return os.path.join(_PATH, 'data')
 
 
+def download_cache_size():
+    size = configuration.get_config_value("extra", "download_cache_size")
+    if not size:
+        size = 4096
+    return int(size)
+
+
+def download_chunk_size():
+    size = configuration.get_config_value("extra", "download_chunk_size")
+    if not size:
+        size = 16
+    return int(size)
+
+
 def esgfsearch_distrib():
     distrib = configuration.get_config_value("extra", "esgfsearch_distrib")
     if distrib is None:
@@ -37,6 +58,25 @@ def esgfsearch_url():
     return url
 
 
+def landsea_cache_size():
+    size = configuration.get_config_value("extra", "landsea_cache_size")
+    if not size:
+        size = 256
+    return int(size)
+
+
+def landsea_mask_index():
+    index = configuration.get_config_value("extra", "landsea_mask_index")
+    return index or None
+
+
+def landsea_mask_ttl():
+    ttl = configuration.get_config_value("extra", "landsea_mask_ttl")
+    if not ttl:
+        ttl = 168
+    return float(ttl)
+
+
 def masks_path():
     # TODO: currently this folder is not used
     return os.path.join(data_path(), 'masks')
@@ -61,6 +101,74 @@ def shapefiles_path():
     return os.path.join(data_path(), 'shapefiles')
 
 
+def clipping_processes():
+    processes = configuration.get_config_value("extra", "clipping_processes")
+    if not processes:
+        processes = 4
+    return int(processes)
+
+
+def ocgis_cache():
+    cache = configuration.get_config_value("extra", "ocgis_cache")
+    return str(cache).lower() in ['true', '1', 'yes']
+
+
+def ocgis_cache_size():
+    size = configuration.get_config_value("extra", "ocgis_cache_size")
+    if not size:
+        size = 2048
+    return int(size)
+
+
+def regrid_cache_size():
+    size = configuration.get_config_value("extra", "regrid_cache_size")
+    if not size:
+        size = 512
+    return int(size)
+
+
+def spatial_analog_cache_size():
+    size = configuration.get_config_value("extra", "spatial_analog_cache_size")
+    if not size:
+        size = 1024
+    return int(size)
+
+
+def spatial_analog_tile_size():
+    tile_size = configuration.get_config_value("extra", "spatial_analog_tile_size")
+    if not tile_size:
+        tile_size = 50
+    return int(tile_size)
+
+
+def spatial_analog_n_jobs():
+    n_jobs = configuration.get_config_value("extra", "spatial_analog_n_jobs")
+    if not n_jobs:
+        n_jobs = 2
+    return int(n_jobs)
+
+
+def spatial_analog_max_memory():
+    max_memory = configuration.get_config_value("extra", "spatial_analog_max_memory")
+    if not max_memory:
+        max_memory = 256
+    return int(max_memory)
+
+
+def spatial_analog_workers():
+    workers = configuration.get_config_value("extra", "spatial_analog_workers")
+    if not workers:
+        workers = 1
+    return int(workers)
+
+
+def staging_threads():
+    threads = configuration.get_config_value("extra", "staging_threads")
+    if not threads:
+        threads = 4
+    return int(threads)
+
+
 def static_path():
     return os.path.join(_PATH, 'static')
 
@@ -8,9 +8,9 @@ def regionalize(infile, basedir, variable, aggregate, scenario):
     :param scenario: scenario name (e.g 'rcp45')"""
 
     from flyingpigeon import subset
-    from flyingpigeon.subset import _POLYGONS_EXTREMOSCOPE_
+    from flyingpigeon.subset import get_shp_column_values
 
-    for polygon in _POLYGONS_EXTREMOSCOPE_:
+    for polygon in get_shp_column_values('extremoscope', 'HASC_1'):
         region = polygon.replace('.', '-')
         prefix = os.basename(infile).replace('EUR', region)
         dir_output = os.path.join(basedir, 'polygons', variable, aggregate, scenario, region)
@@ -7,8 +7,9 @@ from scipy.spatial import cKDTree as KDTree
 Methods to compute the (dis)similarity between samples
 ======================================================
 
-This module implements five of the six methods described in [Grenier20131]_ to measure
-the dissimilarity between two samples. Some of these algorithms can be used to
+This module implements the six methods described in [Grenier20131]_ to measure
+the dissimilarity between two samples, along with the Szekely-Rizzo energy
+distance. Some of these algorithms can be used to
 test whether or not two samples have been drawn from the same distribution.
 Here, they are used to find areas with analog climate conditions to a target
 climate.
@@ -18,6 +19,7 @@ Methods available
  * Standardized Euclidean distance
  * Nearest Neighbour distance
  * Zech-Aslan energy statistic
+ * Szekely-Rizzo energy distance
  * Friedman-Rafsky runs statistic
  * Kolmogorov-Smirnov statistic
  * Kullback-Leibler divergence
@@ -27,15 +29,28 @@ Methods available
 :institution: Ouranos inc.
 """
 
-# TODO: Szekely, G, Rizzo, M (2014) Energy statistics: A class of statistics
-# based on distances. J Stat Planning & Inference 143: 1249-1272
-
 # TODO: Hellinger distance
 
 __all__ = ['seuclidean', 'nearest_neighbor', 'zech_aslan',
-           'kolmogorov_smirnov', 'friedman_rafsky',
+           'skezely_rizzo', 'kolmogorov_smirnov', 'friedman_rafsky',
            'kldiv']
 
+# Pooled sample size up to which the Friedman-Rafsky minimum spanning tree
+# is computed from the complete graph of pairwise distances.
+_FR_DENSE_MAX = 500
+
+# Largest number of neighbours searched for each point in a round of the
+# Euclidean minimum spanning tree, and number of (point, neighbour) pairs
+# queried at once.
+_MST_MAX_K = 64
+_MST_QUERY_SIZE = 2 ** 20
+
+# Memory budget in bytes for the Kolmogorov-Smirnov quadrant counts.
+_KS_MAX_MEMORY = 2 ** 26
+
+# Memory budget in bytes for the blocks of pairwise distances.
+_PAIRWISE_MAX_MEMORY = 2 ** 26
+
 
 # ---------------------------------------------------------------------------- #
 # -------------------------- Utility functions ------------------------------- #
@@ -100,6 +115,316 @@ def standardize(x, y):
     return x / s, y / s
 
 
+def reference_sample(x, y):
+    """
+    Return the reference sample as a `ReferenceSample` and the candidate
+    sample reshaped according to the conventions used in the dissimilarity
+    metrics.
+
+    Parameters
+    ----------
+    x : array_like or ReferenceSample
+      Reference sample.
+    y : array_like
+      Candidate sample.
+
+    Returns
+    -------
+    ref : ReferenceSample
+      Reference sample and its precomputed properties.
+    y : ndarray
+      Array of shape (m,d).
+    """
+    if not isinstance(x, ReferenceSample):
+        x = ReferenceSample(x)
+    _, y = reshape_sample(x.x, y)
+    return x, y
+
+
+def _quadrant_counts(p, s, max_memory=_KS_MAX_MEMORY):
+    """
+    Return the fraction of sample points in each of the 2**d quadrants
+    defined around each pivot point.
+
+    Parameters
+    ----------
+    p : ndarray (np,d)
+      Pivot points.
+    s : ndarray (ns,d)
+      Sample.
+    max_memory : int
+      Approximate memory budget in bytes for the comparison arrays. Pivots
+      are processed in chunks fitting this budget.
+
+    Returns
+    -------
+    ndarray (2**d, np)
+      Fraction of the sample in each quadrant around each pivot.
+    """
+    ns, d = s.shape
+    npiv = p.shape[0]
+    nquad = 2 ** d
+    out = np.empty((nquad, npiv))
+
+    if d == 1:
+        # The number of points above each pivot is given by its rank in the
+        # sorted sample.
+        above = ns - np.searchsorted(np.sort(s[:, 0]), p[:, 0], side='left')
+        out[0] = ns - above
+        out[1] = above
+        return out / ns
+
+    # Multiplicating factor converting d-dim booleans to a unique integer.
+    mf = 2 ** np.arange(d)
+
+    # The comparisons, codes and counts take about d + 24 bytes for each
+    # (pivot, point) pair.
+    chunk = max(1, int(max_memory // (ns * (d + 24))))
+    for a in range(0, npiv, chunk):
+        pc = p[a:a + chunk]
+        nc = pc.shape[0]
+
+        # Assign a unique integer according on whether or not p[j] <= s[i]
+        code = np.dot(pc[:, np.newaxis, :] <= s[np.newaxis, :, :], mf)
+
+        # Count the number of samples in each quadrant, offsetting the codes
+        # of each pivot to count them all with a single bincount.
+        code += (nquad * np.arange(nc))[:, np.newaxis]
+        out[:, a:a + nc] = np.bincount(code.ravel(), minlength=nquad * nc).reshape(nc, nquad).T
+
+    return out / ns
+
+
+def pairwise_distance_sum(x, y=None, func=None, max_memory=_PAIRWISE_MAX_MEMORY):
+    """
+    Return the sum of the Euclidean distances between pairs of points, or of
+    a function of these distances, without storing the full distance matrix.
+
+    Distances are computed by blocks of rows fitting the memory budget and
+    reduced block by block.
+
+    Parameters
+    ----------
+    x : ndarray (n,d)
+      Sample.
+    y : ndarray (m,d), optional
+      Second sample. If given, the sum is over the n*m pairs (x[i], y[j]).
+      Otherwise, it is over the n*(n-1)/2 pairs (x[i], x[j]) with i < j.
+    func : callable, optional
+      Function applied to the distances before the sum, e.g. `np.log`.
+    max_memory : int
+      Approximate memory budget in bytes for a block of distances.
+
+    Returns
+    -------
+    float
+      Sum of the (transformed) distances.
+    """
+    n = x.shape[0]
+    other = x if y is None else y
+    m = other.shape[0]
+
+    block = max(1, int(max_memory // (24 * m)))
+    total = 0.
+    for a in range(0, n, block):
+        if y is None:
+            # Only the pairs with j > i.
+            d = spatial.distance.cdist(x[a:a + block], x[a + 1:])
+            d = d[np.triu_indices(d.shape[0], 0, d.shape[1])]
+        else:
+            d = spatial.distance.cdist(x[a:a + block], y)
+        if func is not None:
+            d = func(d)
+        total += d.sum()
+
+    return total
+
+
+def euclidean_mst(x):
+    """
+    Compute the Euclidean minimum spanning tree of a sample.
+
+    The tree is built with Boruvka's algorithm, using a KD-tree to find the
+    nearest neighbour of each point outside of its component. Up to
+    `_MST_MAX_K` neighbours are searched for each point, in chunks of
+    points. The points whose neighbours all belong to their own component,
+    as in a sample made of well separated clusters, are then searched in a
+    KD-tree of the points outside of their component. Memory usage is
+    linear in the number of points, as opposed to building the complete
+    graph of pairwise distances.
+
+    Parameters
+    ----------
+    x : ndarray (n,d)
+      Sample.
+
+    Returns
+    -------
+    ndarray (n-1,2)
+      Indices of the points linked by each edge of the tree.
+
+    Notes
+    -----
+    The KD-tree search degrades with the dimension of the sample, so this is
+    only efficient for low dimensions (d <= 10).
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    n = x.shape[0]
+    tree = KDTree(x)
+
+    comp = np.arange(n)
+    ncomp = n
+    edges = []
+    while ncomp > 1:
+        best = np.empty(ncomp)
+        best.fill(np.inf)
+        cand = []
+
+        # Find the nearest neighbour of each point in another component,
+        # doubling the number of neighbours searched for the points whose
+        # neighbours are all in the same component. Points whose farthest
+        # neighbour is already beyond the best edge found for their
+        # component can be dropped.
+        todo = np.arange(n)
+        k = 2
+        while todo.size and k <= _MST_MAX_K:
+            k = min(k, n)
+            step = max(1, _MST_QUERY_SIZE // k)
+            left = []
+            for start in range(0, todo.size, step):
+                pts = todo[start:start + step]
+                r, ind = tree.query(x[pts], k=k)
+                other = comp[ind] != comp[pts][:, np.newaxis]
+                found = other.any(1)
+
+                i = pts[found]
+                first = other[found].argmax(1)
+                dist = r[found, first]
+                j = ind[found, first]
+                np.minimum.at(best, comp[i], dist)
+                cand.append((dist, i, j))
+
+                left.append(pts[~found & (r[:, -1] < best[comp[pts]]) & (k < n)])
+            todo = np.concatenate(left)
+            k *= 2
+
+        # Search the remaining points among the points of other components.
+        for c in np.unique(comp[todo]):
+            pts = todo[comp[todo] == c]
+            others = np.flatnonzero(comp != c)
+            dist, j = KDTree(x[others]).query(x[pts], k=1)
+            np.minimum.at(best, comp[pts], dist)
+            cand.append((dist, pts, others[j]))
+
+        # Keep the shortest edge leaving each component.
+        dist, i, j = [np.concatenate(a) for a in zip(*cand)]
+        keep = dist <= best[comp[i]]
+        _, first = np.unique(comp[i][keep], return_index=True)
+        edges.append(np.array([i[keep][first], j[keep][first]]).T)
+
+        # Merge the components linked by the new edges.
+        e = np.concatenate(edges)
+        g = coo_matrix((np.ones(len(e)), (e[:, 0], e[:, 1])), shape=(n, n))
+        ncomp, comp = connected_components(g, directed=False)
+
+    # With ties in distances, the edges selected for different components
+    # may form cycles. Kruskal's algorithm over the selected edges removes
+    # them.
+    e = np.concatenate(edges)
+    w = np.sqrt(((x[e[:, 0]] - x[e[:, 1]]) ** 2).sum(1))
+    parent = np.arange(n)
+
+    def root(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    out = []
+    for a, b in e[np.argsort(w, kind='mergesort')]:
+        ra, rb = root(a), root(b)
+        if ra != rb:
+            parent[ra] = rb
+            out.append((a, b))
+    return np.array(out)
+
+
+class ReferenceSample(object):
+    """
+    Reference sample along with the properties that do not depend on the
+    candidate sample.
+
+    Comparing many candidate samples to the same reference is the typical
+    use case for spatial analogs. All metrics accept a `ReferenceSample` in
+    place of the reference array, in which case the reference statistics,
+    KD-tree and neighbour distances are computed only once.
+
+    Parameters
+    ----------
+    x : array_like (n,d)
+      Reference sample.
+    """
+
+    def __init__(self, x):
+        x = np.atleast_2d(x)
+        if x.shape[0] == 1:
+            x = x.T
+
+        self.x = x
+        self.n, self.d = x.shape
+        self.mean = x.mean(0)
+        self.var = x.var(0, ddof=1)
+        self.std = np.sqrt(self.var)
+
+        self._tree = None
+        self._kneighbors = {}
+        self._quadrants = None
+
+    @property
+    def tree(self):
+        """KD-tree representation of the reference sample."""
+        if self._tree is None:
+            self._tree = KDTree(self.x)
+        return self._tree
+
+    @property
+    def quadrants(self):
+        """Fraction of the reference sample in each quadrant around each
+        reference point."""
+        if self._quadrants is None:
+            self._quadrants = _quadrant_counts(self.x, self.x)
+        return self._quadrants
+
+    def kneighbors(self, k, eps=0, n_jobs=2):
+        """
+        Return the distances from each reference point to its k nearest
+        neighbours in the reference sample, the point itself included.
+
+        Parameters
+        ----------
+        k : int
+          Number of neighbours.
+        eps : float
+          Approximation tolerance of the KD-tree search. The kth returned
+          neighbour is no further than (1 + eps) times the distance to the
+          true kth neighbour.
+        n_jobs : int
+          Number of workers used by the KD-tree search. -1 uses all CPUs.
+
+        Returns
+        -------
+        ndarray (n,k)
+          Distances sorted in increasing order.
+        """
+        r = self._kneighbors.get(eps)
+        if r is None or r.shape[1] < k:
+            r, _ = self.tree.query(self.x, k=k, eps=eps, p=2, n_jobs=n_jobs)
+            self._kneighbors[eps] = r
+        return r[:, :k]
+
+
 # ---------------------------------------------------------------------------- #
 # ------------------------ Dissimilarity metrics ----------------------------- #
 # ---------------------------------------------------------------------------- #
@@ -111,7 +436,7 @@ def seuclidean(x, y):
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or ReferenceSample
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
@@ -133,41 +458,50 @@ def seuclidean(x, y):
     21st-century climate-change scenarios. Climatic Change,
     DOI 10.1007/s10584-011-0261-z.
     """
-    x, y = reshape_sample(x, y)
+    ref, y = reference_sample(x, y)
 
-    mx = x.mean(0)
     my = y.mean(0)
 
-    return spatial.distance.seuclidean(mx, my, x.var(0, ddof=1))
-
+    return spatial.distance.seuclidean(ref.mean, my, ref.var)
 
-"""
-I'm wondering if there is value in writing a generator version of these
-functions, such as the example below, to optimize computations in the case
-multiple candidate samples are compared to the same reference sample.
 
-def seuclidean_gen(x, y):
-    mx = x.mean(0)
+def _seuclidean_batch(x, y):
+    """Vectorized version of `seuclidean` over a stack of candidate samples.
 
-    for vec in y:
-        my = vec.mean(0)
-        yield spatial.distance.seuclidean(mx, my, x.var(0, ddof=1))
+    Parameters
+    ----------
+    x : ReferenceSample
+        Reference sample.
+    y : masked array (cells,m,d)
+        Candidate samples. Masked points are excluded from the means.
 
-seuclidean_gen.__doc__ = seuclidean.__doc__
-"""
+    Returns
+    -------
+    ndarray (cells,)
+        Standardized Euclidean distance for each candidate sample.
+    """
+    my = y.mean(1).filled(np.nan)
+    return np.sqrt(((my - x.mean) ** 2 / x.var).sum(-1))
 
 
-def nearest_neighbor(x, y):
+def nearest_neighbor(x, y, eps=0, n_jobs=2):
     """
     Compute a dissimilarity metric based on the number of points in the
     pooled sample whose nearest neighbor belongs to the same distribution.
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or ReferenceSample
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
+    eps : float
+        Approximation tolerance of the nearest neighbour search. With eps > 0,
+        the neighbour found is no further than (1 + eps) times the distance
+        to the true nearest neighbour. Defaults to 0 (exact search).
+    n_jobs : int
+        Number of workers used by the nearest neighbour search. -1 uses all
+        CPUs.
 
     Returns
     -------
@@ -179,15 +513,18 @@ def nearest_neighbor(x, y):
     Henze N. (1988) A Multivariate two-sample test based on the number of
     nearest neighbor type coincidences. Ann. of Stat., Vol. 16, No.2, 772-783.
     """
-    x, y = reshape_sample(x, y)
-    x, y = standardize(x, y)
+    ref, y = reference_sample(x, y)
+
+    # Standardize by the square root of the product of standard deviations.
+    s = np.sqrt(ref.std * y.std(0, ddof=1))
+    x, y = ref.x / s, y / s
 
     nx, dx = x.shape
 
     # Pool the samples and find the nearest neighbours
     xy = np.vstack([x, y])
     tree = KDTree(xy)
-    r, ind = tree.query(xy, k=2, eps=0, p=2, n_jobs=2)
+    r, ind = tree.query(xy, k=2, eps=eps, p=2, n_jobs=n_jobs)
 
     # Identify points whose neighbors are from the same sample
     same = ~np.logical_xor(*(ind < nx).T)
@@ -202,7 +539,7 @@ def zech_aslan(x, y):
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or ReferenceSample
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
@@ -220,19 +557,18 @@ def zech_aslan(x, y):
     goodness-of-fit tests: the energy tests. arXiV:hep-ex/0203010v5.
     """
 
-    x, y = reshape_sample(x, y)
+    ref, y = reference_sample(x, y)
+    x = ref.x
     nx, d = x.shape
     ny, d = y.shape
 
-    v = x.std(0, ddof=1) * y.std(0, ddof=1)
-
-    dx = spatial.distance.pdist(x, 'seuclidean', V=v)
-    dy = spatial.distance.pdist(y, 'seuclidean', V=v)
-    dxy = spatial.distance.cdist(x, y, 'seuclidean', V=v)
+    # Standardized Euclidean distances.
+    s = np.sqrt(ref.std * y.std(0, ddof=1))
+    x, y = x / s, y / s
 
-    phix = -np.log(dx).sum() / nx / (nx - 1)
-    phiy = -np.log(dy).sum() / ny / (ny - 1)
-    phixy = np.log(dxy).sum() / nx / ny
+    phix = -pairwise_distance_sum(x, func=np.log) / nx / (nx - 1)
+    phiy = -pairwise_distance_sum(y, func=np.log) / ny / (ny - 1)
+    phixy = pairwise_distance_sum(x, y, func=np.log) / nx / ny
     return phix + phiy + phixy
 
 
@@ -243,7 +579,7 @@ def skezely_rizzo(x, y):
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or ReferenceSample
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
@@ -251,33 +587,38 @@ def skezely_rizzo(x, y):
     Returns
     -------
     float
-        Skezely-Rizzo dissimilarity metric ranging from -infinity to infinity.
+        Skezely-Rizzo dissimilarity metric ranging from 0 to infinity.
+
+    Notes
+    -----
+    The energy distance is computed on the samples standardized by the
+    square root of the product of their standard deviations, as for the
+    Zech-Aslan metric.
 
     References
     ----------
-    TODO
+    Szekely, G. J. and Rizzo, M. L. (2004) Testing for equal distributions
+    in high dimension. InterStat, 5.
+    Szekely, G. J. and Rizzo, M. L. (2013) Energy statistics: A class of
+    statistics based on distances. Journal of Statistical Planning and
+    Inference, 143, 1249-1272.
     """
-    raise NotImplementedError
-
-    x, y = reshape_sample(x, y)
+    ref, y = reference_sample(x, y)
+    x = ref.x
     nx, d = x.shape
     ny, d = y.shape
 
-    v = x.std(0, ddof=1) * y.std(0, ddof=1)
+    # Standardized Euclidean distances.
+    s = np.sqrt(ref.std * y.std(0, ddof=1))
+    x, y = x / s, y / s
 
-    dx = spatial.distance.pdist(x, 'seuclidean', V=v)
-    dy = spatial.distance.pdist(y, 'seuclidean', V=v)
-    dxy = spatial.distance.cdist(x, y, 'seuclidean', V=v)
+    # The sums over the full distance matrices are twice the sums over
+    # the pairs.
+    z = 2. * pairwise_distance_sum(x, y) / (nx * ny) \
+        - 2. * pairwise_distance_sum(x) / nx ** 2 \
+        - 2. * pairwise_distance_sum(y) / ny ** 2
 
-    phix = -np.log(dx).sum() / nx / (nx - 1)
-    phiy = -np.log(dy).sum() / ny / (ny - 1)
-    phixy = np.log(dxy).sum() / nx / ny
-
-    # z = dxy.sum() * 2. / (nx*ny) - (1./nx**2) *
-
-    # z = (2 / (n * m)) * sum(dxy(:)) - (1 / (n ^ 2)) * sum(2 * dx) - (1 /
-    #  (m ^ 2)) * sum(2 * dy);
-    # z = ((n * m) / (n + m)) * z;
+    return z * nx * ny / (nx + ny)
 
 
 def friedman_rafsky(x, y):
@@ -290,7 +631,7 @@ def friedman_rafsky(x, y):
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or ReferenceSample
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
@@ -306,20 +647,29 @@ def friedman_rafsky(x, y):
     Wald-Wolfowitz and Smirnov two-sample tests. Annals of Stat. Vol.7,
     No. 4, 697-717.
     """
-    from sklearn import neighbors
-    from scipy.sparse.csgraph import minimum_spanning_tree
-
-    x, y = reshape_sample(x, y)
+    ref, y = reference_sample(x, y)
+    x = ref.x
     nx, d = x.shape
     ny, d = y.shape
     n = nx + ny
 
     xy = np.vstack([x, y])
 
-    # Compute the NNs and the minimum spanning tree
-    g = neighbors.kneighbors_graph(xy, n_neighbors=n - 1, mode='distance')
-    mst = minimum_spanning_tree(g, overwrite=True)
-    edges = np.array(mst.nonzero()).T
+    if n <= _FR_DENSE_MAX or d > 10:
+        from sklearn import neighbors
+        from scipy.sparse.csgraph import minimum_spanning_tree
+
+        # Compute the NNs and the minimum spanning tree
+        g = neighbors.kneighbors_graph(xy, n_neighbors=n - 1, mode='distance')
+        # Zero weights are missing edges for `minimum_spanning_tree`, keep
+        # the edges between duplicate points as in `euclidean_mst`.
+        g.data[g.data == 0] = np.finfo(float).tiny
+        mst = minimum_spanning_tree(g, overwrite=True)
+        edges = np.array(mst.nonzero()).T
+    else:
+        # The complete graph needs O(n^2) memory, build the Euclidean
+        # minimum spanning tree directly instead.
+        edges = euclidean_mst(xy)
 
     # Number of points whose neighbor is from the other sample
     diff = np.logical_xor(*(edges < nx).T).sum()
@@ -334,7 +684,7 @@ def kolmogorov_smirnov(x, y):
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or ReferenceSample
         Reference sample.
     y : ndarray (m,d)
         Candidate sample.
@@ -350,35 +700,22 @@ def kolmogorov_smirnov(x, y):
     of the Kolmogorov-Smirnov test. Monthly Notices of the Royal
     Astronomical Society, vol. 225, pp. 155-170.
     """
-    x, y = reshape_sample(x, y)
-
-    def pivot(x, y):
-        nx, d = x.shape
-        ny, d = y.shape
-
-        # Multiplicating factor converting d-dim booleans to a unique integer.
-        mf = (2 ** np.arange(d)).reshape(1, d, 1)
-        l = 2 ** d
-
-        # Assign a unique integer according on whether or not x[i] <= sample
-        ix = ((x.T <= np.atleast_3d(x)) * mf).sum(1)
-        iy = ((x.T <= np.atleast_3d(y)) * mf).sum(1)
+    ref, y = reference_sample(x, y)
+    x = ref.x
 
-        # Count the number of samples in each quadrant
-        cx = 1. * np.apply_along_axis(np.bincount, 0, ix, minlength=l) / nx
-        cy = 1. * np.apply_along_axis(np.bincount, 0, iy, minlength=l) / ny
+    # Compare the fraction of each sample in the quadrants defined around
+    # the points of x, then around the points of y.
+    # This is from https://github.com/syrte/ndtest/blob/master/ndtest.py
+    # D = cx - cy
+    # D[0,:] -= 1. / nx # I don't understand this...
+    # dmin, dmax = -D.min(), D.max() + .1 / nx
+    dx = np.max(np.abs(ref.quadrants - _quadrant_counts(x, y)))
+    dy = np.max(np.abs(_quadrant_counts(y, y) - _quadrant_counts(y, x)))
 
-        # This is from https://github.com/syrte/ndtest/blob/master/ndtest.py
-        # D = cx - cy
-        # D[0,:] -= 1. / nx # I don't understand this...
-        # dmin, dmax = -D.min(), D.max() + .1 / nx
+    return max(dx, dy)
 
-        return np.max(np.abs(cx - cy))
 
-    return max(pivot(x, y), pivot(y, x))
-
-
-def kldiv(x, y, k=1):
+def kldiv(x, y, k=1, eps=0, n_jobs=2):
     """
     Compute the Kullback-Leibler divergence between two multivariate samples.
 
@@ -391,7 +728,7 @@ def kldiv(x, y, k=1):
 
     Parameters
     ----------
-    x : ndarray (n,d)
+    x : ndarray (n,d) or ReferenceSample
         Samples from distribution P, which typically represents the true
         distribution (reference).
     y : ndarray (m,d)
@@ -400,6 +737,13 @@ def kldiv(x, y, k=1):
     k : int or sequence
         The kth neighbours to look for when estimating the density of the
         distributions. Defaults to 1, which can be noisy.
+    eps : float
+        Approximation tolerance of the nearest neighbour search. With eps > 0,
+        the kth neighbour found is no further than (1 + eps) times the
+        distance to the true kth neighbour. Defaults to 0 (exact search).
+    n_jobs : int
+        Number of workers used by the nearest neighbour search. -1 uses all
+        CPUs.
 
     Returns
     -------
@@ -437,7 +781,8 @@ def kldiv(x, y, k=1):
     mk = np.iterable(k)
     ka = np.atleast_1d(k)
 
-    x, y = reshape_sample(x, y)
+    ref, y = reference_sample(x, y)
+    x = ref.x
 
     nx, d = x.shape
     ny, d = y.shape
@@ -449,15 +794,15 @@ def kldiv(x, y, k=1):
     if nx < 5 or ny < 5:
         return np.nan
 
-    # Build a KD tree representation of the samples.
-    xtree = KDTree(x)
+    # Build a KD tree representation of the candidate sample. The reference
+    # tree and neighbour distances are cached by the ReferenceSample.
     ytree = KDTree(y)
 
     # Get the k'th nearest neighbour from each points in x for both x and y.
     # We get the values for K + 1 to make sure the output is a 2D array.
     kmax = max(ka) + 1
-    r, indx = xtree.query(x, k=kmax, eps=0, p=2, n_jobs=2)
-    s, indy = ytree.query(x, k=kmax, eps=0, p=2, n_jobs=2)
+    r = ref.kneighbors(kmax, eps=eps, n_jobs=n_jobs)
+    s, indy = ytree.query(x, k=kmax, eps=eps, p=2, n_jobs=n_jobs)
 
     # There is a mistake in the paper. In Eq. 14, the right side misses a
     # negative sign on the first term of the right hand side.
@@ -474,3 +819,162 @@ def kldiv(x, y, k=1):
         return out
     else:
         return out[0]
+
+
+# ---------------------------------------------------------------------------- #
+# -------------------------- Batch computation ------------------------------- #
+# ---------------------------------------------------------------------------- #
+
+def _kolmogorov_smirnov_batch(x, y):
+    """Vectorized version of `kolmogorov_smirnov` over a stack of univariate
+    candidate samples.
+
+    In one dimension, the statistic is the largest difference between the
+    fractions of each sample strictly below a point of the pooled sample.
+    These fractions are counted for all candidates at once by sorting the
+    pooled samples.
+
+    Parameters
+    ----------
+    x : ReferenceSample
+        Reference sample (n,1).
+    y : masked array (cells,m,1)
+        Candidate samples. Masked points are excluded.
+
+    Returns
+    -------
+    ndarray (cells,)
+        Kolmogorov-Smirnov statistic for each candidate sample.
+    """
+    ncells, m, _ = y.shape
+    n = x.n
+    valid = ~np.ma.getmaskarray(y)[:, :, 0]
+    my = valid.sum(1)
+
+    # Pooled samples, masked points are sorted last and never counted.
+    z = np.hstack([np.broadcast_to(x.x[:, 0], (ncells, n)), y.filled(np.inf)[:, :, 0]])
+    isx = np.hstack([np.ones((ncells, n), bool), np.zeros((ncells, m), bool)])
+    isy = np.hstack([np.zeros((ncells, n), bool), valid])
+    order = np.argsort(z, axis=1, kind='mergesort')
+    rows = np.arange(ncells)[:, np.newaxis]
+    z, isx, isy = z[rows, order], isx[rows, order], isy[rows, order]
+
+    # Number of points of each sample strictly below each point, that is
+    # before the first point of its group of ties.
+    cx = np.hstack([np.zeros((ncells, 1), int), isx.cumsum(1)])
+    cy = np.hstack([np.zeros((ncells, 1), int), isy.cumsum(1)])
+    start = np.ones(z.shape, bool)
+    start[:, 1:] = z[:, 1:] != z[:, :-1]
+    first = np.maximum.accumulate(np.where(start, np.arange(n + m), 0), axis=1)
+
+    diff = np.abs(cx[rows, first] / float(n) - cy[rows, first] / my[:, np.newaxis].astype(float))
+    return np.where(isx | isy, diff, 0).max(1)
+
+
+# Metrics with a native vectorized implementation over a stack of candidates,
+# with the largest sample dimension they support (None for any dimension).
+# The other metrics are looped over inside `batch`.
+_batch_metrics = {'seuclidean': (_seuclidean_batch, None),
+                  'kolmogorov_smirnov': (_kolmogorov_smirnov_batch, 1)}
+
+
+def batch(dist, x, y, min_samples=5, **kwds):
+    """
+    Compute a dissimilarity metric between a reference sample and a stack
+    of candidate samples.
+
+    The metrics `seuclidean`, and `kolmogorov_smirnov` for univariate samples,
+    are computed for all candidates at once. The other metrics are computed
+    for each candidate in turn.
+
+    Parameters
+    ----------
+    dist : str
+        Name of the dissimilarity metric, one of `__all__`.
+    x : ndarray (n,d) or ReferenceSample
+        Reference sample.
+    y : array_like (cells,m,d) or (cells,m)
+        Stack of candidate samples. Masked or NaN values are excluded from
+        the candidate sample they belong to.
+    min_samples : int
+        Minimum number of valid points in a candidate sample. Candidates with
+        fewer valid points are assigned NaN. The default value of 5 is
+        arbitrary.
+    kwds : dict
+        Additional keyword arguments passed to the metric.
+
+    Returns
+    -------
+    ndarray (cells,)
+        Dissimilarity metric for each candidate sample.
+    """
+    if dist not in __all__:
+        raise ValueError("{} is not a dissimilarity metric.".format(dist))
+
+    if not isinstance(x, ReferenceSample):
+        x = ReferenceSample(x)
+
+    y = np.ma.masked_invalid(y)
+    if y.ndim == 2:
+        y = y[:, :, np.newaxis]
+
+    ncells, m, d = y.shape
+    assert (x.d == d)
+
+    # A point is valid only if all its dimensions are valid.
+    valid = ~np.ma.getmaskarray(y).any(-1)
+    enough = valid.sum(1) >= min_samples
+
+    out = np.empty(ncells)
+    out.fill(np.nan)
+    if not enough.any():
+        return out
+
+    func, max_d = _batch_metrics.get(dist, (None, None))
+    if func is not None and not kwds and (max_d is None or d <= max_d):
+        ys = np.ma.array(y.data[enough], mask=np.repeat(~valid[enough][:, :, np.newaxis], d, -1))
+        out[enough] = func(x, ys)
+    else:
+        metric = globals()[dist]
+        for i in np.flatnonzero(enough):
+            out[i] = metric(x, y.data[i][valid[i]], **kwds)
+
+    return out
+
+
+def select_candidates(score, size=0, threshold=None):
+    """
+    Select the most promising candidates from a screening score.
+
+    Used in a two-stage search, where a cheap metric (e.g. `seuclidean`)
+    first ranks all candidates and the expensive metric is then only computed
+    on the selected ones.
+
+    Parameters
+    ----------
+    score : array_like
+        Screening dissimilarity of each candidate. NaN values are never
+        selected.
+    size : int
+        Maximum number of candidates selected, those with the lowest
+        scores. Ties at the limit are all selected. 0 means no limit.
+    threshold : float, optional
+        Only candidates whose score is lower or equal to the threshold are
+        selected.
+
+    Returns
+    -------
+    ndarray (bool)
+        Mask of the selected candidates, with the same shape as `score`.
+    """
+    score = np.ma.filled(np.ma.masked_invalid(score), np.inf)
+    keep = np.isfinite(score)
+
+    if threshold is not None:
+        keep &= score <= threshold
+
+    if size and keep.sum() > size:
+        limit = np.partition(score[keep], size - 1)[size - 1]
+        keep &= score <= limit
+
+    return keep
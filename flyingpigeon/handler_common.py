@@ -13,7 +13,7 @@ from ocgis.exc import ExtentError
 import netCDF4
 from shapely.geometry import shape
 
-from flyingpigeon.utils import guess_main_variables, opendap_or_download
+from flyingpigeon.utils import guess_main_variables, stage_resources
 
 json_format = get_format('JSON')
 
@@ -32,19 +32,20 @@ def wfs_common(request, response, mode, spatial_mode='wfs'):
     outputpath = configuration.get_config_value('server', 'outputpath')
     outputurl = configuration.get_config_value('server', 'outputurl')
 
-    list_of_files = []
-    for one_resource in request.inputs['resource']:
-        # Download if not opendap
-        # Adding a maximum file size from a server config file would
-        # be possible here...
-        try:
-            nc_file = opendap_or_download(
-                one_resource.data,
-                auth_tkt_cookie=request.http_request.cookies,
-                output_path='/tmp')
-        except:
-            raise Exception(traceback.format_exc())
-        list_of_files.append(nc_file)
+    # Download if not opendap
+    # Adding a maximum file size from a server config file would
+    # be possible here...
+    def progress(count, total):
+        response.update_status('Staged {0}/{1} resources'.format(count, total),
+                               int(40.0 * count / total))
+
+    try:
+        list_of_files = stage_resources(
+            [one_resource.data for one_resource in request.inputs['resource']],
+            auth_tkt_cookie=request.http_request.cookies,
+            output_path='/tmp', progress=progress)
+    except:
+        raise Exception(traceback.format_exc())
 
     if ('typename' in request.inputs) and ('featureids' in request.inputs):
         typename = request.inputs['typename'][0].data
@@ -109,9 +110,7 @@ def wfs_common(request, response, mode, spatial_mode='wfs'):
                 file_prefix = file_name
             ocgis.env.DIR_OUTPUT = tempfile.mkdtemp(dir=os.getcwd())
             ocgis.env.OVERWRITE = True
-            nc = netCDF4.Dataset(one_file, 'r')
-            var_names = guess_main_variables(nc)
-            nc.close()
+            var_names = guess_main_variables(one_file)
             rd = ocgis.RequestDataset(one_file, var_names)
             for i, one_geom in enumerate(geom):
                 if one_geom is None:
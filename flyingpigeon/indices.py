@@ -1,6 +1,7 @@
 import os
 from eggshell.ocg.utils import calc_grouping
-from eggshell.nc.utils import sort_by_filename, get_variable
+from eggshell.nc.utils import sort_by_filename
+from flyingpigeon.utils import get_variable
 from flyingpigeon.subset import get_ugid, get_geom
 from flyingpigeon import config
 
@@ -0,0 +1,155 @@
+"""
+Resolution of the land/sea masks matching datasets.
+
+The land area fraction (sftlf) file of a dataset is searched once per set of
+model, domain and ensemble facets, either in ESGF or in a local search index.
+The resolved location is remembered for `config.landsea_mask_ttl()` hours in
+a persistent index, and the mask itself is copied into the cache so that
+later requests read it locally.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+import netCDF4 as nc
+
+from flyingpigeon import config
+from flyingpigeon.cache import FileCache, file_lock, make_key
+from flyingpigeon.utils import ATTRIBUTE_TO_FACETS_MAP, search_landsea_mask_by_esgf
+
+LOGGER = logging.getLogger("PYWPS")
+
+# Facets that differ between datasets sharing the same land/sea mask.
+_DATASET_FACETS = ['experiment', 'time_frequency', 'variable']
+
+
+def mask_cache():
+    """Return the cache storing local copies of the land/sea masks."""
+    return FileCache('landsea', config.landsea_cache_size() * 1024 ** 2)
+
+
+def mask_facets(resource):
+    """
+    Return the facets identifying the land/sea mask of a dataset.
+
+    :param resource: netCDF file or OPeNDAP URL
+
+    :return dict: facet values read from the global attributes of the dataset
+    """
+    with nc.Dataset(resource) as ds:
+        attributes = ds.ncattrs()
+        facets = dict((facet, str(ds.getncattr(attr))) for attr, facet in ATTRIBUTE_TO_FACETS_MAP.items()
+                      if attr in attributes and facet not in _DATASET_FACETS)
+    return facets
+
+
+def search_index(facets, index):
+    """
+    Search a land/sea mask in a local search index.
+
+    The index is a JSON list of entries holding facet values and the `url` of
+    the mask. It stands in for the ESGF search when working offline.
+
+    :param facets: facets of the dataset
+    :param index: path to the JSON index
+
+    :return str: URL or path of the first matching mask
+    """
+    with open(index) as f:
+        entries = json.load(f)
+    for entry in entries:
+        if all(entry.get(k) == v for k, v in facets.items()):
+            return entry['url']
+    raise Exception("Could not find a mask in {} for facets {}".format(index, facets))
+
+
+def landsea_mask(resource, index=None, ttl=None):
+    """
+    Return the path to a local copy of the land/sea mask matching a dataset.
+
+    :param resource: netCDF file or OPeNDAP URL
+    :param index: local search index used instead of ESGF, defaults to `config.landsea_mask_index()`
+    :param ttl: hours during which a resolved mask location is reused, defaults to `config.landsea_mask_ttl()`
+
+    :return str: path to the cached land area fraction file
+    """
+    if index is None:
+        index = config.landsea_mask_index()
+    if ttl is None:
+        ttl = config.landsea_mask_ttl()
+
+    cache = mask_cache()
+    facets = mask_facets(resource)
+    if not facets:
+        # Nothing identifies the mask apart from the dataset itself.
+        return _store(cache, _search(resource, facets, index))
+
+    key = make_key(sorted(facets.items()), index)
+    resolved = _read_resolved().get(key)
+    if resolved is not None and time.time() - resolved['time'] < ttl * 3600:
+        url = resolved['url']
+    else:
+        url = _search(resource, facets, index)
+        _write_resolved(key, dict(url=url, time=time.time(), facets=facets))
+    return _store(cache, url)
+
+
+def _search(resource, facets, index):
+    LOGGER.info('Searching land/sea mask for {}'.format(os.path.basename(resource)))
+    if index:
+        return search_index(facets, index)
+    return search_landsea_mask_by_esgf(resource)
+
+
+def _store(cache, url):
+    """Copy a land/sea mask into the cache unless it is already there."""
+    key = make_key(url)
+    path = cache.get(key)
+    if path is not None:
+        return path
+
+    fd, tmp = tempfile.mkstemp(suffix='.nc')
+    os.close(fd)
+    try:
+        with nc.Dataset(url) as src, nc.Dataset(tmp, 'w') as dst:
+            dst.setncatts(dict((k, src.getncattr(k)) for k in src.ncattrs()))
+            for name, dim in src.dimensions.items():
+                dst.createDimension(name, len(dim))
+            for name, var in src.variables.items():
+                out = dst.createVariable(name, var.dtype, var.dimensions,
+                                         fill_value=getattr(var, '_FillValue', None))
+                out.setncatts(dict((k, var.getncattr(k)) for k in var.ncattrs() if k != '_FillValue'))
+                out[:] = var[:]
+        return cache.put(key, tmp)
+    finally:
+        os.remove(tmp)
+
+
+def _resolved_path():
+    # Kept out of the mask cache directory so that it is never evicted.
+    return os.path.join(config.cache_path(), 'landsea.json')
+
+
+def _read_resolved():
+    """Return the persistent index of resolved mask locations."""
+    try:
+        with open(_resolved_path()) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_resolved(key, entry):
+    path = _resolved_path()
+    # Concurrent writers would otherwise drop each other's entries.
+    with file_lock(path + '.lock'):
+        resolved = _read_resolved()
+        resolved[key] = entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(resolved, f)
+        # Atomic replacement, concurrent readers see either index.
+        os.rename(tmp, path)
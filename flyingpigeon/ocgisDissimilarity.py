@@ -1,12 +1,22 @@
+import logging
+
 import dissimilarity as dd
+import netCDF4 as nc
 import numpy as np
-from ocgis.util.helpers import iter_array
 from ocgis.calc.base import AbstractParameterizedFunction, AbstractFieldFunction
 from ocgis.collection.field import Field
 from ocgis.constants import NAME_DIMENSION_TEMPORAL
 
+LOGGER = logging.getLogger("PYWPS")
+
 metrics = dd.__all__
 
+# Metrics relying on nearest neighbour searches.
+neighbor_metrics = ['nearest_neighbor', 'kldiv']
+
+# Default memory budget in bytes for the candidate values held in memory.
+_MAX_MEMORY = 2 ** 28
+
 # NOTE: This code builds on ocgis branch v-2.0.0.dev1
 
 
@@ -20,11 +30,15 @@ class Dissimilarity(AbstractFieldFunction, AbstractParameterizedFunction):
     standard_name = 'dissimilarity_metric'
     description = 'Metric evaluating the dissimilarity between two ' \
                   'multivariate samples'
-    parms_definition = {'dist': str, 'target': Field, 'candidate': tuple}
+    parms_definition = {'dist': str, 'target': Field, 'candidate': tuple,
+                        'eps': float, 'n_jobs': int, 'screen': int,
+                        'screen_threshold': float, 'max_memory': int}
     required_variables = ['candidate', 'target']
     _potential_dist = metrics
 
-    def calculate(self, target=None, candidate=None, dist='seuclidean'):
+    def calculate(self, target=None, candidate=None, dist='seuclidean',
+                  eps=0., n_jobs=2, screen=0, screen_threshold=None,
+                  max_memory=_MAX_MEMORY):
         """
 
         Parameters
@@ -35,15 +49,32 @@ class Dissimilarity(AbstractFieldFunction, AbstractParameterizedFunction):
         candidate : tuple
             Sequence of variable names identifying climate indices on which
             the comparison will be performed.
-        dist : {'seuclidean', 'nearest_neighbor', 'zech_aslan',
+        dist : {'seuclidean', 'nearest_neighbor', 'zech_aslan', 'skezely_rizzo',
            'kolmogorov_smirnov', 'friedman_rafsky', 'kldiv'}
             Name of the distance measure, or dissimilarity metric.
+        eps : float
+            Approximation tolerance of the nearest neighbour searches for the
+            `nearest_neighbor` and `kldiv` metrics. Defaults to 0 (exact).
+        n_jobs : int
+            Number of workers used by the nearest neighbour searches.
+        screen : int
+            Two-stage search: number of candidate cells on which the metric
+            is computed. All cells are first ranked using the cheap
+            `seuclidean` metric, and only the `screen` most similar cells
+            are then compared using `dist`. The other cells are set to NaN.
+            Defaults to 0, computing the metric over all cells.
+        screen_threshold : float
+            Two-stage search: only cells whose `seuclidean` screening value
+            is lower or equal to the threshold are compared using `dist`.
+            The other cells are set to NaN.
+        max_memory : int
+            Approximate budget in bytes for the candidate values held in
+            memory. Candidate values are read in blocks of rows, aligned on
+            the chunks of the source file when known, and the budget bounds
+            the size of these blocks.
         """
         assert (dist in self._potential_dist)
 
-        # Get the function from the module.
-        metric = getattr(dd, dist)
-
         for var in candidate:
             if var not in target.keys():
                 raise ValueError("{} not in candidate Field.".format(var))
@@ -52,6 +83,13 @@ class Dissimilarity(AbstractFieldFunction, AbstractParameterizedFunction):
         ref = np.array([target[c].get_value().squeeze() for c in candidate]).T
         assert ref.ndim == 2
 
+        # Precompute the reference properties shared by all candidates.
+        ref = dd.ReferenceSample(ref)
+
+        kwds = {}
+        if dist in neighbor_metrics:
+            kwds = dict(eps=eps, n_jobs=n_jobs)
+
         # Create the fill variable based on the first candidate variable.
         variable = self.field[candidate[0]]
         crosswalk = self._get_dimension_crosswalk_(variable)
@@ -67,29 +105,41 @@ class Dissimilarity(AbstractFieldFunction, AbstractParameterizedFunction):
         # Metric computation #
         # ================== #
 
-        # Iterator over every dimension except time
-        itr = iter_array(fill)
-
+        # The candidate values are read in blocks of rows, each holding all
+        # the cells along the last axis. All cells of a block are sent at
+        # once to the batch function, then the block is released.
         arr = self.get_variable_value(fill)
-        for ind in itr:
-
-            # Build target array
-            dind = list(ind)
-            dind.insert(time_axis, slice(None))
-            data = np.array([self.field[c][dind].get_value().squeeze() for c in
-                             candidate])
-
-            p = np.ma.masked_invalid(data).T
-
-            # Compress masked values from target array.
-            pc = p.compress(~p.mask.any(1), 0)
+        nrows = self._get_block_rows_(variable, time_axis, len(candidate), max_memory)
+        blocks = list(self._get_blocks_(fill.shape, nrows))
+
+        # Screening stage: rank all cells with the standardized Euclidean
+        # distance and keep the most similar ones.
+        keep = None
+        if screen or screen_threshold is not None:
+            score = np.empty(fill.shape)
+            for ind in blocks:
+                data = self._get_data_(ind, candidate, time_axis)
+                score[ind] = dd.batch('seuclidean', ref, data).reshape(score[ind].shape)
+            keep = dd.select_candidates(score, size=screen, threshold=screen_threshold)
+            score[~keep] = np.nan
+
+        for ind in blocks:
+            if keep is None:
+                data = self._get_data_(ind, candidate, time_axis)
+                out = dd.batch(dist, ref, data, **kwds)
+
+            elif dist == 'seuclidean':
+                out = score[ind]
 
-            # Compute the actual metric value. The 5 value threshold is
-            # arbitrary.
-            if pc.shape[0] >= 5:
-                arr.data[ind] = metric(ref, pc)
             else:
-                arr.data[ind] = np.nan
+                k = keep[ind].ravel()
+                out = np.empty(k.shape)
+                out.fill(np.nan)
+                if k.any():
+                    data = self._get_data_(ind, candidate, time_axis)
+                    out[k] = dd.batch(dist, ref, data[k], **kwds)
+
+            arr.data[ind] = out.reshape(arr.data[ind].shape)
 
         # Add the output variable to calculations variable collection. This
         # is what is returned by the execute() call.
@@ -101,3 +151,59 @@ class Dissimilarity(AbstractFieldFunction, AbstractParameterizedFunction):
         # Replaces the time value on the field.
         self.field.set_time(tgv)
         fill.units = ''
+
+    def _get_data_(self, ind, candidate, time_axis):
+        """Return the (cells, n, d) candidate array for the block at index `ind`."""
+        dind = [i if isinstance(i, slice) else slice(i, i + 1) for i in ind]
+        dind.insert(time_axis, slice(None))
+        return np.stack([self._get_band_(self.field[c][dind], time_axis)
+                         for c in candidate], -1)
+
+    @staticmethod
+    def _get_band_(variable, time_axis):
+        """Return the values of a block as a (cells, n) array."""
+        value = np.moveaxis(variable.get_value(), time_axis, -1)
+        return value.reshape(-1, value.shape[-1])
+
+    @staticmethod
+    def _get_blocks_(shape, nrows):
+        """Yield the indices of the blocks of `nrows` rows covering an array
+        of the given shape. Rows are along the second to last axis."""
+        if len(shape) < 2:
+            yield (slice(None),)
+            return
+
+        for lead in np.ndindex(*shape[:-2]):
+            for r0 in range(0, shape[-2], nrows):
+                yield lead + (slice(r0, r0 + nrows), slice(None))
+
+    @staticmethod
+    def _get_block_rows_(variable, time_axis, nvar, max_memory):
+        """Return the number of rows in a block of candidate values.
+
+        The double precision values of one row over all variables, with their copies made
+        while building the candidate array, should fit in the memory budget.
+        When the chunking of the source file is known, the number of rows is
+        rounded down to a multiple of the chunk size along the row axis.
+        """
+        shape = list(variable.shape)
+        ntime = shape.pop(time_axis)
+        ncols = shape[-1] if len(shape) > 1 else 1
+        row = 3 * ncols * ntime * nvar * 8
+        nrows = int(max(1, max_memory // row))
+
+        try:
+            uri = variable._request_dataset.uri
+            if isinstance(uri, (list, tuple)):
+                uri = uri[0]
+            with nc.Dataset(uri) as ds:
+                chunks = ds.variables[variable.source_name].chunking()
+            if chunks != 'contiguous':
+                chunk = chunks[-2] if len(chunks) > 2 else 1
+                if nrows > chunk:
+                    nrows -= nrows % chunk
+        except Exception:
+            LOGGER.debug('Chunking of {} unknown, blocks are not aligned on chunks'.format(variable.name),
+                         exc_info=True)
+
+        return nrows
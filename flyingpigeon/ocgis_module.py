@@ -1,9 +1,15 @@
 from netCDF4 import Dataset
+import os
 from os.path import  abspath, curdir, isfile
 import logging
+import shutil
 import config
+from flyingpigeon.cache import FileCache, canonical, make_key, source_signature
 LOGGER = logging.getLogger("PYWPS")
 
+# Upper bound in MB of the memory used by an ocgis operation.
+MAX_MEMORY_LIMIT = 1024. * 4
+
 
 #from eggshell.ocg.utils import call # Does not work from eggshell due to shapefile path from config that are wrong.
 
@@ -13,7 +19,7 @@ def call(resource=[], variable=None, dimension_map=None, agg_selection=True, cal
          geom=None, output_format_options=None, search_radius_mult=2.,
          select_nearest=False, select_ugid=None, spatial_wrapping=None,
          t_calendar=None, time_region=None,
-         time_range=None, dir_output=None, output_format='nc'):
+         time_range=None, dir_output=None, output_format='nc', cache=None):
     '''
     ocgis operation call
     :param resource:
@@ -22,18 +28,19 @@ def call(resource=[], variable=None, dimension_map=None, agg_selection=True, cal
     :param agg_selection: For aggregation of in case of mulitple polygons geoms
     :param calc: ocgis calc syntax for calculation partion
     :param calc_grouping: time aggregate grouping
-    :param cdover: use py-cdo ('python', by default) or cdo from the system ('system')
+    :param cdover: deprecated, regridding applies cached weights in memory (see `flyingpigeon.regrid`)
     :param conform_units_to:
     :param crs: coordinate reference system
-    :param memory_limit: limit the amount of data to be loaded into the memory at once \
-        if None (default) free memory is detected by birdhouse
+    :param memory_limit: limit in MB of the amount of data to be loaded into the memory at once. \
+        If None (default), half of the free memory is used, up to 4 GB. Larger requests are \
+        computed over spatial tiles fitting in this limit.
     :param level_range: subset of given levels
     :param prefix: string for the file base name
     :param regrid_destination: file path with netCDF file with grid for output file
     :param geom: name of shapefile stored in birdhouse shape cabinet
     :param output_format_options: output options for netCDF e.g compression level()
     :param regrid_destination: file containing the targed grid (griddes.txt or netCDF file)
-    :param regrid_options: methods for regridding:
+    :param regrid_options: methods for regridding, using weights cached per source and destination grids:
                           'bil' = Bilinear interpolation
                           'bic' = Bicubic interpolation
                           'dis' = Distance-weighted average remapping
@@ -48,6 +55,9 @@ def call(resource=[], variable=None, dimension_map=None, agg_selection=True, cal
     :param time_range: sequence of two datetime.datetime objects to mark start and end point
     :param dir_output (default= curdir):
     :param output_format:
+    :param cache: reuse the output of previous calls with identical arguments on unchanged resources. \
+        Cached outputs are copied into dir_output, so that the returned file can be modified. \
+        If None (default), the `ocgis_cache` configuration option is used.
     :return: output file path
     '''
     LOGGER.info('Start ocgis module call function')
@@ -68,27 +78,7 @@ def call(resource=[], variable=None, dimension_map=None, agg_selection=True, cal
         dir_output = abspath(curdir)
 
     # check time_range format:
-
-    if time_range is not None:
-        try:
-            LOGGER.debug('time_range type= %s , %s ' % (type(time_range[0]), type(time_range[1])))
-            LOGGER.debug('time_range= %s , %s ' % (time_range[0], time_range[1]))
-            # if type(time_range[0] is 'datetime.date'):
-            if (isinstance(time_range[0], dd) and not isinstance(time_range[0], dt)):
-                time_range = [dt.combine(time_range[0], dt.min.time()),
-                              dt.combine(time_range[1], dt.min.time())]
-                # time_range = [dt.combine(time_range[0], dt_time(12,0)),
-                #               dt.combine(time_range[1], dt_time(12,0))]
-            LOGGER.debug('time_range changed to type= %s , %s ' % (type(time_range[0]), type(time_range[1])))
-            LOGGER.debug('time_range changed to= %s , %s ' % (time_range[0], time_range[1]))
-        except:
-            LOGGER.exception('failed to convert data to datetime')
-
-    if spatial_wrapping == 'wrap':
-        spatial_reorder = True
-    else:
-        spatial_reorder = False
-    LOGGER.debug('spatial_reorder: %s and spatial_wrapping: %s ' % (spatial_reorder, spatial_wrapping))
+    time_range = get_time_range(time_range)
 
     if prefix is None:
         prefix = str(uuid.uuid1())
@@ -105,6 +95,36 @@ def call(resource=[], variable=None, dimension_map=None, agg_selection=True, cal
 
     if type(resource) != list:
         resource = list([resource])
+
+    ##########################
+    # look for a cached result
+    ##########################
+    if cache is None:
+        cache = config.ocgis_cache()
+
+    key = None
+    if cache and output_format == 'nc':
+        try:
+            key = make_key([source_signature(r) for r in resource], canonical([
+                variable, dimension_map, agg_selection, calc, calc_grouping, conform_units_to,
+                level_range, geom, search_radius_mult, select_nearest, select_ugid,
+                spatial_wrapping, t_calendar, time_region, time_range, output_format_options,
+                regrid_options]),
+                None if regrid_destination is None else source_signature(regrid_destination))
+        except TypeError as e:
+            LOGGER.debug('ocgis call arguments can not be cached: %s' % e)
+        else:
+            results = ocgis_cache()
+            cached = results.get(key)
+            if cached is not None:
+                output = os.path.join(dir_output, prefix + '.nc')
+                try:
+                    shutil.copyfile(cached, output)
+                    return output
+                except (IOError, OSError):
+                    # Evicted in the meantime.
+                    LOGGER.exception('failed to copy cached ocgis output, calling ocgis instead')
+
     # execute ocgis
     LOGGER.info('Execute ocgis module call function')
 
@@ -117,155 +137,87 @@ def call(resource=[], variable=None, dimension_map=None, agg_selection=True, cal
 
     try:
         LOGGER.debug('call module curdir = %s ' % abspath(curdir))
-        rd = RequestDataset(resource, variable=variable, level_range=level_range,
-                            dimension_map=dimension_map, conform_units_to=conform_units_to,
-                            time_region=time_region, t_calendar=t_calendar, time_range=time_range) # , crs=crs)
-
-        from ocgis.constants import DimensionMapKey
-        rd.dimension_map.set_bounds(DimensionMapKey.TIME, None)
-
-        ops = OcgOperations(dataset=rd,
-                            output_format_options=output_format_options,
-                            dir_output=dir_output,
-                            spatial_wrapping=spatial_wrapping,
-                            spatial_reorder=spatial_reorder,
-                            # regrid_destination=rd_regrid,
-                            # options=options,
-                            calc=calc,
-                            calc_grouping=calc_grouping,
-                            geom=geom,
-                            agg_selection=agg_selection,
-                            output_format=output_format,
-                            prefix=prefix,
-                            search_radius_mult=search_radius_mult,
-                            select_nearest=select_nearest,
-                            select_ugid=select_ugid,
-                            add_auxiliary_files=False)
+        rd = request_dataset(resource, variable=variable, level_range=level_range,
+                             dimension_map=dimension_map, conform_units_to=conform_units_to,
+                             time_region=time_region, t_calendar=t_calendar, time_range=time_range) # , crs=crs)
+
+        ops_kwds = get_ops_options(spatial_wrapping, output_format_options)
+        ops_kwds.update(dataset=rd,
+                        dir_output=dir_output,
+                        # regrid_destination=rd_regrid,
+                        # options=options,
+                        calc=calc,
+                        calc_grouping=calc_grouping,
+                        geom=geom,
+                        agg_selection=agg_selection,
+                        output_format=output_format,
+                        prefix=prefix,
+                        search_radius_mult=search_radius_mult,
+                        select_nearest=select_nearest,
+                        select_ugid=select_ugid)
+        ops = OcgOperations(**ops_kwds)
         LOGGER.info('OcgOperations set')
     except:
         LOGGER.exception('failed to setup OcgOperations')
         return None
 
+    ##########################################
+    # compare the request size with the memory
+    ##########################################
+    tile_dimension = None
     try:
-        LOGGER.info('ocgis module call as ops.execute()')
-        geom_file = ops.execute()
+        mem_limit = get_memory_limit(memory_limit)
+        data_mb = ops.get_base_request_size()['total'] / 1024.
+        LOGGER.info('request size = %s MB, memory_limit = %s MB' % (data_mb, mem_limit))
+
+        if data_mb > mem_limit:
+            variables = rd.variable if isinstance(rd.variable, (list, tuple)) else [rd.variable]
+            if output_format != 'nc':
+                LOGGER.warning('request exceeds the memory limit, but chunked computation '
+                               'requires netCDF output: calling as execute instead')
+            elif calc is None and len(variables) != 1:
+                LOGGER.warning('request exceeds the memory limit, but chunked computation '
+                               'requires a single variable: calling as execute instead')
+            else:
+                shape = rd.get().grid.shape
+                tile_dimension = get_tile_dimension(data_mb, shape, mem_limit)
+                ntiles = -(-shape[0] // tile_dimension) * -(-shape[1] // tile_dimension)
+                LOGGER.info('request exceeds the memory limit: computing over %s tiles of %s x %s '
+                            'grid cells' % (ntiles, tile_dimension, tile_dimension))
+    except:
+        LOGGER.exception('failed to compare data load with free memory, calling as execute instead')
+
+    try:
+        if tile_dimension is None:
+            LOGGER.info('ocgis module call as ops.execute()')
+            geom_file = ops.execute()
+        else:
+            # Chunked computation requires a calculation.
+            if calc is None:
+                ops_kwds['calc'] = '%s=%s*1' % (variables[0], variables[0])
+                LOGGER.info('calc set to = %s ' % ops_kwds['calc'])
+            ops = OcgOperations(**ops_kwds)
+            LOGGER.info('ocgis module call compute with chunks')
+            geom_file = compute(ops, tile_dimension=tile_dimension, verbose=False)
     except:
         LOGGER.exception('failed to execute ocgis operation')
         return None
 
-    #
-    # try:
-    #     from numpy import sqrt
-    #     from flyingpigeon.utils import FreeMemory
-    #
-    #     if memory_limit is None:
-    #         f = FreeMemory()
-    #         mem_kb = f.user_free
-    #         mem_mb = mem_kb / 1024.
-    #         mem_limit = mem_mb / 2.  # set limit to half of the free memory
-    #     else:
-    #         mem_limit = memory_limit
-    #
-    #     if mem_limit >= 1024. * 4:
-    #         mem_limit = 1024. * 4
-    #         # 475.0 MB for openDAP
-    #
-    #     LOGGER.info('memory_limit = %s Mb' % (mem_limit))
-    #
-    #     data_kb = ops.get_base_request_size()['total']
-    #     data_mb = data_kb / 1024.
-    #
-    #     # data_kb = size['total']/reduce(lambda x,y: x*y,size['variables'][variable]['value']['shape'])
-    #     LOGGER.info('data_mb  = %s Mb' % (data_mb))
-    #
-    #     if data_mb <= mem_limit:  # input is smaler than the half of free memory size
-    #         try:
-    #             LOGGER.info('ocgis module call as ops.execute()')
-    #             geom_file = ops.execute()
-    #         except Exception as e:
-    #             LOGGER.debug('failed to execute ocgis operation')
-    #             raise
-    #             return None
-    #
-    #     else:
-    #         ##########################
-    #         # calcultion of chunk size
-    #         ##########################
-    #         try:
-    #             size = ops.get_base_request_size()
-    #             nb_time_coordinates_rd = size['variables'][variable]['temporal']['shape'][0]
-    #             element_in_kb = size['total']/reduce(lambda x, y: x*y, size['variables'][variable]['value']['shape'])
-    #             element_in_mb = element_in_kb / 1024.
-    #             tile_dim = sqrt(mem_limit/(element_in_mb*nb_time_coordinates_rd))  # maximum chunk size
-    #
-    #             LOGGER.info('ocgis module call compute with chunks')
-    #             if calc is None:
-    #                 calc = '%s=%s*1' % (variable, variable)
-    #                 LOGGER.info('calc set to = %s ' % calc)
-    #             ops = OcgOperations(dataset=rd,
-    #                                 output_format_options=output_format_options,
-    #                                 dir_output=dir_output,
-    #                                 spatial_wrapping=spatial_wrapping,
-    #                                 spatial_reorder=spatial_reorder,
-    #                                 # regrid_destination=rd_regrid,
-    #                                 # options=options,
-    #                                 calc=calc,
-    #                                 calc_grouping=calc_grouping,
-    #                                 geom=geom,
-    #                                 output_format=output_format,
-    #                                 prefix=prefix,
-    #                                 search_radius_mult=search_radius_mult,
-    #                                 select_nearest=select_nearest,
-    #                                 select_ugid=select_ugid,
-    #                                 add_auxiliary_files=False)
-    #             geom_file = compute(ops, tile_dimension=int(tile_dim), verbose=True)
-    #             print 'ocgis calculated'
-    #         except Exception as e:
-    #             LOGGER.debug('failed to compute ocgis with chunks')
-    #             raise
-    #             return None
-    #     LOGGER.info('Succeeded with ocgis module call function')
-    # except:
-    #     LOGGER.exception('failed to compare dataload with free memory, calling as execute instead')
-
     ############################################
     # remapping according to regrid informations
     ############################################
     if regrid_destination is not None:
         try:
-            if (cdover=='system'):
-                from os import system
-                remap = 'remap%s' % regrid_options
-                output = '%s.nc' % uuid.uuid1()
-                output = abspath(curdir)+'/'+output
-                comcdo = 'cdo -O %s,%s %s %s' % (remap, regrid_destination, geom_file, output)
-                system(comcdo)
-
-                if(isfile(output)==False):
-                    comcdo = '/usr/bin/cdo -O %s,%s %s %s' % (remap, regrid_destination, geom_file, output)
-                    system(comcdo)
-
-                if(isfile(output)==False): cdover='python'
-
-                # need to substitute by subprocess call
-                # TODO: If system failed - py-cdo used insted
-                # what if py-cdo failed, with option 'python'
-                # need to call 'system' in this case - need to write function
-
-            if (cdover=='python'):
-                from tempfile import mkstemp
-                from cdo import Cdo
-                cdo = Cdo()
-                output = '%s.nc' % uuid.uuid1()
-                remap = 'remap%s' % regrid_options
-                call = [op for op in dir(cdo) if remap in op]
-                cmd = "output = cdo.%s('%s',input='%s', output='%s')" \
-                      % (str(call[0]), regrid_destination, geom_file, output)
-                exec cmd
+            from flyingpigeon.regrid import regrid
+            output = regrid(geom_file, regrid_destination, method=regrid_options, dir_output=dir_output)
+            # The ocgis output is only an intermediate file, the regridded
+            # file takes its name.
+            os.remove(geom_file)
+            os.rename(output, geom_file)
+            output = geom_file
         except Exception as e:
             LOGGER.debug('failed to remap')
             raise
-            return None
     else:
         output = geom_file
 
@@ -274,8 +226,118 @@ def call(resource=[], variable=None, dimension_map=None, agg_selection=True, cal
     #     lat, lon = unrotate_pole(output)
     # except:
     #     LOGGER.exception('failed to unrotate pole')
+
+    if key is not None:
+        try:
+            results.put(key, output)
+        except Exception:
+            LOGGER.exception('failed to store ocgis output in cache')
     return output
 
+
+def get_time_range(time_range):
+    """
+    Return a time range with the datetime objects expected by ocgis.
+
+    :param time_range: sequence of two datetime.date or datetime.datetime objects, or None
+
+    :return list: start and end datetime.datetime objects, or None
+    """
+    from datetime import datetime as dt
+    from datetime import date as dd
+
+    if time_range is None:
+        return None
+    try:
+        LOGGER.debug('time_range type= %s , %s ' % (type(time_range[0]), type(time_range[1])))
+        LOGGER.debug('time_range= %s , %s ' % (time_range[0], time_range[1]))
+        if (isinstance(time_range[0], dd) and not isinstance(time_range[0], dt)):
+            time_range = [dt.combine(time_range[0], dt.min.time()),
+                          dt.combine(time_range[1], dt.min.time())]
+            # time_range = [dt.combine(time_range[0], dt_time(12,0)),
+            #               dt.combine(time_range[1], dt_time(12,0))]
+        LOGGER.debug('time_range changed to type= %s , %s ' % (type(time_range[0]), type(time_range[1])))
+        LOGGER.debug('time_range changed to= %s , %s ' % (time_range[0], time_range[1]))
+    except:
+        LOGGER.exception('failed to convert data to datetime')
+    return time_range
+
+
+def request_dataset(resource, time_range=None, **kwds):
+    """
+    Return the ocgis RequestDataset of an operation, ignoring the time bounds of the resource.
+
+    :param resource: input netCDF files
+    :param time_range: sequence of two datetime.date or datetime.datetime objects
+    :param kwds: other RequestDataset arguments
+
+    :return RequestDataset:
+    """
+    from ocgis import RequestDataset
+    from ocgis.constants import DimensionMapKey
+
+    rd = RequestDataset(resource, time_range=get_time_range(time_range), **kwds)
+    rd.dimension_map.set_bounds(DimensionMapKey.TIME, None)
+    return rd
+
+
+def get_ops_options(spatial_wrapping=None, output_format_options=None):
+    """
+    Return the OcgOperations options shared by the operations of `call` and `subset.clip_polygons`.
+
+    :param spatial_wrapping: how to handle coordinates, options: None (default), 'wrap', 'unwrap'
+    :param output_format_options: output options for netCDF e.g compression level()
+
+    :return dict: OcgOperations arguments
+    """
+    spatial_reorder = spatial_wrapping == 'wrap'
+    LOGGER.debug('spatial_reorder: %s and spatial_wrapping: %s ' % (spatial_reorder, spatial_wrapping))
+    return dict(spatial_wrapping=spatial_wrapping,
+                spatial_reorder=spatial_reorder,
+                output_format_options=output_format_options,
+                add_auxiliary_files=False)
+
+
+def ocgis_cache():
+    """Return the cache storing the outputs of `call`."""
+    return FileCache('ocgis', config.ocgis_cache_size() * 1024 ** 2)
+
+
+def get_memory_limit(memory_limit=None):
+    """
+    Return the memory available to an ocgis operation.
+
+    :param memory_limit: explicit limit in MB. If None, half of the free memory is used.
+
+    :return float: memory limit in MB, at most 4 GB
+    """
+    if memory_limit is None:
+        from flyingpigeon.utils import FreeMemory
+        mem_limit = FreeMemory(unit='MB').user_free / 2.
+    else:
+        mem_limit = float(memory_limit)
+
+    return min(mem_limit, MAX_MEMORY_LIMIT)
+
+
+def get_tile_dimension(data_mb, grid_shape, mem_limit):
+    """
+    Return the size of square spatial tiles such that the data of a tile fits in memory.
+
+    :param data_mb: size of the data request in MB
+    :param grid_shape: shape of the spatial grid (rows, columns)
+    :param mem_limit: memory limit in MB
+
+    :return int: number of rows and columns in a tile
+    """
+    from numpy import sqrt, prod
+
+    ncells = prod(grid_shape)
+    cells_per_tile = ncells * mem_limit / data_mb
+    tile_dim = int(sqrt(cells_per_tile))
+    return max(1, min(tile_dim, max(grid_shape)))
+
+
 def has_Lambert_Conformal(resource):
     """
     Check if grid is organised as Lambert_Conformal
@@ -324,29 +386,3 @@ def eval_timerange(resource, time_range):
         LOGGER.debug('time range reversed! start was later than end ')
     LOGGER.info('time range start and end set')
     return time_range
-
-# # check memory load
-# from os import stat
-#   if memory_limit == None:
-#     f = FreeMemory()
-#     mem_kb = f.user_free
-#     mem_mb = mem_kb / 1024.
-#     mem_limit = mem_mb / 2. # set limit to half of the free memory
-#   else:
-#     mem_limit = memory_limit
-#
-#   if mem_limit >= 1024. * 4:
-#     mem_limit = 1024. * 4
-#     # 475.0 MB for openDAP
-#
-#   #if type(resource) == list :
-#     #data_kb =  stat(resource[0]).st_size * len(resource)
-#   #else:
-#     #data_kb =  stat(resource).st_size
-#   size = ops.get_base_request_size()['total']
-#   data_kb = size['total']/reduce(lambda x,y: x*y,size['variables'][variable]['value']['shape'])
-#   data_mb = data_kb / 1024.
-#
-#   if variable == None:
-#     variable = rd.variable
-#     LOGGER.info('%s as variable dedected' % (variable))
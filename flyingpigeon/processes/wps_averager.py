@@ -88,7 +88,7 @@ class AveragerProcess(Process):
         try:
             opendap_hostnames = [
                 urlparse(r.data).hostname for r in request.inputs['resource']]
-            with CookieNetCDFTransfer(request, opendap_hostnames):
+            with CookieNetCDFTransfer(request, opendap_hostnames, self.workdir):
                 result = wfs_common(request, response, mode='averager')
             return result
         except:
@@ -79,7 +79,7 @@ class AveragerBboxProcess(Process):
         try:
             opendap_hostnames = [
                 urlparse(r.data).hostname for r in request.inputs['resource']]
-            with CookieNetCDFTransfer(request, opendap_hostnames):
+            with CookieNetCDFTransfer(request, opendap_hostnames, self.workdir):
                 result = wfs_common(request, response, mode='averager',
                                     spatial_mode='bbox')
             return result
@@ -8,7 +8,7 @@ from flyingpigeon.utils import rename_complexinputs
 
 from eggshell.log import init_process_logger
 
-from flyingpigeon.utils import search_landsea_mask_by_esgf
+from flyingpigeon.landsea import landsea_mask as search_landsea_mask
 from pywps import ComplexInput, ComplexOutput
 from pywps import Format
 from pywps import LiteralInput
@@ -132,7 +132,7 @@ class LandseamaskProcess(Process):
             if 'mask' in request.inputs:
                 landsea_mask = request.inputs['mask'][0].data
             else:
-                landsea_mask = search_landsea_mask_by_esgf(ds)
+                landsea_mask = search_landsea_mask(ds)
 
             LOGGER.info("using landsea_mask: {}".format(landsea_mask))
             prefix = 'masked_{}'.format(ds_name.replace('.nc', ''))
@@ -6,13 +6,14 @@ Author: David Huard (huard.david@ouranos.ca),
 
 import logging
 import os
+import shutil
 import tempfile
 from datetime import datetime as dt
 
 import netCDF4 as nc
 import ocgis
 from eggshell.log import init_process_logger
-from ocgis import FunctionRegistry, RequestDataset, OcgOperations
+from ocgis import RequestDataset, OcgOperations
 from pywps import ComplexInput, ComplexOutput
 from pywps import Format
 from pywps import LiteralInput
@@ -20,15 +21,15 @@ from pywps import Process
 from pywps.app.Common import Metadata
 from shapely.geometry import Point
 
-from flyingpigeon.ocgisDissimilarity import Dissimilarity, metrics
+from flyingpigeon import config
+from flyingpigeon.ocgisDissimilarity import metrics, neighbor_metrics
 from flyingpigeon.ocgis_module import call
+from flyingpigeon.spatial_analog import tiled_dissimilarity, result_cache, result_key
 from flyingpigeon.utils import archiveextract
 from flyingpigeon.utils import rename_complexinputs
 
 LOGGER = logging.getLogger("PYWPS")
 
-FunctionRegistry.append(Dissimilarity)
-
 
 class SpatialAnalogProcess(Process):
     def __init__(self):
@@ -81,6 +82,29 @@ class SpatialAnalogProcess(Process):
                          allowed_values=metrics,
                          ),
 
+            LiteralInput('eps', "Approximation tolerance",
+                         abstract="Relative tolerance of the nearest neighbour searches used by the "
+                                  "nearest_neighbor and kldiv metrics. Neighbours returned are at most "
+                                  "(1 + eps) times farther than the true nearest neighbours. Larger "
+                                  "values speed up the computation at the expense of accuracy. "
+                                  "Defaults to 0 (exact search).",
+                         data_type='float',
+                         min_occurs=0,
+                         max_occurs=1,
+                         default=0,
+                         ),
+
+            LiteralInput('screen', "Screened candidates",
+                         abstract="Two-stage search. All candidate cells are first ranked using the "
+                                  "cheap seuclidean metric, and the selected distance is then only "
+                                  "computed over the given number of most similar cells. Other cells "
+                                  "are set to NaN. Defaults to 0, computing the distance over all cells.",
+                         data_type='integer',
+                         min_occurs=0,
+                         max_occurs=1,
+                         default=0,
+                         ),
+
             LiteralInput('dateStartCandidate', 'Candidate start date',
                          abstract="Beginning of period (YYYY-MM-DD) for candidate data. "
                                   "Defaults to first entry.",
@@ -175,10 +199,13 @@ class SpatialAnalogProcess(Process):
             location = request.inputs['location'][0].data
             indices = [el.data for el in request.inputs['indices']]
             dist = request.inputs['dist'][0].data
+            eps = float(request.inputs['eps'][0].data)
+            screen = int(request.inputs['screen'][0].data)
             dateStartCandidate = request.inputs['dateStartCandidate'][0].data
             dateEndCandidate = request.inputs['dateEndCandidate'][0].data
             dateStartTarget = request.inputs['dateStartTarget'][0].data
             dateEndTarget = request.inputs['dateEndTarget'][0].data
+            sources = [getattr(el, 'url', None) or el.file for el in request.inputs['candidate']]
 
         except Exception as ex:
             msg = 'Failed to read input parameter {}'.format(ex)
@@ -198,6 +225,14 @@ class SpatialAnalogProcess(Process):
             dateStartTarget = dt.strptime(dateStartTarget, '%Y-%m-%d')
             dateEndTarget = dt.strptime(dateEndTarget, '%Y-%m-%d')
 
+            # Options of the dissimilarity calculation. The nearest neighbour
+            # search options are ignored by other metrics.
+            kwds = {}
+            if dist in neighbor_metrics:
+                kwds.update(eps=eps, n_jobs=config.spatial_analog_n_jobs())
+            if screen > 0:
+                kwds['screen'] = screen
+
         except Exception as ex:
             msg = 'failed to process inputs {}'.format(ex)
             LOGGER.error(msg)
@@ -238,18 +273,56 @@ class SpatialAnalogProcess(Process):
 
         response.update_status('Extracted target series', 5)
 
+        ######################################
+        # Look for a cached result
+        ######################################
+        cache = None
+        if config.spatial_analog_cache_size() > 0:
+            try:
+                cache = result_cache()
+                key = result_key(target_ts, sources, indices, dist,
+                                 [dateStartCandidate, dateEndCandidate],
+                                 [dateStartTarget, dateEndTarget],
+                                 eps=kwds.get('eps'), screen=screen)
+                cached = cache.get(key)
+            except Exception as ex:
+                LOGGER.exception('Spatial analog cache lookup failed: {}'.format(ex))
+                cache, cached = None, None
+
         ######################################
         # Compute dissimilarity metric
         ######################################
 
         response.update_status('Computing spatial analog', 6)
+        workers = config.spatial_analog_workers()
+        # The memory budget is shared by the workers.
+        kwds['max_memory'] = config.spatial_analog_max_memory() * 1024 ** 2 // max(workers, 1)
+        output = None
+        if cache is not None and cached is not None:
+            try:
+                output = os.path.join(ocgis.env.DIR_OUTPUT, os.path.basename(cached))
+                shutil.copyfile(cached, output)
+            except (IOError, OSError) as ex:
+                # The entry was evicted since the lookup, compute it again.
+                LOGGER.warning('Failed to copy cached spatial analog: {}'.format(ex))
+                output, cached = None, None
         try:
-            output = call(resource=candidate,
-                          calc=[{'func': 'dissimilarity', 'name': 'spatial_analog',
-                                 'kwds': {'dist': dist, 'target': target_ts,
-                                          'candidate': indices}}],
-                          time_range=[dateStartCandidate, dateEndCandidate],
-                          )
+            if output is not None:
+                LOGGER.info('Spatial analog read from cache')
+            elif workers > 1:
+                output = tiled_dissimilarity(candidate, target_ts, indices, dist,
+                                             time_range=[dateStartCandidate, dateEndCandidate],
+                                             workers=workers,
+                                             tile_size=config.spatial_analog_tile_size(),
+                                             dir_output=ocgis.env.DIR_OUTPUT,
+                                             **kwds)
+            else:
+                output = call(resource=candidate,
+                              calc=[{'func': 'dissimilarity', 'name': 'spatial_analog',
+                                     'kwds': dict(kwds, dist=dist, target=target_ts,
+                                                  candidate=indices)}],
+                              time_range=[dateStartCandidate, dateEndCandidate],
+                              )
 
         except Exception as ex:
             msg = 'Spatial analog failed: {}'.format(ex)
@@ -258,6 +331,8 @@ class SpatialAnalogProcess(Process):
 
         add_metadata(output,
                      dist=dist,
+                     eps=eps,
+                     screen=screen,
                      indices=",".join(indices),
                      target_location=location,
                      candidate_time_range="{},{}".format(dateStartCandidate,
@@ -266,6 +341,12 @@ class SpatialAnalogProcess(Process):
                                                       dateEndTarget)
                      )
 
+        if cache is not None and cached is None:
+            try:
+                cache.put(key, output)
+            except Exception as ex:
+                LOGGER.exception('Failed to store spatial analog in cache: {}'.format(ex))
+
         response.update_status('Computed spatial analog', 95)
 
         response.outputs['output_netcdf'].file = output
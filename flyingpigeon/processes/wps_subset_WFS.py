@@ -73,7 +73,7 @@ class SubsetWFSProcess(Process):
         try:
             opendap_hostnames = [
                 urlparse(r.data).hostname for r in request.inputs['resource']]
-            with CookieNetCDFTransfer(request, opendap_hostnames):
+            with CookieNetCDFTransfer(request, opendap_hostnames, self.workdir):
                 result = wfs_common(request, response, mode='subsetter')
             return result
         except Exception as ex:
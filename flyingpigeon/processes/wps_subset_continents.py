@@ -10,7 +10,8 @@ from pywps import Process
 from pywps.app.Common import Metadata
 
 
-from flyingpigeon.subset import _CONTINENTS_
+from flyingpigeon import config
+from flyingpigeon.subset import continents
 from flyingpigeon.subset import clipping
 from flyingpigeon.utils import archive, archiveextract
 from flyingpigeon.utils import rename_complexinputs
@@ -30,9 +31,9 @@ class ClipcontinentProcess(Process):
                          data_type='string',
                          abstract="Continent name.",
                          min_occurs=1,
-                         max_occurs=len(_CONTINENTS_),
+                         max_occurs=len(continents()),
                          default='Africa',
-                         allowed_values=_CONTINENTS_),  # REGION_EUROPE #COUNTRIES
+                         allowed_values=continents()),  # REGION_EUROPE #COUNTRIES
 
             LiteralInput('mosaic', 'Union of multiple regions',
                          data_type='boolean',
@@ -122,6 +123,8 @@ class ClipcontinentProcess(Process):
                 polygons=regions,  # self.region.getValue(),
                 mosaic=mosaic,
                 spatial_wrapping='wrap',
+                processes=config.clipping_processes(),
+                single_read=True,
                 # variable=variable,
                 # dir_output=os.path.abspath(os.curdir),
                 # dimension_map=dimension_map,
@@ -3,6 +3,7 @@ from eggshell.log import init_process_logger
 import logging
 
 from flyingpigeon.log import init_process_logger
+from flyingpigeon import config
 from flyingpigeon.subset import clipping
 from flyingpigeon.subset import countries
 from flyingpigeon.utils import archive, archiveextract
@@ -123,6 +124,8 @@ class ClippingProcess(Process):
                 polygons=regions,  # self.region.getValue(),
                 mosaic=mosaic,
                 spatial_wrapping='wrap',
+                processes=config.clipping_processes(),
+                single_read=True,
                 # variable=variable,
                 # dir_output=os.path.abspath(os.curdir),
                 # dimension_map=dimension_map,
@@ -10,7 +10,8 @@ from pywps.app.Common import Metadata
 
 from flyingpigeon.log import init_process_logger
 # from flyingpigeon.subset import countries, countries_longname
-from flyingpigeon.subset import _EUREGIONS_
+from flyingpigeon import config
+from flyingpigeon.subset import eu_regions
 from flyingpigeon.subset import clipping
 from flyingpigeon.utils import archive, archiveextract
 from flyingpigeon.utils import rename_complexinputs
@@ -31,9 +32,9 @@ class ClipregionseuropeProcess(Process):
                          abstract="European region code, see ISO-3166 Alpha2: https://en.wikipedia.org/wiki/ISO_3166-2 ",
                          # noqa
                          min_occurs=1,
-                         max_occurs=len(_EUREGIONS_),
+                         max_occurs=len(eu_regions()),
                          default='DE.HH',
-                         allowed_values=_EUREGIONS_),
+                         allowed_values=list(eu_regions())),
 
             LiteralInput('mosaic', 'Union of multiple regions',
                          data_type='boolean',
@@ -122,6 +123,8 @@ class ClipregionseuropeProcess(Process):
                 polygons=regions,  # self.region.getValue(),
                 mosaic=mosaic,
                 spatial_wrapping='wrap',
+                processes=config.clipping_processes(),
+                single_read=True,
                 # variable=variable,
                 # dir_output=os.path.abspath(os.curdir),
                 # dimension_map=dimension_map,
@@ -0,0 +1,300 @@
+"""
+Regridding with cached interpolation weights.
+
+Interpolation weights are generated once per (source grid, destination grid,
+method) with the cdo `gen*` operators and stored in a file cache. They are
+then applied in memory as a sparse matrix, so regridding a series of files
+sharing the same grid only reads and writes each file once.
+
+Destination cells partly covered by masked source cells get the average of
+the valid source cells, with renormalized weights, so their values differ
+from the output of `cdo remap`.
+"""
+
+import logging
+import os
+import tempfile
+import uuid
+
+import netCDF4 as nc
+import numpy as np
+from scipy import sparse
+
+from flyingpigeon import config
+from flyingpigeon.cache import FileCache, file_signature, make_key
+
+LOGGER = logging.getLogger("PYWPS")
+
+# cdo operators generating the weights of each regridding method.
+METHODS = {'bil': 'genbil',  # Bilinear interpolation
+           'bic': 'genbic',  # Bicubic interpolation
+           'dis': 'gendis',  # Distance-weighted average remapping
+           'nn': 'gennn',  # Nearest neighbour
+           'con': 'gencon',  # First-order conservative remapping
+           'laf': 'genlaf',  # Largest area fraction remapping
+           }
+
+# Methods whose weights include gradient terms, which only cdo applies.
+_CDO_METHODS = ['bic']
+
+# Standard names of the coordinates identifying a grid.
+_GRID_STANDARD_NAMES = ['latitude', 'longitude', 'grid_latitude', 'grid_longitude',
+                        'projection_x_coordinate', 'projection_y_coordinate']
+
+# Maximum size in bytes of the values regridded at once.
+_MAX_MEMORY = 2 ** 26
+
+# Last weights read in this process, keyed by file signature.
+_WEIGHTS = {}
+
+
+def weights_cache():
+    """Return the cache storing the regridding weights."""
+    return FileCache('regrid', config.regrid_cache_size() * 1024 ** 2)
+
+
+def grid_key(resource, destination, method):
+    """
+    Return a key identifying the source grid, the destination grid and the method.
+
+    The source grid is identified by the values of its coordinates, so that
+    files sharing the same grid share the same weights.
+
+    :param resource: netCDF file on the source grid
+    :param destination: netCDF file or cdo grid description of the destination grid
+    :param method: regridding method, one of `METHODS`
+
+    :return str: cache key
+    """
+    parts = [method]
+    with nc.Dataset(resource) as ds:
+        for name in sorted(ds.variables):
+            var = ds.variables[name]
+            if getattr(var, 'standard_name', None) in _GRID_STANDARD_NAMES:
+                parts.extend([name, var[:]])
+
+    if os.path.isfile(destination):
+        parts.append(file_signature(destination))
+    else:
+        parts.append(destination)
+    return make_key(*parts)
+
+
+def get_weights(resource, destination, method='bil'):
+    """
+    Return the path to the weights regridding the grid of a file onto the destination grid.
+
+    The weights are generated with cdo if they are not in the cache yet.
+
+    :param resource: netCDF file on the source grid
+    :param destination: netCDF file or cdo grid description of the destination grid
+    :param method: regridding method, one of `METHODS`
+
+    :return str: path to the SCRIP weights file
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown regridding method {}. Options are {}'.format(method, sorted(METHODS)))
+
+    cache = weights_cache()
+    key = grid_key(resource, destination, method)
+    path = cache.get(key)
+    if path is not None:
+        return path
+
+    from cdo import Cdo
+    cdo = Cdo()
+    fd, tmp = tempfile.mkstemp(suffix='.nc')
+    os.close(fd)
+    try:
+        LOGGER.info('Generating {} regridding weights to {}'.format(method, destination))
+        getattr(cdo, METHODS[method])(destination, input=resource, output=tmp)
+        return cache.put(key, tmp)
+    finally:
+        os.remove(tmp)
+
+
+def read_weights(path):
+    """
+    Read a SCRIP weights file.
+
+    :param path: path to the weights file
+
+    :return dict: `matrix`, the sparse (destination, source) weights matrix, `src_shape` and
+                  `dst_shape`, the (rows, columns) shapes of the grids, and `lat`, `lon`, the
+                  destination cell centers in degrees.
+    """
+    sig = file_signature(path)
+    if sig in _WEIGHTS:
+        return _WEIGHTS[sig]
+
+    with nc.Dataset(path) as ds:
+        v = ds.variables
+        src_shape = tuple(v['src_grid_dims'][::-1])
+        dst_shape = tuple(v['dst_grid_dims'][::-1])
+        wts = v['remap_matrix'][:]
+        if wts.ndim > 1 and wts.shape[1] > 1:
+            raise ValueError('Weights with gradient terms can only be applied with cdo.')
+
+        # Addresses are 1-based.
+        matrix = sparse.csr_matrix((np.asarray(wts).ravel(),
+                                    (v['dst_address'][:] - 1, v['src_address'][:] - 1)),
+                                   shape=(np.prod(dst_shape), np.prod(src_shape)))
+
+        coords = []
+        for name in ['dst_grid_center_lat', 'dst_grid_center_lon']:
+            values = np.asarray(v[name][:], dtype=float).reshape(dst_shape)
+            if 'rad' in getattr(v[name], 'units', 'radians'):
+                values = np.degrees(values)
+            coords.append(values)
+
+    _WEIGHTS.clear()
+    _WEIGHTS[sig] = dict(matrix=matrix, src_shape=src_shape, dst_shape=dst_shape,
+                         lat=coords[0], lon=coords[1])
+    return _WEIGHTS[sig]
+
+
+def apply_weights(values, matrix, dst_shape):
+    """
+    Regrid an array using a weights matrix.
+
+    Masked values are excluded and the weights of the remaining source cells
+    are renormalized. Destination cells without valid source cells are masked.
+
+    :param values: array (..., rows, columns) on the source grid
+    :param matrix: sparse (destination, source) weights matrix
+    :param dst_shape: (rows, columns) shape of the destination grid
+
+    :return masked array: array (..., rows, columns) on the destination grid
+    """
+    lead = values.shape[:-2]
+    values = np.ma.masked_invalid(values).reshape(-1, matrix.shape[1])
+    valid = ~np.ma.getmaskarray(values)
+
+    # Weights matrix products operate on (source, n) arrays.
+    data = matrix.dot(np.where(valid, values.data, 0).T)
+    norm = matrix.dot(valid.T.astype(float))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = np.ma.masked_where(norm <= 0, data / norm)
+
+    return out.T.reshape(lead + tuple(dst_shape))
+
+
+def remap(resource, weights, output):
+    """
+    Regrid all the variables of a file defined on the source grid using a weights file.
+
+    Variables whose last two dimensions are the source grid dimensions are
+    regridded, other variables depending on the source grid dimensions are
+    dropped, and the remaining variables are copied. The destination grid
+    coordinates are written as `lat` and `lon`.
+
+    :param resource: netCDF file on the source grid
+    :param weights: SCRIP weights file
+    :param output: output netCDF file path
+
+    :return str: output netCDF file path
+    """
+    w = read_weights(weights)
+    ny, nx = w['dst_shape']
+    lat, lon = w['lat'], w['lon']
+
+    # Rectilinear destination grids get one-dimensional coordinates.
+    rectilinear = np.allclose(lat, lat[:, :1]) and np.allclose(lon, lon[:1])
+    dst_dims = ('lat', 'lon') if rectilinear else ('y', 'x')
+
+    with nc.Dataset(resource) as src, nc.Dataset(output, 'w', format=src.data_model) as dst:
+        src_dims = _grid_dimensions(src, w['src_shape'])
+
+        dst.setncatts(dict((k, src.getncattr(k)) for k in src.ncattrs()))
+        for name, dim in src.dimensions.items():
+            if name not in src_dims:
+                dst.createDimension(name, None if dim.isunlimited() else len(dim))
+        dst.createDimension(dst_dims[0], ny)
+        dst.createDimension(dst_dims[1], nx)
+
+        if rectilinear:
+            _write_coordinate(dst, 'lat', ('lat',), lat[:, 0], 'latitude', 'degrees_north')
+            _write_coordinate(dst, 'lon', ('lon',), lon[0], 'longitude', 'degrees_east')
+        else:
+            _write_coordinate(dst, 'lat', dst_dims, lat, 'latitude', 'degrees_north')
+            _write_coordinate(dst, 'lon', dst_dims, lon, 'longitude', 'degrees_east')
+
+        for name, var in src.variables.items():
+            if name in dst.variables:
+                continue
+
+            gridded = var.dimensions[-2:] == src_dims
+            if not gridded and set(var.dimensions) & set(src_dims):
+                continue
+
+            dims = var.dimensions[:-2] + dst_dims if gridded else var.dimensions
+            dtype = 'f8' if gridded and var.dtype.kind != 'f' else var.dtype
+            fill_value = getattr(var, '_FillValue', 1e20 if gridded else None)
+            out = dst.createVariable(name, dtype, dims, fill_value=fill_value,
+                                     zlib=src.data_model.startswith('NETCDF4'))
+            attrs = dict((k, var.getncattr(k)) for k in var.ncattrs() if k != '_FillValue')
+            if gridded:
+                attrs.pop('grid_mapping', None)
+                attrs['coordinates'] = 'lat lon'
+            out.setncatts(attrs)
+
+            if not gridded:
+                out[:] = var[:]
+                continue
+
+            # Regrid blocks along the first dimension to bound memory.
+            if var.ndim == 2:
+                out[:] = apply_weights(var[:], w['matrix'], (ny, nx))
+            else:
+                step = int(max(1, _MAX_MEMORY // (32 * np.prod(var.shape[1:]))))
+                for i in range(0, var.shape[0], step):
+                    block = apply_weights(var[i:i + step], w['matrix'], (ny, nx))
+                    out[i:i + block.shape[0]] = block
+
+    return output
+
+
+def regrid(resource, destination, method='bil', output=None, dir_output=None):
+    """
+    Regrid a netCDF file onto a destination grid.
+
+    :param resource: netCDF file on the source grid
+    :param destination: netCDF file or cdo grid description (e.g. 'r360x180') of the destination grid
+    :param method: regridding method, one of `METHODS`:
+                   'bil' = Bilinear interpolation
+                   'bic' = Bicubic interpolation
+                   'dis' = Distance-weighted average remapping
+                   'nn' = nearest neighbour
+                   'con' = First-order conservative remapping
+                   'laf' = largest area fraction reamapping
+    :param output: output file path, defaults to a unique name in `dir_output`
+    :param dir_output: output directory (default: current directory)
+
+    :return str: output netCDF file path
+    """
+    if output is None:
+        if dir_output is None:
+            dir_output = os.path.abspath(os.curdir)
+        output = os.path.join(dir_output, '{}.nc'.format(uuid.uuid1()))
+
+    weights = get_weights(resource, destination, method)
+    if method in _CDO_METHODS:
+        from cdo import Cdo
+        LOGGER.info('Applying {} regridding weights with cdo'.format(method))
+        return Cdo().remap('{},{}'.format(destination, weights), input=resource, output=output)
+    return remap(resource, weights, output)
+
+
+def _grid_dimensions(ds, shape):
+    """Return the names of the (rows, columns) dimensions of a grid of the given shape."""
+    for var in ds.variables.values():
+        dims = var.dimensions[-2:]
+        if len(dims) == 2 and var.shape[-2:] == tuple(shape) and var.ndim > 2:
+            return dims
+    raise ValueError('No variable defined on a {} grid.'.format(shape))
+
+
+def _write_coordinate(ds, name, dims, values, standard_name, units):
+    var = ds.createVariable(name, 'f8', dims)
+    var.setncatts({'standard_name': standard_name, 'long_name': standard_name, 'units': units})
+    var[:] = values
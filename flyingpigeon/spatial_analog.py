@@ -0,0 +1,246 @@
+"""
+Spatial analog computations over the candidate grid.
+
+The serial computation runs the `dissimilarity` ocgis calculation over the
+whole candidate dataset at once. The tiled computation splits the candidate
+grid into spatial tiles, computes each tile in a process pool and stitches
+the results back into a single netCDF file.
+
+Results are cached, keyed by the target values, the candidate datasets and
+the computation parameters.
+"""
+
+import logging
+import os
+import uuid
+from multiprocessing import Pool
+
+import netCDF4 as nc
+import numpy as np
+from ocgis import FunctionRegistry, OcgOperations, RequestDataset
+
+from flyingpigeon import config
+from flyingpigeon import dissimilarity as dd
+from flyingpigeon.cache import FileCache, make_key, source_signature
+from flyingpigeon.ocgisDissimilarity import Dissimilarity
+
+LOGGER = logging.getLogger("PYWPS")
+
+FunctionRegistry.append(Dissimilarity)
+
+# Target field shared with the pool workers.
+_TARGET = None
+
+
+def result_cache():
+    """Return the cache storing spatial analog results."""
+    return FileCache('spatial_analog', config.spatial_analog_cache_size() * 1024 ** 2)
+
+
+def result_key(target, sources, indices, dist, candidate_range, target_range, **kwds):
+    """
+    Return the cache key of a spatial analog computation.
+
+    :param target: ocgis Field storing the target indices
+    :param sources: paths or URLs of the candidate datasets
+    :param indices: list of indices used in the comparison
+    :param dist: name of the dissimilarity metric
+    :param candidate_range: [start, end] of the candidate period
+    :param target_range: [start, end] of the target period
+    :param kwds: other options of the dissimilarity calculation
+
+    :return str: cache key
+    """
+    values = [np.ma.filled(np.ma.asarray(target[c].get_value(), dtype=float), np.nan) for c in indices]
+    return make_key(sorted(source_signature(s) for s in sources), list(indices), dist,
+                    [str(t) for t in candidate_range], [str(t) for t in target_range],
+                    sorted(kwds.items()), *values)
+
+
+def get_tiles(shape, tile_size):
+    """
+    Split a grid into square tiles.
+
+    :param shape: (rows, columns) shape of the grid
+    :param tile_size: number of rows and columns in a tile
+
+    :return list: [[row_start, row_stop], [col_start, col_stop]] for each tile
+    """
+    nrow, ncol = shape
+    tiles = []
+    for r in range(0, nrow, tile_size):
+        for c in range(0, ncol, tile_size):
+            tiles.append([[r, min(r + tile_size, nrow)],
+                          [c, min(c + tile_size, ncol)]])
+    return tiles
+
+
+def _init_worker(target):
+    global _TARGET
+    _TARGET = target
+
+
+def _dissimilarity_tile(args):
+    """Compute the dissimilarity over one tile of the candidate grid.
+
+    :param args: (candidate, indices, dist, time_range, kwds, tile)
+
+    :return ndarray: dissimilarity values over the tile, NaN where masked
+    """
+    candidate, indices, dist, time_range, kwds, (rows, cols) = args
+
+    rd = RequestDataset(candidate, variable=indices, time_range=time_range)
+    ops = OcgOperations(dataset=rd,
+                        calc=[{'func': 'dissimilarity', 'name': 'spatial_analog',
+                               'kwds': dict(kwds, dist=dist, target=_TARGET,
+                                            candidate=indices)}],
+                        slice=[None, None, None, rows, cols],
+                        output_format='numpy')
+    field = ops.execute().get_element()
+    return np.ma.filled(field['dissimilarity'].get_masked_value(), np.nan)
+
+
+def tiled_dissimilarity(candidate, target, indices, dist, time_range,
+                        workers, tile_size=50, dir_output=None, **kwds):
+    """
+    Compute the dissimilarity over the candidate grid using a process pool
+    working on spatial tiles.
+
+    :param candidate: list of candidate netCDF files
+    :param target: ocgis Field storing the target indices
+    :param indices: list of indices used in the comparison
+    :param dist: name of the dissimilarity metric
+    :param time_range: [start, end] of the candidate period
+    :param workers: number of processes in the pool
+    :param tile_size: number of rows and columns in a tile
+    :param dir_output: output directory (default: current directory)
+    :param kwds: other options of the dissimilarity calculation
+
+    :return str: path to the netCDF file storing the dissimilarity
+    """
+    if type(candidate) != list:
+        candidate = [candidate]
+    if dir_output is None:
+        dir_output = os.path.abspath(os.curdir)
+
+    with nc.Dataset(candidate[0]) as ds:
+        shape = ds.variables[indices[0]].shape
+        get_time_dimension(ds, indices[0])
+
+    # The time dimension is the first one, the grid dimensions the last two.
+    tiles = get_tiles(shape[-2:], tile_size)
+    LOGGER.info('Spatial analog computed over {} tiles with {} workers'.format(len(tiles), workers))
+
+    pool = Pool(processes=workers, initializer=_init_worker, initargs=(target,))
+    try:
+        # Tiles are screened independently, so the number of cells kept over
+        # the whole grid is applied to the stitched screening score.
+        screen = kwds.pop('screen', 0)
+        if screen and dist != 'seuclidean':
+            opts = {'max_memory': kwds['max_memory']} if 'max_memory' in kwds else {}
+            score = _map_tiles(pool, shape, tiles, (candidate, indices, 'seuclidean', time_range, opts))
+            keep = dd.select_candidates(score, size=screen, threshold=kwds.get('screen_threshold'))
+            kwds['screen_threshold'] = float(score[keep].max()) if keep.any() else -np.inf
+
+        values = _map_tiles(pool, shape, tiles, (candidate, indices, dist, time_range, kwds))
+    finally:
+        pool.close()
+        pool.join()
+
+    if screen and dist == 'seuclidean':
+        # The metric is its own screening score.
+        values[~dd.select_candidates(values, size=screen, threshold=kwds.get('screen_threshold'))] = np.nan
+
+    output = os.path.join(dir_output, '{}.nc'.format(uuid.uuid1()))
+    write_dissimilarity(output, candidate[0], indices[0], values, time_range)
+    return output
+
+
+def _map_tiles(pool, shape, tiles, args):
+    """Compute the dissimilarity over all tiles in the pool and stitch the results together."""
+    results = pool.map(_dissimilarity_tile, [args + (tile,) for tile in tiles])
+    values = np.empty(shape[1:])
+    for (rows, cols), result in zip(tiles, results):
+        values[..., rows[0]:rows[1], cols[0]:cols[1]] = result
+    return values
+
+
+def get_time_dimension(ds, variable):
+    """
+    Return the name of the time dimension of a candidate variable.
+
+    :param ds: candidate netCDF Dataset
+    :param variable: name of the candidate variable
+
+    :return str: name of the time dimension, which must be the first dimension of the variable
+    """
+    dims = ds.variables[variable].dimensions
+    for name in dims:
+        coord = ds.variables.get(name)
+        if coord is not None and (getattr(coord, 'axis', None) == 'T' or
+                                  getattr(coord, 'standard_name', None) == 'time' or
+                                  ' since ' in getattr(coord, 'units', '')):
+            break
+    else:
+        raise ValueError('No time dimension found for {} {}'.format(variable, dims))
+
+    if name != dims[0]:
+        raise ValueError('The time dimension {} of {} must be the first one {}'.format(name, variable, dims))
+    return name
+
+
+def write_dissimilarity(path, template, variable, values, time_range):
+    """
+    Write the dissimilarity values on the grid of a candidate file, using the
+    same layout as the ocgis `dissimilarity` calculation output.
+
+    :param path: output netCDF file path
+    :param template: candidate netCDF file providing the grid
+    :param variable: name of a candidate variable defined on the grid
+    :param values: dissimilarity values, with the candidate variable shape minus time
+    :param time_range: [start, end] of the candidate period
+    """
+    with nc.Dataset(template) as src:
+        time_dim = get_time_dimension(src, variable)
+
+    with nc.Dataset(template) as src, nc.Dataset(path, 'w') as dst:
+        var = src.variables[variable]
+        time = src.variables[time_dim]
+        units = time.units
+        calendar = getattr(time, 'calendar', 'standard')
+
+        for name, dim in src.dimensions.items():
+            if name != time_dim:
+                dst.createDimension(name, len(dim))
+        dst.createDimension(time_dim, 1)
+        if 'bounds' not in dst.dimensions:
+            dst.createDimension('bounds', 2)
+
+        # Copy the grid coordinates, bounds and mapping.
+        for name, v in src.variables.items():
+            if time_dim in v.dimensions or name == time_dim:
+                continue
+            out = dst.createVariable(name, v.dtype, v.dimensions)
+            out.setncatts(dict((k, v.getncattr(k)) for k in v.ncattrs() if k != '_FillValue'))
+            out[:] = v[:]
+
+        # Climatology time covering the candidate period.
+        if time_range is None:
+            bnds = [time[0], time[-1]]
+        else:
+            bnds = nc.date2num(list(time_range), units, calendar)
+        t = dst.createVariable(time_dim, 'f8', (time_dim,))
+        t.setncatts({'units': units, 'calendar': calendar, 'axis': 'T',
+                     'climatology': 'climatology_bounds'})
+        t[:] = np.mean(bnds)
+        cb = dst.createVariable('climatology_bounds', 'f8', (time_dim, 'bounds'))
+        cb.setncatts({'units': units, 'calendar': calendar})
+        cb[:] = [bnds]
+
+        out = dst.createVariable('dissimilarity', 'f4', var.dimensions[1:])
+        out.standard_name = Dissimilarity.standard_name
+        out.long_name = Dissimilarity.long_name
+        out.units = ''
+        if 'grid_mapping' in var.ncattrs():
+            out.grid_mapping = var.grid_mapping
+        out[:] = np.ma.masked_invalid(values)
@@ -1,22 +1,45 @@
-from cdo import Cdo
+from multiprocessing import Pool
 from tempfile import mkstemp
+import json
 import os
+import traceback
+
+from netCDF4 import Dataset
+import numpy as np
 
 from flyingpigeon import config
+from flyingpigeon.cache import source_signature
 
-from flyingpigeon.ocgis_module import call
+from flyingpigeon.ocgis_module import call, get_ops_options, request_dataset
 from flyingpigeon.utils import sort_by_filename, get_variable
 
 
 import logging
 LOGGER = logging.getLogger("PYWPS")
 
+# Attribute tables of the shapefiles read in this process.
+_SHP_INDEX = {}
+
+# Shapefiles of the shape cabinet and the attribute column naming their
+# polygons, in the order polygon names are looked up.
+_GEOM_COLUMNS = [('countries', 'ADM0_A3'), ('extremoscope', 'HASC_1'), ('continents', 'CONTINENT')]
+
+# Polygon name to UGID dictionaries of the shapefiles, built in this process.
+_UGID_LOOKUP = {}
+
+# Land/sea masks computed in this process, keyed by land area fraction file signature,
+# threshold and land area flag.
+_LANDSEA_MASKS = {}
+
+# Maximum size in bytes of the values masked at once.
+_MAX_MEMORY = 2 ** 26
+
 
 def countries():
     """
     :return: a list of all country codes.
     """
-    countries = _COUNTRIES_.keys()
+    countries = list(_countries_().keys())
     # countries = ['DEU', 'FRA', 'GBR', 'ESP', 'ITA']
     countries.sort()
     return countries
@@ -27,15 +50,82 @@ def countries_longname():
     :return: the long name of all countries.
     """
     longname = ''
+    names = _countries_()
     for country in countries():
-        longname = longname + "%s : %s \n" % (country, _COUNTRIES_[country]['longname'])
+        longname = longname + "%s : %s \n" % (country, names[country]['longname'])
     return longname
 
 
+def continents():
+    """
+    :return: a list of all continent names.
+    """
+    return get_shp_column_values(geom='continents', columnname='CONTINENT')
+
+
+def eu_regions():
+    """
+    :return: a dictionary of the European regions, keyed by their HASC code.
+    """
+    index = get_shp_index('extremoscope')
+    return dict((key, dict(longname=name)) for key, name in zip(index['HASC_1'], index['NAME_1']))
+
+
+def _countries_():
+    """
+    :return: a dictionary of the countries, keyed by their ADM0_A3 code.
+    """
+    index = get_shp_index('countries')
+    return dict((key, dict(longname=name)) for key, name in zip(index['ADM0_A3'], index['NAME_LONG']))
+
+
+def get_landsea_mask(sftlf, threshold=50, land_area=True):
+    """
+    Return the grid cells kept by a land/sea mask.
+
+    The mask is computed once per land area fraction file and threshold, then
+    kept in memory.
+
+    :param sftlf: land_area fraction netCDF file
+    :param threshold: Percentage of land area
+    :param land_area: If True (default), land areas are kept, otherwise sea areas
+
+    :returns array: boolean (rows, columns) array, True where values are kept
+    """
+    key = (source_signature(sftlf), threshold, land_area)
+    if key not in _LANDSEA_MASKS:
+        #######################
+        # TODO check sftlf unit
+        #######################
+        th = threshold / 100.0
+        with Dataset(sftlf) as ds:
+            if 'sftlf' in ds.variables:
+                var = ds.variables['sftlf']
+            else:
+                var = [v for v in ds.variables.values() if v.ndim >= 2][0]
+            fraction = np.ma.masked_invalid(var[:]).squeeze()
+        if fraction.ndim != 2:
+            raise ValueError('Land area fraction of {} is not defined on a grid.'.format(sftlf))
+
+        if land_area is True:
+            mask = fraction > th
+        else:
+            # TODO: check the operator ltc/stc
+            mask = fraction < th
+
+        if len(_LANDSEA_MASKS) >= 8:
+            _LANDSEA_MASKS.clear()
+        _LANDSEA_MASKS[key] = np.ma.filled(mask, False)
+    return _LANDSEA_MASKS[key]
+
+
 def masking(resource, sftlf, threshold=50, land_area=True, prefix=None):
     """
     Set land/sea areas to nan.
 
+    Variables defined on the grid of the mask are masked time step block by
+    time step block while the file is copied, other variables are copied as is.
+
     :param resource: string path to netCDF resource
     :param sftlf: land_area fraction netCDF file
     :param threshold: Percentage of land area
@@ -44,30 +134,56 @@ def masking(resource, sftlf, threshold=50, land_area=True, prefix=None):
 
     :returns str: path to netCDF file
     """
-    cdo = Cdo()
-    #######################
-    # TODO check sftlf unit
-    #######################
-    th = threshold / 100.0
-
-    ###################
-    # generate the mask
-    if land_area is True:
-        mask = cdo.gtc(th, input=sftlf, output='mask.nc')
-    else:
-        # TODO: check the operator ltc/stc
-        mask = cdo.ltc(th, input=sftlf, output='mask.nc')
+    mask = get_landsea_mask(sftlf, threshold=threshold, land_area=land_area)
 
     # generate output filename
     if prefix is not None:
         nc_masked = prefix + '.nc'
     else:
-        _, nc_masked = mkstemp(dir='.', suffix='.nc')
-
-    #################
-    # divide by mask
-
-    _ = cdo.div(input=[resource, mask], output=nc_masked)
+        fd, nc_masked = mkstemp(dir='.', suffix='.nc')
+        os.close(fd)
+
+    with Dataset(resource) as src, Dataset(nc_masked, 'w', format=src.data_model) as dst:
+        # Coordinates, bounds and dimension variables are never masked.
+        coordinates = set(src.dimensions)
+        for var in src.variables.values():
+            coordinates.update(getattr(var, 'coordinates', '').split())
+            coordinates.update(getattr(var, 'bounds', '').split())
+
+        dst.setncatts(dict((k, src.getncattr(k)) for k in src.ncattrs()))
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+
+        masked = []
+        for name, var in src.variables.items():
+            gridded = name not in coordinates and var.ndim >= 2 and var.shape[-2:] == mask.shape
+            dtype = 'f4' if gridded and var.dtype.kind != 'f' else var.dtype
+            fill_value = getattr(var, '_FillValue', 1e20 if gridded else None)
+            out = dst.createVariable(name, dtype, var.dimensions, fill_value=fill_value,
+                                     zlib=src.data_model.startswith('NETCDF4'))
+            out.setncatts(dict((k, var.getncattr(k)) for k in var.ncattrs() if k != '_FillValue'))
+            if gridded:
+                masked.append(name)
+
+        if masked:
+            LOGGER.info('masking variables {} with {}'.format(masked, sftlf))
+        else:
+            raise ValueError('No variable of {} is defined on the grid of {}.'.format(resource, sftlf))
+
+        for name, var in src.variables.items():
+            out = dst.variables[name]
+            if var.ndim < 3:
+                values = var[:]
+                out[:] = np.ma.masked_where(~mask, values) if name in masked else values
+                continue
+
+            # Copy blocks along the first dimension to bound memory.
+            step = int(max(1, _MAX_MEMORY // (var.dtype.itemsize * np.prod(var.shape[1:]))))
+            for i in range(0, var.shape[0], step):
+                block = var[i:i + step]
+                if name in masked:
+                    block = np.ma.masked_where(np.broadcast_to(~mask, block.shape), block)
+                out[i:i + block.shape[0]] = block
 
     return nc_masked
 
@@ -76,7 +192,7 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
              calc_grouping=None, time_range=None, time_region=None,
              historical_concatination=True, prefix=None,
              spatial_wrapping='wrap', polygons=None, mosaic=False,
-             dir_output=None, memory_limit=None):
+             dir_output=None, memory_limit=None, processes=1, single_read=False):
     """ returns list of clipped netCDF files
 
     :param resource: list of input netCDF files
@@ -87,13 +203,17 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
     :param historical_concatination: concat files of RCPs with appropriate historical runs into one timeseries
     :param prefix: prefix for output file name
     :param polygons: list of polygons to be used. If more than 1 in the list, an appropriate mosaic will be clipped
-    :param mosaic: Whether the polygons are aggregated into a single geometry (True) or individual files are created for each geometry (False).
+    :param mosaic: Whether the polygons are aggregated into a single geometry (True)
+                   or individual files are created for each geometry (False).
     :param output_format: output_format (default='nc')
     :param dir_output: specify an output location
     :param time_range: [start, end] of time subset
     :param time_region: year, months or days to be extracted in the timeseries
+    :param processes: number of processes clipping datasets and polygons in parallel
+    :param single_read: if True and mosaic is False, each dataset is read once over the bounding box of
+                        the polygons of a shapefile, and all polygons are extracted from this block
 
-    :returns list: path to clipped files
+    :returns list: path to clipped files, in the order of polygons then datasets
     """
 
     if type(resource) != list:
@@ -106,70 +226,206 @@ def clipping(resource=[], variable=None, dimension_map=None, calc=None, output_f
 
     geoms = set()
     ncs = sort_by_filename(resource, historical_concatination=historical_concatination)  # historical_concatenation=True
-    geom_files = []
+    try:
+        resolved = resolve_polygons(polygons)
+    except:
+        LOGGER.exception('geom identification failed')
+        resolved = {}
+
+    # Each task runs a clipping function over one dataset and returns one
+    # output per item of its list of (output position, description).
+    kwds = dict(calc=calc, calc_grouping=calc_grouping, output_format=output_format,
+                time_range=time_range, time_region=time_region, spatial_wrapping=spatial_wrapping,
+                dir_output=dir_output, dimension_map=dimension_map)
+    tasks = []
     if mosaic is True:
         try:
             nameadd = '_'
+            ugids = []
             for polygon in polygons:
-                geoms.add(get_geom(polygon))
+                polygon_geom, ugid = resolved[polygon]
+                if polygon_geom is None:
+                    LOGGER.error('polygon %s not found in the shapefiles, skipped' % polygon)
+                    continue
+                geoms.add(polygon_geom)
+                ugids.extend(ugid or [])
                 nameadd = nameadd + polygon.replace(' ', '')
             if len(geoms) > 1:
                 LOGGER.error('polygons belong to different shapefiles! mosaic option is not possible %s', geoms)
+            elif not geoms:
+                LOGGER.error('none of the polygons %s found in the shapefiles' % polygons)
             else:
                 geom = geoms.pop()
-            ugids = get_ugid(polygons=polygons, geom=geom)
+                for i, key in enumerate(ncs.keys()):
+                    if prefix is None:
+                        name = key + nameadd
+                    else:
+                        name = prefix[i]
+                    tasks.append(([(i, 'ocgis mosaik clipping %s ' % (key))], _clip,
+                                  dict(kwds, resource=ncs[key], prefix=name, geom=geom, select_ugid=ugids,
+                                       memory_limit=memory_limit)))
         except:
             LOGGER.exception('geom identification failed')
-        for i, key in enumerate(ncs.keys()):
-            try:
-                # if variable is None:
-                variable = get_variable(ncs[key])
-                LOGGER.info('variable %s detected in resource' % (variable))
-                if prefix is None:
-                    name = key + nameadd
-                else:
-                    name = prefix[i]
-                geom_file = call(resource=ncs[key], variable=variable, calc=calc, calc_grouping=calc_grouping,
-                                 output_format=output_format, prefix=name,
-                                 geom=geom, select_ugid=ugids, time_range=time_range,
-                                 time_region=time_region,
-                                 spatial_wrapping=spatial_wrapping, memory_limit=memory_limit,
-                                 dir_output=dir_output, dimension_map=dimension_map)
-                geom_files.append(geom_file)
-                LOGGER.info('ocgis mosaik clipping done for %s ' % (key))
-            except:
-                msg = 'ocgis mosaik clipping failed for %s ' % (key)
-                LOGGER.exception(msg)
+
     else:
+        # With single_read, polygons are grouped by shapefile, and each group is clipped
+        # from a single read of each dataset.
+        groups = {}
         for i, polygon in enumerate(polygons):
             try:
-                geom = get_geom(polygon)
-                ugid = get_ugid(polygons=polygon, geom=geom)
-                for key in ncs.keys():
-                    try:
-                        # if variable is None:
-                        variable = get_variable(ncs[key])
-                        LOGGER.info('variable %s detected in resource' % (variable))
-                        if prefix is None:
-                            name = key + '_' + polygon.replace(' ', '')
-                        else:
-                            name = prefix[i]
-                        geom_file = call(resource=ncs[key], variable=variable, calc=calc, calc_grouping=calc_grouping,
-                                         output_format=output_format,
-                                         prefix=name, geom=geom, select_ugid=ugid, dir_output=dir_output,
-                                         dimension_map=dimension_map, spatial_wrapping=spatial_wrapping,
-                                         memory_limit=memory_limit, time_range=time_range, time_region=time_region,
-                                         )
-                        geom_files.append(geom_file)
-                        LOGGER.info('ocgis clipping done for %s ' % (key))
-                    except:
-                        msg = 'ocgis clipping failed for %s ' % (key)
-                        LOGGER.exception(msg)
+                geom, ugid = resolved[polygon]
+                if geom is None:
+                    # Clipping without geometry would return the whole domain.
+                    LOGGER.error('polygon %s not found in the shapefiles, skipped' % polygon)
+                    continue
+                for j, key in enumerate(ncs.keys()):
+                    if prefix is None:
+                        name = key + '_' + polygon.replace(' ', '')
+                    else:
+                        name = prefix[i]
+                    if single_read is True:
+                        groups.setdefault((geom, key), []).append((i * len(ncs) + j, name, ugid))
+                        continue
+                    tasks.append(([(i * len(ncs) + j, 'ocgis clipping %s ' % (key))], _clip,
+                                  dict(kwds, resource=ncs[key], prefix=name, geom=geom, select_ugid=ugid,
+                                       memory_limit=memory_limit)))
             except:
                 LOGGER.exception('geom identification failed')
+
+        for (geom, key), group in sorted(groups.items()):
+            tasks.append(([(order, 'ocgis clipping %s ' % (key)) for order, _, _ in group], _clip_polygons,
+                          dict(kwds, resource=ncs[key], geom=geom,
+                               selections=[(name, ugid) for _, name, ugid in group])))
+
+    ################
+    # run the tasks
+    ################
+    processes = max(1, min(processes, len(tasks)))
+    if processes > 1:
+        LOGGER.info('clipping %s tasks with %s processes' % (len(tasks), processes))
+        pool = Pool(processes=processes)
+        try:
+            results = pool.map(_run_clipping_task, [t[1:] for t in tasks], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_run_clipping_task(t[1:]) for t in tasks]
+
+    outputs = []
+    for (items, _, _), result in zip(tasks, results):
+        outputs.extend(zip(items, result))
+
+    geom_files = []
+    for (_, msg), (geom_file, error) in sorted(outputs, key=lambda o: o[0][0]):
+        if error is None:
+            geom_files.append(geom_file)
+            LOGGER.info('%s done' % msg)
+        else:
+            LOGGER.error('%s failed\n%s' % (msg, error))
     return geom_files
 
 
+def _run_clipping_task(task):
+    """
+    Run a clipping function, returning a list of (path to the clipped file,
+    error traceback in case of failure) tuples.
+    """
+    func, kwds = task
+    return func(kwds)
+
+
+def _clip(kwds):
+    """
+    Clip a dataset with `ocgis_module.call`.
+
+    :param kwds: `call` arguments
+
+    :returns list: (path to the clipped file, error traceback) tuple
+    """
+    try:
+        # if variable is None:
+        variable = get_variable(kwds['resource'])
+        LOGGER.info('variable %s detected in resource' % (variable))
+        return [(call(variable=variable, **kwds), None)]
+    except:
+        return [(None, traceback.format_exc())]
+
+
+def _clip_polygons(kwds):
+    """
+    Clip a dataset to several polygons of a shapefile with `clip_polygons`.
+
+    :param kwds: `clip_polygons` arguments
+
+    :returns list: (path to the clipped file, error traceback) tuple for each selection
+    """
+    try:
+        variable = get_variable(kwds['resource'])
+        LOGGER.info('variable %s detected in resource' % (variable))
+        return clip_polygons(variable=variable, **kwds)
+    except:
+        return [(None, traceback.format_exc())] * len(kwds['selections'])
+
+
+def clip_polygons(resource, geom, selections, variable=None, dimension_map=None, calc=None,
+                  calc_grouping=None, output_format='nc', time_range=None, time_region=None,
+                  spatial_wrapping='wrap', dir_output=None):
+    """ clips a dataset to several polygons of a shapefile, reading the dataset once
+
+    The values covering the bounding box of all polygons are read into memory,
+    then each selection of polygons is extracted from them and written to its own file.
+
+    :param resource: list of input netCDF files of a single dataset
+    :param geom: name of the shapefile
+    :param selections: list of (prefix, ugids) tuples, one for each output file
+    :param variable: variable (string) to be used in netCDF
+    :param dimesion_map: specify a dimension map if input netCDF has unconventional dimension
+    :param calc: ocgis calculation argument
+    :param calc_grouping: ocgis calculation grouping
+    :param output_format: output_format (default='nc')
+    :param time_range: [start, end] of time subset
+    :param time_region: year, months or days to be extracted in the timeseries
+    :param spatial_wrapping: how to handle coordinates, options: None, 'wrap' (default), 'unwrap'
+    :param dir_output: specify an output location
+
+    :returns list: (path to the clipped file, error traceback) tuple for each selection
+    """
+    from ocgis import OcgOperations, ShpCabinetIterator, env
+
+    env.DIR_SHPCABINET = config.shapefiles_path()
+    env.OVERWRITE = True
+    if dir_output is None:
+        dir_output = os.path.abspath(os.curdir)
+
+    # Bounding box of all polygons.
+    ugids = sorted(set(ugid for _, selection in selections for ugid in selection))
+    bounds = [row['geom'].bounds for row in ShpCabinetIterator(geom, select_uid=ugids)]
+    bbox = [min(b[0] for b in bounds), min(b[1] for b in bounds),
+            max(b[2] for b in bounds), max(b[3] for b in bounds)]
+
+    # Read the values over the bounding box once, set up as in `call`.
+    rd = request_dataset(resource, variable=variable, dimension_map=dimension_map,
+                         time_range=time_range, time_region=time_region)
+    ops = OcgOperations(dataset=rd, geom=bbox, output_format='ocgis', **get_ops_options(spatial_wrapping))
+    field = ops.execute().get_element()
+    for var in field.data_variables:
+        var.get_value()
+    LOGGER.info('read %s over %s for %s selections' % (variable, bbox, len(selections)))
+
+    results = []
+    for name, selection in selections:
+        try:
+            # Polygons sharing a code are aggregated, as by `call`.
+            ops = OcgOperations(dataset=field, geom=geom, select_ugid=selection, agg_selection=True,
+                                prefix=name, dir_output=dir_output, calc=calc, calc_grouping=calc_grouping,
+                                output_format=output_format, **get_ops_options(spatial_wrapping))
+            results.append((ops.execute(), None))
+        except:
+            results.append((None, traceback.format_exc()))
+    return results
+
+
 def get_dimension_map(resource):
     """ returns the dimension map for a file, required for ocgis processing.
     file must have a DRS-conformant filename (see: utils.drs_filename())
@@ -222,6 +478,56 @@ def get_dimension_map(resource):
 # return dimension_map
 
 
+def get_shp_index(geom):
+    """ returns the attribute table of a shapefile of the shape cabinet
+
+    The table is read once from the shapefile and persisted in the cache
+    directory, keyed by the shapefile path, modification time and size, so
+    that later calls do not read the geometries.
+
+    :param geom: name of the shapefile
+
+    returns dict: list of values of each attribute column, including UGID
+    """
+    path = os.path.join(config.shapefiles_path(), geom + '.shp')
+    st = os.stat(path)
+    signature = [path, st.st_mtime, st.st_size]
+
+    if geom in _SHP_INDEX and _SHP_INDEX[geom]['signature'] == signature:
+        return _SHP_INDEX[geom]['columns']
+
+    sidecar = os.path.join(config.cache_path(), 'shapefiles', geom + '.json')
+    try:
+        with open(sidecar) as f:
+            index = json.load(f)
+        if index['signature'] != signature:
+            raise ValueError('outdated index')
+    except (IOError, OSError, ValueError, KeyError):
+        from ocgis import env, ShpCabinetIterator
+
+        LOGGER.info('building attribute index of shapefile %s' % geom)
+        env.DIR_SHPCABINET = config.shapefiles_path()
+        columns = {}
+        for row in ShpCabinetIterator(geom):
+            for key, value in row['properties'].items():
+                columns.setdefault(key, []).append(value)
+        index = dict(signature=signature, columns=columns)
+
+        try:
+            if not os.path.isdir(os.path.dirname(sidecar)):
+                os.makedirs(os.path.dirname(sidecar))
+            fd, tmp = mkstemp(dir=os.path.dirname(sidecar), suffix='.tmp')
+            os.close(fd)
+            with open(tmp, 'w') as f:
+                json.dump(index, f, default=str)
+            os.rename(tmp, sidecar)
+        except (IOError, OSError):
+            LOGGER.exception('failed to store attribute index of shapefile %s' % geom)
+
+    _SHP_INDEX[geom] = index
+    return index['columns']
+
+
 def get_shp_column_values(geom, columnname):
     """ returns a list of all entries the shapefile column name
 
@@ -230,16 +536,27 @@ def get_shp_column_values(geom, columnname):
 
     returns list: column names
     """
-    from ocgis import env, ShpCabinetIterator
-    # import ocgis
+    return list(get_shp_index(geom)[columnname])
 
-    env.DIR_SHPCABINET = config.shapefiles_path()
-    sci = ShpCabinetIterator(geom)
 
-    vals = []
-    for row in sci:
-        vals.append(row['properties'][columnname])
-    return vals
+def _get_ugid_lookup_(geom):
+    """ returns a dictionary from the polygon names of a shapefile to their UGIDs
+
+    The dictionary is built once per process and rebuilt if the shapefile
+    attribute index changes.
+
+    :param geom: name of the shapefile, one of `_GEOM_COLUMNS`
+
+    returns dict: list of UGIDs of each polygon name
+    """
+    columns = get_shp_index(geom)
+    cached = _UGID_LOOKUP.get(geom)
+    if cached is None or cached[0] is not columns:
+        lookup = {}
+        for value, ugid in zip(columns[dict(_GEOM_COLUMNS)[geom]], columns['UGID']):
+            lookup.setdefault(value, []).append(ugid)
+        cached = _UGID_LOOKUP[geom] = (columns, lookup)
+    return cached[1]
 
 
 def get_ugid(polygons=None, geom=None):
@@ -247,40 +564,22 @@ def get_ugid(polygons=None, geom=None):
     returns geometry id of given polygon in a given shapefile.
 
     :param polygons: string or list of the region polygons
-    :param geom: available shapefile. Possible entries: '50m_country', 'NUTS2'
+    :param geom: available shapefile. Possible entries: 'countries', 'extremoscope', 'continents'
 
     :returns list: ugids used by ocgis
     """
-    from ocgis import env, ShpCabinetIterator
-    # from ocgis import env
-
     if polygons is None:
         result = None
     else:
         if type(polygons) != list:
             polygons = list([polygons])
 
-        env.DIR_SHPCABINET = config.shapefiles_path()
-        sc_iter = ShpCabinetIterator(geom)
         result = []
 
-        if geom == 'countries':
-            for row in sc_iter:
-                for polygon in polygons:
-                    if row['properties']['ADM0_A3'] == polygon:
-                        result.append(row['properties']['UGID'])
-
-        elif geom == 'extremoscope':
-            for row in sc_iter:
-                for polygon in polygons:
-                    if row['properties']['HASC_1'] == polygon:
-                        result.append(row['properties']['UGID'])
-
-        elif geom == 'continents':
-            for row in sc_iter:
-                for polygon in polygons:
-                    if row['properties']['CONTINENT'] == polygon:
-                        result.append(row['properties']['UGID'])
+        if geom in dict(_GEOM_COLUMNS):
+            lookup = _get_ugid_lookup_(geom)
+            for polygon in polygons:
+                result.extend(lookup.get(polygon, []))
         else:
             from ocgis import ShpCabinet
             sc = ShpCabinet(config.shapefiles_path())
@@ -295,46 +594,32 @@ def get_geom(polygon=None):
 
     returns str: name of shapefile (geom)
     """
-
     if polygon is None:
-        geom = None
-    else:
-        if polygon in _COUNTRIES_:  # (polygon) == 3:
-            geom = 'countries'
-        elif polygon in _POLYGONS_EXTREMOSCOPE_:  # len(polygon) == 5 and polygon[2] == '.':
-            geom = 'extremoscope'
-        elif polygon in _EUREGIONS_:
-            geom = 'extremoscope'
-        elif polygon in _CONTINENTS_:
-            geom = 'continents'
-        else:
-            LOGGER.debug('polygon: %s not found in geoms' % polygon)
-    return geom
-
-# === Available Polygons
-_CONTINENTS_ = get_shp_column_values(geom='continents', columnname='CONTINENT')
+        return None
 
-_COUNTRIES_ = {}
-_COUNTRIES_Europe_ = {}
+    for geom, _ in _GEOM_COLUMNS:
+        if polygon in _get_ugid_lookup_(geom):
+            return geom
 
-# === populate polygon dictionaries
-ADM0_A3 = get_shp_column_values(geom='countries', columnname='ADM0_A3')
-NAMELONG = get_shp_column_values(geom='countries', columnname='NAME_LONG')
-CONTINENT = get_shp_column_values(geom='countries', columnname='CONTINENT')
+    LOGGER.debug('polygon: %s not found in geoms' % polygon)
+    return None
 
-for c, key in enumerate(ADM0_A3):
-    _COUNTRIES_[key] = dict(longname=NAMELONG[c])
 
-for c, key in enumerate(ADM0_A3):
-    if CONTINENT[c] == 'Europe':
-        _COUNTRIES_Europe_[key] = dict(longname=NAMELONG[c])
+def resolve_polygons(polygons):
+    """ returns the shapefile (geom) and geometry ids of a list of polygons
 
-_EUREGIONS_ = {}
+    :param polygons: list of polygon short names
 
-HASC_1 = get_shp_column_values(geom='extremoscope', columnname='HASC_1')
-NAME_1 = get_shp_column_values(geom='extremoscope', columnname='NAME_1')
-
-_POLYGONS_EXTREMOSCOPE_ = HASC_1
+    :returns dict: (geom, ugids) tuple for each polygon. geom and ugids are None for unknown polygons.
+    """
+    if type(polygons) != list:
+        polygons = list([polygons])
 
-for c, key in enumerate(HASC_1):
-    _EUREGIONS_[key] = dict(longname=NAME_1[c])
+    result = {}
+    for polygon in polygons:
+        geom = get_geom(polygon)
+        if geom is None:
+            result[polygon] = (None, None)
+        else:
+            result[polygon] = (geom, list(_get_ugid_lookup_(geom)[polygon]))
+    return result
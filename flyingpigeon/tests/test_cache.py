@@ -0,0 +1,80 @@
+import os
+import stat
+import tempfile
+import time
+
+import numpy as np
+import pytest
+
+from flyingpigeon.cache import FileCache, make_key, file_signature, canonical, link
+
+
+def write(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'0' * size)
+    return path
+
+
+def test_make_key():
+    a = np.arange(10.)
+    assert make_key('a', 1, a) == make_key('a', 1, a.copy())
+    assert make_key('a', 1, a) != make_key('a', 1, a + 1)
+    assert make_key('a', 1) != make_key('a', 2)
+
+
+def test_file_signature():
+    path = write(tempfile.mktemp(), 10)
+    sig = file_signature(path)
+    assert sig[0] == path
+    assert sig[2] == 10
+
+
+def test_get_put():
+    cache = FileCache('test', 1000, path=tempfile.mkdtemp())
+    src = write(tempfile.mktemp(), 10)
+    assert cache.get('abc') is None
+    path = cache.put('abc', src)
+    assert cache.get('abc') == path
+    assert os.path.getsize(path) == 10
+    assert not os.stat(path).st_mode & stat.S_IWUSR
+
+
+def test_evict():
+    cache = FileCache('test', 250, path=tempfile.mkdtemp())
+    src = write(tempfile.mktemp(), 100)
+    cache.put('a', src)
+    cache.put('b', src)
+    os.utime(cache.path('a'), (time.time() - 10, time.time() - 10))
+    os.utime(cache.path('b'), (time.time() - 20, time.time() - 20))
+    cache.get('b')  # b is now the most recently used entry
+
+    cache.put('c', src)
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    assert cache.get('c') is not None
+
+
+def test_put_larger_than_cache():
+    cache = FileCache('test', 150, path=tempfile.mkdtemp())
+    cache.put('a', write(tempfile.mktemp(), 100))
+
+    # The new entry is returned even though it does not fit, older entries make room.
+    path = cache.put('b', write(tempfile.mktemp(), 200), move=True)
+    assert os.path.exists(path)
+    assert cache.get('a') is None
+
+
+def test_canonical():
+    import datetime as dt
+    a = canonical({'b': [1, 2.], 'a': (dt.datetime(2000, 1, 1), None)})
+    b = canonical({'a': [dt.datetime(2000, 1, 1), None], 'b': (1, 2.)})
+    assert a == b
+    assert make_key(a) == make_key(b)
+    with pytest.raises(TypeError):
+        canonical(object())
+
+
+def test_link():
+    src = write(tempfile.mktemp(), 10)
+    dest = link(src, tempfile.mktemp())
+    assert os.stat(dest).st_ino == os.stat(src).st_ino
@@ -123,6 +123,43 @@ class TestZAE():
         aaeq(dm, 0.77802, 4)
 
 
+class TestSR():
+    def test_simple(self):
+        d = 2
+        n, m = 200, 200
+        x = np.random.randn(n, d)
+        y = np.random.randn(m, d)
+
+        # Almost identical samples
+        dm = dd.skezely_rizzo(x + .001, x)
+        aaeq(dm, 0, 2)
+
+        # Different distributions
+        assert dd.skezely_rizzo(x + 2, y) > dd.skezely_rizzo(x, y)
+
+    def test_against_dense(self):
+        x, y = matlab_sample()
+        n, m = len(x), len(y)
+        v = x.std(0, ddof=1) * y.std(0, ddof=1)
+        dx = spatial.distance.pdist(x, 'seuclidean', V=v)
+        dy = spatial.distance.pdist(y, 'seuclidean', V=v)
+        dxy = spatial.distance.cdist(x, y, 'seuclidean', V=v)
+        z = 2. * dxy.sum() / (n * m) - 2. * dx.sum() / n ** 2 - 2. * dy.sum() / m ** 2
+
+        aaeq(dd.skezely_rizzo(x, y), z * n * m / (n + m))
+
+
+class TestPairwiseDistanceSum():
+    def test_blocks(self):
+        x = np.random.randn(50, 3)
+        y = np.random.randn(40, 3)
+
+        aaeq(dd.pairwise_distance_sum(x, max_memory=100),
+             spatial.distance.pdist(x).sum())
+        aaeq(dd.pairwise_distance_sum(x, y, func=np.log, max_memory=100),
+             np.log(spatial.distance.cdist(x, y)).sum())
+
+
 class TestFR():
     def test_simple(self):
         # Over these 7 points, there are 2 with edges within the same sample.
@@ -144,6 +181,67 @@ class TestFR():
         aaeq(dm, 0.96667, 4)
 
 
+class TestEuclideanMST():
+    def test_against_dense(self):
+        from sklearn import neighbors
+        from scipy.sparse.csgraph import minimum_spanning_tree
+
+        np.random.seed(5)
+        for n, d in [(50, 1), (300, 2), (400, 5)]:
+            x = np.random.randn(n, d)
+            g = neighbors.kneighbors_graph(x, n_neighbors=n - 1, mode='distance')
+            mst = minimum_spanning_tree(g)
+            expected = set(map(tuple, np.sort(np.array(mst.nonzero()).T, 1)))
+
+            edges = dd.euclidean_mst(x)
+            assert set(map(tuple, np.sort(edges, 1))) == expected
+
+    def test_separated(self):
+        from sklearn import neighbors
+        from scipy.sparse.csgraph import minimum_spanning_tree
+
+        # Well separated samples, the neighbours of most points are all in
+        # their own component.
+        np.random.seed(8)
+        x = np.random.randn(400, 2)
+        y = np.random.randn(300, 2) + 50
+        xy = np.vstack([x, y])
+        g = neighbors.kneighbors_graph(xy, n_neighbors=len(xy) - 1, mode='distance')
+        expected = set(map(tuple, np.sort(np.array(minimum_spanning_tree(g).nonzero()).T, 1)))
+        assert set(map(tuple, np.sort(dd.euclidean_mst(xy), 1))) == expected
+
+        assert len(xy) > dd._FR_DENSE_MAX
+        aaeq(dd.friedman_rafsky(x, y), 1 - 2. / len(xy))
+
+    def test_friedman_rafsky_duplicates(self):
+        np.random.seed(7)
+        # Duplicates within each sample, and a point shared by both samples.
+        samples = [(np.repeat(np.random.randn(40, 2), 3, axis=0), np.repeat(np.random.randn(30, 2) + .5, 4, axis=0)),
+                   (np.zeros((1, 1)), np.zeros((1, 1)))]
+        dense = [dd.friedman_rafsky(x, y) for x, y in samples]
+        aaeq(dense[1], 0)
+
+        dense_max = dd._FR_DENSE_MAX
+        dd._FR_DENSE_MAX = 0
+        try:
+            aaeq([dd.friedman_rafsky(x, y) for x, y in samples], dense)
+        finally:
+            dd._FR_DENSE_MAX = dense_max
+
+    def test_friedman_rafsky(self):
+        np.random.seed(6)
+        x = np.random.randn(400, 3)
+        y = np.random.randn(300, 3) + .5
+        dm = dd.friedman_rafsky(x, y)
+
+        dense_max = dd._FR_DENSE_MAX
+        dd._FR_DENSE_MAX = 1000
+        try:
+            aaeq(dd.friedman_rafsky(x, y), dm)
+        finally:
+            dd._FR_DENSE_MAX = dense_max
+
+
 class TestKS():
     def test_1D_ks_2samp(self):
         # Compare with scipy.stats.ks_2samp
@@ -158,6 +256,103 @@ class TestKS():
         dm = dd.kolmogorov_smirnov(x, y)
         aaeq(dm, 0.96667, 4)
 
+    def test_quadrant_counts_chunks(self):
+        x = np.random.randn(100, 3)
+        y = np.random.randn(80, 3)
+        c = dd._quadrant_counts(x, y)
+        assert c.shape == (8, 100)
+        aaeq(c.sum(0), 1)
+        aeq(dd._quadrant_counts(x, y, max_memory=1000), c)
+
+    def test_quadrant_counts_1D(self):
+        x = np.random.randn(50, 1)
+        y = np.random.randn(60, 1)
+        c = dd._quadrant_counts(x, y)
+        aaeq(c[1], (y.T >= x).mean(1))
+
+
+class TestReferenceSample():
+    def test_metrics(self):
+        np.random.seed(4)
+        x = np.random.randn(30, 2)
+        ref = dd.ReferenceSample(x)
+        for i in range(3):
+            y = np.random.randn(25, 2) + i
+            for dist in dd.__all__:
+                metric = getattr(dd, dist)
+                aaeq(metric(ref, y), metric(x, y))
+
+    def test_kneighbors(self):
+        x, y = matlab_sample()
+        ref = dd.ReferenceSample(x)
+        r2 = ref.kneighbors(2)
+        assert r2.shape == (30, 2)
+        aeq(r2[:, 0], 0)
+        aeq(ref.kneighbors(4)[:, :2], r2)
+        aeq(ref.kneighbors(3), ref.kneighbors(4)[:, :3])
+
+    def test_approximate(self):
+        np.random.seed(4)
+        x = np.random.randn(2000, 3)
+        y = np.random.randn(1500, 3) + .3
+        for metric in [dd.nearest_neighbor, dd.kldiv]:
+            exact = metric(x, y)
+            aeq(metric(x, y, eps=0), exact)
+            np.testing.assert_allclose(metric(x, y, eps=.5), exact, rtol=.1)
+
+
+class TestBatch():
+    def test_against_single(self):
+        np.random.seed(3)
+        x = np.random.randn(30, 2)
+        y = np.random.randn(10, 30, 2) + np.random.rand(10, 1, 2)
+
+        # Missing values in candidate samples.
+        y[2, :27] = np.nan
+        y[4, 5, 1] = np.nan
+
+        for dist in dd.__all__:
+            out = dd.batch(dist, x, y)
+            assert out.shape == (10,)
+            assert np.isnan(out[2])
+
+            for i in [0, 4, 9]:
+                yi = np.ma.masked_invalid(y[i])
+                yi = yi.compress(~yi.mask.any(1), 0)
+                aaeq(out[i], getattr(dd, dist)(x, yi))
+
+    def test_1D(self):
+        x = np.random.randn(30)
+        y = np.random.randn(4, 30)
+        out = dd.batch('seuclidean', x, y)
+        aaeq(out[1], dd.seuclidean(x, y[1]))
+
+    def test_kolmogorov_smirnov_1D(self):
+        np.random.seed(4)
+        x = np.round(np.random.randn(40), 1)
+        y = np.round(np.random.randn(50, 30) + np.random.rand(50, 1), 1)
+        y[3, :10] = np.nan
+        y[7, 2] = np.nan
+
+        out = dd.batch('kolmogorov_smirnov', x, y)
+        for i in range(50):
+            yi = y[i][np.isfinite(y[i])]
+            aaeq(out[i], dd.kolmogorov_smirnov(x, yi))
+
+    def test_unknown_metric(self):
+        with pytest.raises(ValueError):
+            dd.batch('foo', np.ones((5, 1)), np.ones((2, 5, 1)))
+
+
+class TestSelectCandidates():
+    def test_simple(self):
+        score = np.array([[3., np.nan, 1.], [0., 5., 2.]])
+        aeq(dd.select_candidates(score), np.isfinite(score))
+        aeq(dd.select_candidates(score, size=2), [[0, 0, 1], [1, 0, 0]])
+        aeq(dd.select_candidates(score, threshold=2.5), [[0, 0, 1], [1, 0, 1]])
+        aeq(dd.select_candidates(score, size=2, threshold=.5), [[0, 0, 0], [1, 0, 0]])
+        aeq(dd.select_candidates(score, size=10).sum(), 5)
+
 
 # ==================================================================== #
 #                       Analytical results
@@ -0,0 +1,142 @@
+import os
+import threading
+
+import pytest
+
+from flyingpigeon import utils
+from flyingpigeon.cache import FileCache, make_key
+
+from .common import TESTDATA
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve the files of the server with an ETag and range support."""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path in self.server.errors:
+            self.send_error(self.server.errors.pop(self.path))
+            return
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        data, etag = self.server.files[self.path]
+        start = 0
+        if 'Range' in self.headers and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.server.ranges.append(start)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    with open(utils.local_path(TESTDATA['cmip5_tasmax_2006_nc']), 'rb') as f:
+        data = f.read()
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    httpd.files = {'/a/tasmax.nc': (data, '"a"'), '/b/tasmax.nc': (data, '"b"'), '/bad.nc': (b'not netcdf', '"c"')}
+    httpd.files['/c/tasmax.nc'] = (data, None)
+    httpd.files['/dap/tasmax.nc.dds'] = (b'Dataset {\n} tasmax.nc;\n', '"d"')
+    httpd.errors = {}
+    httpd.ranges = []
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server, path):
+    return 'http://127.0.0.1:{}{}'.format(server.server_address[1], path)
+
+
+def test_cached_download(server):
+    path = utils.cached_download(url(server, '/a/tasmax.nc'))
+    assert os.path.dirname(path) == utils.download_cache().dir
+    assert utils.cached_download(url(server, '/a/tasmax.nc')) == path
+
+    # A new ETag is a new entry.
+    data, _ = server.files['/a/tasmax.nc']
+    server.files['/a/tasmax.nc'] = (data, '"a2"')
+    assert utils.cached_download(url(server, '/a/tasmax.nc')) != path
+
+
+def test_cached_download_resume(server):
+    data, etag = server.files['/b/tasmax.nc']
+    cache = utils.download_cache()
+    key = make_key(url(server, '/b/tasmax.nc'), etag)
+    with open(cache.path(key, '.part'), 'wb') as f:
+        f.write(data[:1000])
+
+    path = utils.cached_download(url(server, '/b/tasmax.nc'))
+    assert server.ranges == [1000]
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_cached_download_invalid(server):
+    with pytest.raises(IOError):
+        utils.cached_download(url(server, '/bad.nc'))
+    key = make_key(url(server, '/bad.nc'), '"c"')
+    assert not os.path.exists(utils.download_cache().path(key, '.part'))
+
+
+def test_opendap_or_download(server, tmpdir):
+    a = utils.opendap_or_download(url(server, '/a/tasmax.nc'), output_path=str(tmpdir))
+    b = utils.opendap_or_download(url(server, '/b/tasmax.nc'), output_path=str(tmpdir))
+    assert os.path.basename(a) == os.path.basename(b) == 'tasmax.nc'
+    assert a != b
+
+
+def test_cached_download_not_stored(server, tmpdir, monkeypatch):
+    # Without validator, the file could never be reused.
+    output = str(tmpdir.join('c.nc'))
+    assert utils.cached_download(url(server, '/c/tasmax.nc'), output=output) == output
+    assert os.path.getsize(output) == len(server.files['/c/tasmax.nc'][0])
+    assert utils.download_cache().get(make_key(url(server, '/c/tasmax.nc'), None)) is None
+
+    # Files larger than the store are not stored either.
+    cache = FileCache('downloads', 100, path=str(tmpdir))
+    monkeypatch.setattr(utils, 'download_cache', lambda: cache)
+    path = utils.opendap_or_download(url(server, '/a/tasmax.nc'), output_path=str(tmpdir))
+    assert os.path.exists(path)
+    assert os.path.dirname(path) != cache.dir
+    assert [name for name in os.listdir(cache.dir) if name.endswith('.nc')] == []
+
+
+def test_opendap_supported(server):
+    assert utils.opendap_supported(url(server, '/dap/tasmax.nc'))
+    assert not utils.opendap_supported(url(server, '/a/tasmax.nc'))
+    assert server.requests == ['/dap/tasmax.nc.dds', '/a/tasmax.nc.dds']
+
+    # Results are reused for the same host and directory.
+    assert utils.opendap_supported(url(server, '/dap/tasmin.nc'))
+    assert not utils.opendap_supported(url(server, '/a/tasmin.nc'))
+    assert len(server.requests) == 2
+    assert utils.opendap_supported('/tmp/tasmax.nc')
+
+
+def test_opendap_supported_server_error(server):
+    server.errors['/dap/tasmax.nc.dds'] = 503
+    assert not utils.opendap_supported(url(server, '/dap/tasmax.nc'))
+
+    # A temporary failure is not remembered.
+    assert utils.opendap_supported(url(server, '/dap/tasmax.nc'))
+    assert server.requests == ['/dap/tasmax.nc.dds'] * 2
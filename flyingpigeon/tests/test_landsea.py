@@ -0,0 +1,66 @@
+import json
+import os
+import tempfile
+
+import netCDF4 as nc
+import pytest
+
+from flyingpigeon import config
+from flyingpigeon import landsea
+from flyingpigeon.utils import ATTRIBUTE_TO_FACETS_MAP
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmpdir, monkeypatch):
+    """Keep the masks and resolved locations of the tests out of the configured cache."""
+    monkeypatch.setattr(config, 'cache_path', lambda: str(tmpdir))
+    return str(tmpdir)
+
+
+def write_dataset(path, model, experiment='historical'):
+    """Write a dataset with the global attributes mapped to search facets."""
+    with nc.Dataset(path, 'w') as ds:
+        for attr, facet in ATTRIBUTE_TO_FACETS_MAP.items():
+            ds.setncattr(attr, experiment if facet == 'experiment' else model)
+        ds.createDimension('lat', 2)
+        ds.createVariable('lat', 'f8', ('lat',))[:] = [0., 1.]
+        ds.createVariable('sftlf', 'f4', ('lat',))[:] = [0., 100.]
+    return path
+
+
+def write_index(entries):
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(entries, f)
+    return path
+
+
+def test_landsea_mask(cache_path):
+    model = os.path.basename(tempfile.mkdtemp())
+    sftlf = write_dataset(tempfile.mktemp(suffix='.nc'), model)
+    historical = write_dataset(tempfile.mktemp(suffix='.nc'), model)
+    rcp85 = write_dataset(tempfile.mktemp(suffix='.nc'), model, experiment='rcp85')
+
+    facets = landsea.mask_facets(historical)
+    assert 'experiment' not in facets
+    index = write_index([dict(facets, url=sftlf)])
+
+    mask = landsea.landsea_mask(historical, index=index)
+    assert os.path.dirname(mask) == landsea.mask_cache().dir
+    assert mask.startswith(cache_path)
+    assert os.path.isfile(os.path.join(cache_path, 'landsea.json'))
+    with nc.Dataset(mask) as ds:
+        assert ds.variables['sftlf'][1] == 100.
+
+    # Datasets of other experiments resolve to the same mask without searching the index.
+    os.remove(index)
+    assert landsea.landsea_mask(rcp85, index=index) == mask
+
+    # Expired resolutions are searched again.
+    index = write_index([])
+    try:
+        landsea.landsea_mask(rcp85, index=index, ttl=0)
+    except Exception as e:
+        assert 'Could not find a mask' in str(e)
+    else:
+        raise AssertionError('Expired resolution was reused.')
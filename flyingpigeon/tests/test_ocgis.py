@@ -24,3 +24,46 @@ def test_has_Lambert_Conformal():
 
 def test_gdal():
     from flyingpigeon.subset import clipping
+
+
+def test_get_memory_limit():
+    assert ocgis_module.get_memory_limit(100) == 100
+    assert ocgis_module.get_memory_limit(10 ** 6) == ocgis_module.MAX_MEMORY_LIMIT
+    assert 0 < ocgis_module.get_memory_limit() <= ocgis_module.MAX_MEMORY_LIMIT
+
+
+def test_get_tile_dimension():
+    # Each tile holds a quarter of the data.
+    assert ocgis_module.get_tile_dimension(400., (100, 100), 100.) == 50
+    assert ocgis_module.get_tile_dimension(400., (100, 100), 1000.) == 100
+    assert ocgis_module.get_tile_dimension(10. ** 6, (10, 10), 1.) == 1
+
+
+def test_call_chunked():
+    from netCDF4 import Dataset
+    import numpy as np
+
+    resource = local_path(TESTDATA['cordex_tasmax_2006_nc'])
+    expected = ocgis_module.call(resource, variable='tasmax', prefix='tasmax_full')
+    actual = ocgis_module.call(resource, variable='tasmax', prefix='tasmax_chunked',
+                               memory_limit=0.05)
+
+    with Dataset(expected) as e, Dataset(actual) as a:
+        np.testing.assert_array_equal(a.variables['tasmax'][:], e.variables['tasmax'][:])
+
+
+def test_call_cache():
+    import os
+    resource = local_path(TESTDATA['cordex_tasmax_2006_nc'])
+    first = ocgis_module.call(resource, variable='tasmax', prefix='tasmax_first', cache=True)
+    second = ocgis_module.call(resource, variable='tasmax', prefix='tasmax_second', cache=True)
+    assert os.path.basename(first) == 'tasmax_first.nc'
+    assert os.path.basename(second) == 'tasmax_second.nc'
+    assert os.path.getsize(first) == os.path.getsize(second)
+
+    # Outputs are copies, modifying them leaves the cache untouched.
+    with Dataset(second, 'a') as ds:
+        ds.setncattr('modified', 'yes')
+    third = ocgis_module.call(resource, variable='tasmax', prefix='tasmax_third', cache=True)
+    with Dataset(third) as ds:
+        assert 'modified' not in ds.ncattrs()
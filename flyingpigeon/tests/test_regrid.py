@@ -0,0 +1,84 @@
+import os
+import tempfile
+
+import netCDF4 as nc
+import numpy as np
+
+from flyingpigeon import regrid
+
+
+def write_source(path, lat=(0., 1.), lon=(0., 1., 2.)):
+    """Write a (time, lat, lon) file on a 2x3 grid."""
+    with nc.Dataset(path, 'w') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('lat', len(lat))
+        ds.createDimension('lon', len(lon))
+        t = ds.createVariable('time', 'f8', ('time',))
+        t.units = 'days since 2000-01-01'
+        t[:] = [0, 1]
+        for name, values in [('lat', lat), ('lon', lon)]:
+            v = ds.createVariable(name, 'f8', (name,))
+            v.standard_name = {'lat': 'latitude', 'lon': 'longitude'}[name]
+            v[:] = values
+        v = ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'), fill_value=1e20)
+        v.units = 'K'
+        v[:] = np.ma.masked_greater(np.arange(12.).reshape(2, 2, 3), 10)
+    return path
+
+
+def write_weights(path):
+    """Write SCRIP weights averaging the two rows of the 2x3 source grid onto
+    a 1x2 destination grid: the first destination cell averages the first
+    two source columns, the second the last column."""
+    src = [0, 3, 1, 4, 2, 5]
+    dst = [0, 0, 0, 0, 1, 1]
+    wts = [.25, .25, .25, .25, .5, .5]
+    with nc.Dataset(path, 'w') as ds:
+        ds.createDimension('src_grid_rank', 2)
+        ds.createDimension('dst_grid_rank', 2)
+        ds.createDimension('num_links', len(src))
+        ds.createDimension('num_wgts', 1)
+        ds.createDimension('dst_grid_size', 2)
+        ds.createVariable('src_grid_dims', 'i4', ('src_grid_rank',))[:] = [3, 2]
+        ds.createVariable('dst_grid_dims', 'i4', ('dst_grid_rank',))[:] = [2, 1]
+        ds.createVariable('src_address', 'i4', ('num_links',))[:] = np.array(src) + 1
+        ds.createVariable('dst_address', 'i4', ('num_links',))[:] = np.array(dst) + 1
+        ds.createVariable('remap_matrix', 'f8', ('num_links', 'num_wgts'))[:] = np.array(wts)[:, np.newaxis]
+        for name, values in [('dst_grid_center_lat', [.5, .5]), ('dst_grid_center_lon', [.5, 2.])]:
+            v = ds.createVariable(name, 'f8', ('dst_grid_size',))
+            v.units = 'degrees'
+            v[:] = values
+    return path
+
+
+def test_apply_weights():
+    w = regrid.read_weights(write_weights(tempfile.mktemp(suffix='.nc')))
+    values = np.ma.masked_greater(np.arange(12.).reshape(2, 2, 3), 10)
+    out = regrid.apply_weights(values, w['matrix'], w['dst_shape'])
+    assert out.shape == (2, 1, 2)
+    np.testing.assert_array_almost_equal(out[0], [[2., 3.5]])
+    # The masked value is excluded from the average.
+    np.testing.assert_array_almost_equal(out[1], [[8., 8.]])
+
+
+def test_remap():
+    source = write_source(tempfile.mktemp(suffix='.nc'))
+    weights = write_weights(tempfile.mktemp(suffix='.nc'))
+    output = regrid.remap(source, weights, tempfile.mktemp(suffix='.nc'))
+
+    with nc.Dataset(output) as ds:
+        assert ds.variables['tas'].dimensions == ('time', 'lat', 'lon')
+        np.testing.assert_array_almost_equal(ds.variables['lat'][:], [.5])
+        np.testing.assert_array_almost_equal(ds.variables['lon'][:], [.5, 2.])
+        np.testing.assert_array_almost_equal(ds.variables['tas'][:], [[[2., 3.5]], [[8., 8.]]])
+        np.testing.assert_array_equal(ds.variables['time'][:], [0, 1])
+        assert ds.variables['tas'].units == 'K'
+
+
+def test_grid_key():
+    a = write_source(tempfile.mktemp(suffix='.nc'))
+    b = write_source(tempfile.mktemp(suffix='.nc'))
+    c = write_source(tempfile.mktemp(suffix='.nc'), lat=(0., 2.))
+    assert regrid.grid_key(a, 'r360x180', 'bil') == regrid.grid_key(b, 'r360x180', 'bil')
+    assert regrid.grid_key(a, 'r360x180', 'bil') != regrid.grid_key(a, 'r360x180', 'con')
+    assert regrid.grid_key(a, 'r360x180', 'bil') != regrid.grid_key(c, 'r360x180', 'bil')
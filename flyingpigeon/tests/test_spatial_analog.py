@@ -0,0 +1,59 @@
+import pytest
+
+import datetime as dt
+import os
+import numpy as np
+import netCDF4 as nc
+
+try:
+    from flyingpigeon import spatial_analog
+except Exception:
+    pytestmark = pytest.mark.skip
+from flyingpigeon.utils import local_path
+from flyingpigeon.tests.common import TESTDATA
+from flyingpigeon.config import test_output_path
+
+
+def test_get_tiles():
+    tiles = spatial_analog.get_tiles((5, 7), 3)
+    assert len(tiles) == 6
+    assert tiles[0] == [[0, 3], [0, 3]]
+    assert tiles[-1] == [[3, 5], [6, 7]]
+
+
+def test_write_dissimilarity():
+    cfn = local_path(TESTDATA['indicators_small.nc'])
+    path = os.path.join(test_output_path, 'test_write_dissimilarity.nc')
+    values = np.random.rand(4, 4)
+    values[0, 0] = np.nan
+
+    spatial_analog.write_dissimilarity(path, cfn, 'meantemp', values,
+                                       [dt.datetime(1970, 1, 1), dt.datetime(1990, 1, 1)])
+
+    with nc.Dataset(path) as ds:
+        out = ds.variables['dissimilarity']
+        assert out.dimensions == ('lat', 'lon')
+        assert out[0, 0] is np.ma.masked
+        np.testing.assert_almost_equal(out[1:, 1:], values[1:, 1:], 6)
+        assert ds.variables['time'].climatology == 'climatology_bounds'
+
+
+def test_write_dissimilarity_time_dimension():
+    cfn = local_path(TESTDATA['indicators_small.nc'])
+    path = os.path.join(test_output_path, 'test_write_dissimilarity_time.nc')
+    with nc.Dataset(cfn) as ds:
+        assert spatial_analog.get_time_dimension(ds, 'meantemp') == 'time'
+
+    # lat has no time dimension.
+    with pytest.raises(ValueError):
+        spatial_analog.write_dissimilarity(path, cfn, 'lat', np.random.rand(4), None)
+
+
+def test_source_signature():
+    cfn = local_path(TESTDATA['indicators_small.nc'])
+    sig = spatial_analog.source_signature(TESTDATA['indicators_small.nc'])
+    assert sig == (cfn, os.path.getmtime(cfn), os.path.getsize(cfn))
+    assert spatial_analog.source_signature(cfn) == sig
+
+    url = 'http://example.com/indicators.nc'
+    assert spatial_analog.source_signature(url) == (url,)
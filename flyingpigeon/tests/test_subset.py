@@ -0,0 +1,144 @@
+import os
+import tempfile
+
+import netCDF4 as nc
+import numpy as np
+
+from flyingpigeon import config
+from flyingpigeon import subset
+
+
+def test_get_shp_index():
+    index = subset.get_shp_index('countries')
+    assert len(index['UGID']) == len(index['ADM0_A3'])
+    assert 'FRA' in index['ADM0_A3']
+    assert os.path.isfile(os.path.join(config.cache_path(), 'shapefiles', 'countries.json'))
+
+    # The persisted index is used once the in-memory index is cleared.
+    subset._SHP_INDEX.clear()
+    assert subset.get_shp_index('countries') == index
+
+
+def test_get_geom():
+    assert subset.get_geom('FRA') == 'countries'
+    assert subset.get_geom('Africa') == 'continents'
+    assert subset.get_geom('DE.HH') == 'extremoscope'
+    assert subset.get_geom('XXX') is None
+
+
+def test_get_ugid():
+    index = subset.get_shp_index('countries')
+    ugid = index['UGID'][index['ADM0_A3'].index('FRA')]
+    assert subset.get_ugid('FRA', geom='countries') == [ugid]
+    assert subset.get_ugid(None) is None
+
+
+def test_countries():
+    assert 'FRA' in subset.countries()
+    assert 'Africa' in subset.continents()
+    assert 'DE.HH' in subset.eu_regions()
+
+
+def test_resolve_polygons():
+    resolved = subset.resolve_polygons(['FRA', 'Africa', 'XXX'])
+    assert resolved['FRA'] == ('countries', subset.get_ugid('FRA', geom='countries'))
+    assert resolved['Africa'] == ('continents', subset.get_ugid('Africa', geom='continents'))
+    assert resolved['XXX'] == (None, None)
+
+
+def test_clipping_processes():
+    from flyingpigeon.tests.common import TESTDATA
+    from flyingpigeon.utils import local_path
+
+    resource = [local_path(TESTDATA['cordex_tasmax_2006_nc']),
+                local_path(TESTDATA['cordex_tasmax_2007_nc'])]
+    serial = subset.clipping(resource=resource, polygons=['DEU', 'FRA'], processes=1,
+                             dir_output=tempfile.mkdtemp())
+    parallel = subset.clipping(resource=resource, polygons=['DEU', 'FRA'], processes=2,
+                               dir_output=tempfile.mkdtemp())
+    assert len(serial) == 2
+    assert [os.path.basename(p) for p in parallel] == [os.path.basename(p) for p in serial]
+    assert 'DEU' in os.path.basename(parallel[0])
+
+
+def test_clipping_single_read():
+    from flyingpigeon.tests.common import TESTDATA
+    from flyingpigeon.utils import local_path
+
+    resource = [local_path(TESTDATA['cordex_tasmax_2006_nc']),
+                local_path(TESTDATA['cordex_tasmax_2007_nc'])]
+    polygons = ['DEU', 'FRA', 'DE.HH']
+    default = subset.clipping(resource=resource, polygons=polygons, dir_output=tempfile.mkdtemp())
+    single = subset.clipping(resource=resource, polygons=polygons, single_read=True,
+                             dir_output=tempfile.mkdtemp())
+    assert len(single) == 3
+    assert [os.path.basename(p) for p in single] == [os.path.basename(p) for p in default]
+
+
+def test_clipping_single_read_duplicated_code():
+    from flyingpigeon.tests.common import TESTDATA
+    from flyingpigeon.utils import local_path
+
+    # CH.AG has two polygons in the extremoscope shapefile.
+    resource = local_path(TESTDATA['cordex_tasmax_2006_nc'])
+    polygons = ['CH.AG', 'DE.HH']
+    assert len(subset.resolve_polygons(polygons)['CH.AG'][1]) == 2
+    default = subset.clipping(resource=resource, polygons=polygons, dir_output=tempfile.mkdtemp())
+    single = subset.clipping(resource=resource, polygons=polygons, single_read=True,
+                             dir_output=tempfile.mkdtemp())
+    assert len(single) == len(default) == 2
+    for a, b in zip(single, default):
+        with nc.Dataset(a) as ds_a, nc.Dataset(b) as ds_b:
+            np.testing.assert_array_equal(ds_a.variables['tasmax'][:], ds_b.variables['tasmax'][:])
+
+
+def test_clipping_unknown_polygon():
+    from flyingpigeon.tests.common import TESTDATA
+    from flyingpigeon.utils import local_path
+
+    resource = local_path(TESTDATA['cordex_tasmax_2006_nc'])
+    assert subset.clipping(resource=resource, polygons=['XYZ'], dir_output=tempfile.mkdtemp()) == []
+    assert subset.clipping(resource=resource, polygons=['XYZ'], mosaic=True, dir_output=tempfile.mkdtemp()) == []
+
+    # Known polygons are still clipped.
+    geom_files = subset.clipping(resource=resource, polygons=['XYZ', 'DEU'], dir_output=tempfile.mkdtemp())
+    assert len(geom_files) == 1
+    assert 'DEU' in os.path.basename(geom_files[0])
+
+
+def write_landsea(path, sftlf=((0., .4), (.6, 1.)), resource=None):
+    """Write a land area fraction file, or a (time, lat, lon) resource if `resource` is given."""
+    with nc.Dataset(path, 'w') as ds:
+        ds.createDimension('time', None)
+        ds.createDimension('lat', 2)
+        ds.createDimension('lon', 2)
+        for name in ['lat', 'lon']:
+            ds.createVariable(name, 'f8', (name,))[:] = [0., 1.]
+        if resource is None:
+            ds.createVariable('sftlf', 'f4', ('lat', 'lon'))[:] = sftlf
+        else:
+            ds.createVariable('time', 'f8', ('time',))[:] = [0, 1, 2]
+            v = ds.createVariable('tas', 'f4', ('time', 'lat', 'lon'))
+            v.units = 'K'
+            v[:] = resource
+    return path
+
+
+def test_masking():
+    sftlf = write_landsea(tempfile.mktemp(suffix='.nc'))
+    resource = write_landsea(tempfile.mktemp(suffix='.nc'), resource=np.arange(12.).reshape(3, 2, 2))
+    prefix = os.path.join(tempfile.mkdtemp(), 'masked')
+
+    land = subset.masking(resource, sftlf, land_area=True, prefix=prefix + '_land')
+    sea = subset.masking(resource, sftlf, land_area=False, prefix=prefix + '_sea')
+    with nc.Dataset(land) as ds:
+        tas = ds.variables['tas']
+        assert tas.units == 'K'
+        np.testing.assert_array_equal(tas[:].mask, [[[True, True], [False, False]]] * 3)
+        np.testing.assert_array_equal(tas[:, 1], [[2., 3.], [6., 7.], [10., 11.]])
+        np.testing.assert_array_equal(ds.variables['time'][:], [0, 1, 2])
+    with nc.Dataset(sea) as ds:
+        np.testing.assert_array_equal(ds.variables['tas'][:].mask, [[[False, False], [True, True]]] * 3)
+
+    # The mask is computed once.
+    assert subset.get_landsea_mask(sftlf) is subset.get_landsea_mask(sftlf)
@@ -5,6 +5,8 @@ from .common import TESTDATA
 import os.path
 import tempfile
 import tarfile
+import threading
+import time
 import zipfile
 from netCDF4 import Dataset
 
@@ -196,3 +198,95 @@ def test_calc_grouping():
     # check invalid value: should raise an exception
     with pytest.raises(Exception) as e_info:
         indices.calc_grouping('unknown') == ['year']
+
+
+def test_stage_resources():
+    resources = [local_path(TESTDATA['cmip5_tasmax_2006_nc']),
+                 local_path(TESTDATA['cmip5_tasmax_2007_nc'])]
+    counts = []
+    staged = utils.stage_resources(resources, threads=2, progress=lambda i, n: counts.append((i, n)))
+    assert staged == resources
+    assert counts == [(1, 2), (2, 2)]
+
+    # Errors are reported with the traceback of the staging.
+    with pytest.raises(Exception) as e_info:
+        utils.stage_resources(resources + ['http://localhost:1/missing.nc'], threads=2)
+    assert 'Traceback' in str(e_info.value)
+
+
+def cookie_request(token):
+    class Request(object):
+        class http_request(object):
+            cookies = {'auth_tkt': token}
+    return Request()
+
+
+def read_cookie_jar():
+    """Return the content of the cookie jar netCDF reads from the working directory."""
+    with open('.daprc') as f:
+        jar = f.read().split('= ')[1]
+    with open(jar) as f:
+        return f.read()
+
+
+def test_cookie_netcdf_transfer(tmpdir):
+    seen = {}
+
+    def transfer(token, hostname):
+        with utils.CookieNetCDFTransfer(cookie_request(token), [hostname]):
+            jars = []
+            for _ in range(20):
+                jars.append(read_cookie_jar())
+                time.sleep(0.001)
+            seen[token] = jars
+
+    with tmpdir.as_cwd():
+        threads = [threading.Thread(target=transfer, args=('secret{}'.format(i), '{}.org'.format(i)))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert os.getcwd() == str(tmpdir)
+
+    # Each transfer only ever sees its own credentials.
+    assert len(seen) == 4
+    for i in range(4):
+        for jar in seen['secret{}'.format(i)]:
+            assert jar == '{}.org\tFALSE\t/\tFALSE\t0\tauth_tkt\tsecret{}\n'.format(i, i)
+    assert tmpdir.listdir() == []
+
+
+def _transfer_process(token, workdir, entered, other):
+    with utils.CookieNetCDFTransfer(cookie_request(token), ['a.org'], workdir):
+        entered.set()
+        # Both transfers run at the same time.
+        assert other.wait(10)
+        assert token in read_cookie_jar()
+
+
+def test_cookie_netcdf_transfer_processes(tmpdir):
+    import multiprocessing
+
+    events = [multiprocessing.Event(), multiprocessing.Event()]
+    processes = [multiprocessing.Process(target=_transfer_process,
+                                         args=(token, str(tmpdir.mkdir(token)), events[i], events[1 - i]))
+                 for i, token in enumerate(['secret0', 'secret1'])]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    assert [p.exitcode for p in processes] == [0, 0]
+
+
+def test_nc_header():
+    nc = local_path(TESTDATA['cordex_tasmax_2006_nc'])
+    record = utils.nc_header(nc)
+    assert utils.nc_header(TESTDATA['cordex_tasmax_2006_nc']) is record
+    assert record['main_variables'] == ['tasmax']
+    assert record['timerange'] == ('20060215', '20061216')
+    assert 'time_bnds' in record['bounds']
+
+    with Dataset(nc) as ds:
+        assert utils.guess_main_variables(ds) == utils.guess_main_variables(nc)
+    assert utils.get_calendar(nc) == ('proleptic_gregorian', record['units'])
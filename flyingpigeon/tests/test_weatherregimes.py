@@ -0,0 +1,37 @@
+import numpy as np
+import statsmodels.api as sm
+
+from flyingpigeon import weatherregimes as wr
+
+
+def test_smooth_annual_cycle():
+    np.random.seed(0)
+    ts = 365
+    cycle = 10 * np.sin(2 * np.pi * np.arange(ts) / ts)[:, np.newaxis, np.newaxis]
+    values = cycle + np.random.randn(ts, 3, 4) + .2 * np.random.standard_cauchy((ts, 3, 4))
+    x = np.linspace(1, ts * 3, num=ts * 3, endpoint=True)
+
+    for frac in [.05, .2]:
+        out = wr.smooth_annual_cycle(values, frac=frac)
+        assert out.shape == values.shape
+        for lat in range(3):
+            for lon in range(4):
+                expected = sm.nonparametric.lowess(np.tile(values[:, lat, lon], 3), x, frac=frac)[ts:ts * 2, 1]
+                np.testing.assert_allclose(out[:, lat, lon], expected, atol=1e-8)
+
+
+def test_lowess_nan():
+    y = np.vstack([np.arange(20.), np.arange(20.)])
+    y[1, 3] = np.nan
+    out = wr.lowess(y, np.arange(20.), frac=.5)
+    np.testing.assert_allclose(out[0], y[0], atol=1e-8)
+    assert np.isnan(out[1]).all()
+
+
+def test_smooth_annual_cycle_processes():
+    np.random.seed(1)
+    values = np.random.randn(60, 5, 3)
+    serial = wr.smooth_annual_cycle(values, frac=.3)
+    parallel = wr.smooth_annual_cycle(values, frac=.3, processes=4)
+    np.testing.assert_allclose(parallel, serial)
+    assert not np.allclose(wr.smooth_annual_cycle(values, frac=.1, processes=4), serial)
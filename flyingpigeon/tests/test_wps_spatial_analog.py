@@ -125,7 +125,7 @@ class TestDissimilarity(TestBase):
                                                                         p4]]
         candidate = ocgis.MultiRequestDataset(can)
 
-        fig, axes = plt.subplots(2, 3)
+        fig, axes = plt.subplots(2, 4)
         for i, dist in enumerate(dissimilarity.__all__):
 
             calc = [{'func': 'dissimilarity',
@@ -146,6 +146,81 @@ class TestDissimilarity(TestBase):
         plt.savefig(path)
         plt.close()
 
+    def get_dissimilarity(self, **kwds):
+        """Return the dissimilarity values over a 10x11 candidate grid."""
+        p1 = self.write_field_data('v1', ncol=1, nrow=1)
+        p3 = self.write_field_data('v1', ncol=11, nrow=10, dir='c')
+
+        ref_range = [dt.datetime(2000, 3, 1), dt.datetime(2000, 3, 31)]
+        reference = ocgis.RequestDataset(p1, time_range=ref_range).get()
+
+        cand_range = [dt.datetime(2000, 8, 1), dt.datetime(2000, 8, 31)]
+        candidate = ocgis.RequestDataset(p3, time_range=cand_range)
+
+        kwds.update(target=reference, candidate=('v1',))
+        calc = [{'func': 'dissimilarity', 'name': 'output', 'kwds': kwds}]
+        ret = OcgOperations(dataset=candidate, calc=calc).execute()
+        return ret.get_element()['dissimilarity'].get_value().squeeze()
+
+    def test_blocks(self):
+        """The values do not depend on the size of the blocks read."""
+        expected = self.get_dissimilarity(dist='zech_aslan')
+        actual = self.get_dissimilarity(dist='zech_aslan', max_memory=1)
+        np.testing.assert_array_almost_equal(actual, expected)
+
+    def test_screen(self):
+        expected = self.get_dissimilarity(dist='kldiv')
+        actual = self.get_dissimilarity(dist='kldiv', screen=10, max_memory=1)
+        assert np.isfinite(actual).sum() == 10
+        ok = np.isfinite(actual)
+        np.testing.assert_array_almost_equal(actual[ok], expected[ok])
+
+    def test_block_rows(self):
+        """Blocks hold whole chunks of the candidate file along the rows."""
+        import netCDF4 as nc
+        from flyingpigeon.ocgisDissimilarity import Dissimilarity
+
+        path = self.get_temporary_file_path('chunked.nc')
+        with nc.Dataset(path, 'w') as ds:
+            ds.createDimension('time', 10)
+            ds.createDimension('lat', 40)
+            ds.createDimension('lon', 5)
+            t = ds.createVariable('time', 'f8', ('time',))
+            t.units = 'days since 2000-01-01'
+            t[:] = np.arange(10)
+            ds.createVariable('lat', 'f8', ('lat',))[:] = np.arange(40)
+            ds.createVariable('lon', 'f8', ('lon',))[:] = np.arange(5)
+            ds.createVariable('v1', 'f4', ('time', 'lat', 'lon'), chunksizes=(10, 7, 5))[:] = 1.
+            ds.createVariable('v2', 'f4', ('time', 'lat', 'lon'), contiguous=True)[:] = 1.
+
+        variable = ocgis.RequestDataset(path, variable='v1').get()['v1']
+        # One row of values takes 3 * 5 * 10 * 8 bytes, the budget holds 20 rows.
+        assert Dissimilarity._get_block_rows_(variable, 0, 1, 20 * 1200) == 14
+        assert Dissimilarity._get_block_rows_(variable, 0, 1, 5 * 1200) == 5
+
+        variable = ocgis.RequestDataset(path, variable='v2').get()['v2']
+        assert Dissimilarity._get_block_rows_(variable, 0, 1, 20 * 1200) == 20
+
+    def test_tiled_screen(self):
+        """Tiled and serial computations select the same cells."""
+        from flyingpigeon.spatial_analog import tiled_dissimilarity
+        import netCDF4 as nc
+
+        p1 = self.write_field_data('v1', ncol=1, nrow=1)
+        p3 = self.write_field_data('v1', ncol=11, nrow=10, dir='c')
+        ref_range = [dt.datetime(2000, 3, 1), dt.datetime(2000, 3, 31)]
+        reference = ocgis.RequestDataset(p1, time_range=ref_range).get()
+        cand_range = [dt.datetime(2000, 8, 1), dt.datetime(2000, 8, 31)]
+
+        for dist in ['seuclidean', 'kldiv']:
+            expected = self.get_dissimilarity(dist=dist, screen=10)
+            path = tiled_dissimilarity(p3, reference, ['v1'], dist, cand_range, workers=2, tile_size=4,
+                                       dir_output=self.current_dir_output, screen=10)
+            with nc.Dataset(path) as ds:
+                actual = np.ma.filled(ds.variables['dissimilarity'][:], np.nan)
+            assert np.isfinite(actual).sum() == 10
+            np.testing.assert_array_almost_equal(actual, expected)
+
     @pytest.mark.skip(reason="ocgis exception")
     def test_simple(self):
         p1 = self.write_field_data('v1', ncol=1, nrow=1)
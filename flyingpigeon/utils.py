@@ -5,20 +5,51 @@ from flyingpigeon import config
 from eggshell.general.utils import archive, archiveextract, check_creationtime, download, FreeMemory, download_file, \
     searchfile, local_path, make_dirs, rename_complexinputs, prepare_static_folder
 from eggshell.ocg.utils import calc_grouping, has_variable, temp_groups
-from eggshell.nc.utils import get_coordinates, get_values, get_time, get_variable, get_calendar, get_timerange, \
-    get_index_lat, get_frequency, get_domain, sort_by_filename, sort_by_time, unrotate_pole, rename_variable
+from eggshell.nc.utils import get_coordinates, get_values, get_time, get_index_lat, get_frequency, get_domain, \
+    sort_by_filename, sort_by_time, unrotate_pole, rename_variable
+from eggshell.nc.utils import get_variable as _get_variable
 from eggshell.esgf.utils import aggregations, drs_filename, ATTRIBUTE_TO_FACETS_MAP, search_landsea_mask_by_esgf
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import os
-from netCDF4 import Dataset
+import shutil
+import tempfile
+import threading
+import traceback
+from netCDF4 import Dataset, num2date
+import numpy as np
 import requests
 
+from flyingpigeon._compat import urlparse
+from flyingpigeon.cache import FileCache, file_lock, link, make_key, source_signature
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
 GROUPING = temp_groups.keys()
 
+# OPeNDAP support of the url prefixes probed in this process, keyed by (scheme, netloc, directory).
+_OPENDAP_PREFIXES = {}
+
+# Seconds to wait for the answer to an OPeNDAP probe.
+_PROBE_TIMEOUT = 30
+
+# The netCDF library is not thread-safe.
+_NETCDF_LOCK = threading.Lock()
+# Held by the cookie transfers of this process, see `CookieNetCDFTransfer`.
+_TRANSFER_LOCK = threading.Lock()
+
+# Header records of the NetCDF files read in this process, keyed by file signature,
+# least recently used first.
+_HEADERS = OrderedDict()
+_HEADERS_LOCK = threading.Lock()
+_MAX_HEADERS = 1024
+
 
 def guess_main_variables(ncdataset):
     """Guess main variables in a NetCDF file.
-    :param ncdataset: netCDF4.Dataset
+    :param ncdataset: netCDF4.Dataset, or path to a NetCDF file answered from its cached header
     :return list: names of main variables
     Notes
     -----
@@ -26,15 +57,21 @@ def guess_main_variables(ncdataset):
     time, lon, lat variables and variables that are defined as bounds are
     automatically ignored.
     """
+    if not isinstance(ncdataset, Dataset):
+        return list(nc_header(ncdataset)['main_variables'])
+    return _main_variables(dict((name, dict(shape=var.shape, bounds=getattr(var, 'bounds', None)))
+                                for name, var in ncdataset.variables.items()))
+
 
+def _main_variables(variables):
     var_candidates = []
     bnds_variables = []
-    for var_name in ncdataset.variables:
+    for var_name in variables:
         if var_name in ['time', 'lon', 'lat']:
             continue
-        ncvar = ncdataset.variables[var_name]
-        if hasattr(ncvar, 'bounds'):
-            bnds_variables.append(ncvar.bounds)
+        ncvar = variables[var_name]
+        if ncvar['bounds'] is not None:
+            bnds_variables.append(ncvar['bounds'])
         var_candidates.append(var_name)
     var_candidates = list(set(var_candidates) - set(bnds_variables))
 
@@ -43,87 +80,385 @@ def guess_main_variables(ncdataset):
     size = -1
     main_variables = []
     for var_name in var_candidates:
-        ncvar = ncdataset.variables[var_name]
-        if len(ncvar.shape) > nd:
+        shape = variables[var_name]['shape']
+        var_size = int(np.prod(shape))
+        if len(shape) > nd:
             main_variables = [var_name]
-            nd = len(ncvar.shape)
-            size = ncvar.size
-        elif (len(ncvar.shape) == nd) and (ncvar.size > size):
+            nd = len(shape)
+            size = var_size
+        elif (len(shape) == nd) and (var_size > size):
             main_variables = [var_name]
-            size = ncvar.size
-        elif (len(ncvar.shape) == nd) and (ncvar.size == size):
+            size = var_size
+        elif (len(shape) == nd) and (var_size == size):
             main_variables.append(var_name)
     return main_variables
 
 
+def nc_header(resource):
+    """Return a compact record of the header of a NetCDF file.
+
+    The header is parsed once per file, identified by its path, modification
+    time and size, and the record is kept in memory for later calls.
+
+    :param resource: path or url of a NetCDF file
+    :return dict: `dimensions` sizes, `variables` dimensions, shape, bounds and data variable flag,
+                  time `calendar` and `units`, `timerange` as (start, end) 'YYYYMMDD' strings,
+                  `bounds` variables and `main_variables`
+    """
+    if resource.startswith('file://'):
+        resource = local_path(resource)
+    key = source_signature(resource)
+    with _HEADERS_LOCK:
+        if key in _HEADERS:
+            record = _HEADERS.pop(key)
+            _HEADERS[key] = record
+            return record
+
+    with _NETCDF_LOCK:
+        with Dataset(resource, 'r') as ds:
+            record = _read_header(ds)
+
+    with _HEADERS_LOCK:
+        _HEADERS[key] = record
+        while len(_HEADERS) > _MAX_HEADERS:
+            _HEADERS.popitem(last=False)
+    return record
+
+
+def _read_header(ds):
+    # Variables describing other variables, which are not data.
+    described = set(ds.dimensions)
+    for var in ds.variables.values():
+        for attr in ['bounds', 'coordinates', 'grid_mapping', 'climatology']:
+            described.update(str(getattr(var, attr, '')).split())
+
+    variables = dict((name, dict(dimensions=var.dimensions, shape=var.shape,
+                                 bounds=getattr(var, 'bounds', None),
+                                 data=name not in described and var.ndim > 0))
+                     for name, var in ds.variables.items())
+
+    calendar, units, timerange = None, None, (None, None)
+    if 'time' in ds.variables:
+        time = ds.variables['time']
+        units = getattr(time, 'units', None)
+        calendar = getattr(time, 'calendar', None)
+        if len(time) and units is not None:
+            dates = num2date([time[0], time[-1]], units, calendar or 'standard')
+            timerange = tuple('%s%s%s' % (d.year, str(d.month).zfill(2), str(d.day).zfill(2)) for d in dates)
+
+    return dict(dimensions=dict((name, len(dim)) for name, dim in ds.dimensions.items()),
+                variables=variables,
+                calendar=calendar,
+                units=units,
+                timerange=timerange,
+                bounds=sorted(v['bounds'] for v in variables.values() if v['bounds'] is not None),
+                main_variables=_main_variables(variables))
+
+
+def get_variable(resource):
+    """Detect the processable variable name in NetCDF files from their cached header.
+
+    :param resource: NetCDF file or files of one dataset
+    :return str: variable name, or tuple of names if the dataset holds several data variables
+    """
+    if type(resource) == list:
+        resource = resource[0]
+    record = nc_header(resource)
+    names = [name for name in record['main_variables'] if record['variables'][name]['data']]
+    if len(names) == 1:
+        return names[0]
+    # Leave ambiguous cases to the ocgis detection.
+    return _get_variable(resource)
+
+
+def get_calendar(resource, variable=None):
+    """Return the calendar and units of the timestamps, from the cached header.
+
+    :param resource: NetCDF file or files of one dataset
+    :return str: calendar, unit
+    """
+    if type(resource) == list:
+        resource = resource[0]
+    record = nc_header(resource)
+    return str(record['calendar']), str(record['units'])
+
+
+def get_timerange(resource):
+    """Return the first and last dates of NetCDF files, from their cached headers.
+
+    :param resource: NetCDF file or files of one dataset
+    :return str: start, end as 'YYYYMMDD'
+    """
+    if type(resource) != list:
+        resource = [resource]
+    ranges = [nc_header(r)['timerange'] for r in resource]
+    starts = [r[0] for r in ranges if r[0] is not None]
+    ends = [r[1] for r in ranges if r[1] is not None]
+    if not starts:
+        return None, None
+    return min(starts), max(ends)
+
+
 def opendap_or_download(resource, auth_tkt_cookie={}, output_path=None,
-                        max_nbytes=10000000000):
+                        max_nbytes=10000000000, chunk_size=None):
     """Check for OPEnDAP support, if not download the resource.
+
+    The OPeNDAP support is probed once per host and directory, see
+    `opendap_supported`, and netCDF calls are serialized so that resources
+    can be staged from several threads.
+    Downloads go through the shared download store, see `cached_download`,
+    and are linked into a sub-directory of `output_path` specific to the url.
+
     :param resource: url of a NetCDF resource
     :param output_path: where to save the non-OPEnDAP resource
     :param max_nbytes: maximum file size for download, default: 1 gb
+    :param chunk_size: download chunk size in bytes, defaults to `config.download_chunk_size()` KiB
     :return str: the original url if OPEnDAP is supported or path of saved file
     """
+    if opendap_supported(resource, auth_tkt_cookie):
+        return resource
+
+    if not output_path:
+        output_path = os.getcwd()
+    output_dir = os.path.join(output_path, make_key(resource)[:16])
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    output = os.path.join(output_dir, os.path.basename(resource))
+
+    cached = cached_download(resource, auth_tkt_cookie=auth_tkt_cookie, max_nbytes=max_nbytes,
+                             chunk_size=chunk_size, output=output)
+    if cached == output:
+        return output
+    return link(cached, output)
+
+
+def download_cache():
+    """Return the shared store of downloaded files."""
+    return FileCache('downloads', config.download_cache_size() * 1024 ** 2)
+
+
+def cached_download(url, auth_tkt_cookie={}, max_nbytes=10000000000, chunk_size=None, output=None):
+    """Download a NetCDF file into the shared download store.
+
+    Entries are keyed by the url and its ETag or Last-Modified header, and
+    are reused as long as the server reports the same validator. Interrupted
+    transfers are resumed with HTTP range requests. Concurrent downloads of
+    the same url wait on a file lock for the first one to complete. Files are
+    validated by opening them as NetCDF before entering the store.
+    Files without validator, which could never be reused, and files larger
+    than the store are moved to `output` instead.
+
+    :param url: url of a NetCDF resource
+    :param max_nbytes: maximum file size for download, default: 1 gb
+    :param chunk_size: download chunk size in bytes, defaults to `config.download_chunk_size()` KiB
+    :param output: path of the files kept out of the store, defaults to the url file name in the
+                   current directory
+    :return str: path to the file in the store, or `output`
+    """
+    if chunk_size is None:
+        chunk_size = config.download_chunk_size() * 1024
+    cache = download_cache()
 
+    response = _get(url, auth_tkt_cookie, max_nbytes)
     try:
-        nc = Dataset(resource, 'r')
-        nc.close()
-    except Exception:
-        response = requests.get(resource, cookies=auth_tkt_cookie, stream=True)
-        if response.status_code == 401:
-            raise Exception("Not Authorized")
-
-        if 'Content-Length' in response.headers.keys():
-            if int(response.headers['Content-Length']) > max_nbytes:
-                raise IOError("File too large to download.")
-        chunk_size = 16 * 1024
-        if not output_path:
-            output_path = os.getcwd()
-        output_file = os.path.join(output_path, os.path.basename(resource))
-        with open(output_file, 'wb') as f:
-            for chunk in response.iter_content(chunk_size):
-                if chunk:
-                    f.write(chunk)
+        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        key = make_key(url, validator)
+        with file_lock(cache.path(key, '.lock')):
+            # Without validator, there is no telling whether a stored file is up to date.
+            path = cache.get(key) if validator else None
+            if path is not None:
+                return path
+
+            part = cache.path(key, '.part')
+            offset = os.path.getsize(part) if validator and os.path.exists(part) else 0
+            if offset:
+                LOGGER.info('Resuming download of {} at byte {}'.format(url, offset))
+                response.close()
+                response = _get(url, auth_tkt_cookie, max_nbytes,
+                                headers={'Range': 'bytes={}-'.format(offset), 'If-Range': validator})
+                if response.status_code == 416:
+                    response.close()
+                    response = _get(url, auth_tkt_cookie, max_nbytes)
+                if response.status_code != 206:
+                    # The file changed, or the server ignores ranges.
+                    offset = 0
+
+            with open(part, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size):
+                    if chunk:
+                        f.write(chunk)
+            try:
+                with _NETCDF_LOCK:
+                    nc = Dataset(part, 'r')
+                    nc.close()
+            except:
+                os.remove(part)
+                raise IOError("This does not appear to be a valid NetCDF file.")
+            if validator and os.path.getsize(part) <= cache.max_size:
+                return cache.put(key, part, move=True)
+
+            LOGGER.info('Download of {} kept out of the store'.format(url))
+            if output is None:
+                output = os.path.join(os.getcwd(), os.path.basename(urlparse.urlparse(url).path))
+            shutil.move(part, output)
+            return output
+    finally:
+        response.close()
+
+
+def _get(url, auth_tkt_cookie, max_nbytes, headers=None):
+    response = requests.get(url, cookies=auth_tkt_cookie, stream=True, headers=headers)
+    if response.status_code == 401:
+        response.close()
+        raise Exception("Not Authorized")
+
+    if 'Content-Length' in response.headers.keys():
+        if int(response.headers['Content-Length']) > max_nbytes:
+            response.close()
+            raise IOError("File too large to download.")
+    return response
+
+
+def opendap_supported(resource, auth_tkt_cookie={}):
+    """Return whether a resource is served through OPeNDAP.
+
+    Only the `.dds` endpoint of the resource is requested. The result is
+    reused for the other resources sharing the same host and directory,
+    since servers such as THREDDS expose OPeNDAP and plain HTTP access
+    under different path prefixes of the same host. Local paths are used
+    as is. Only definite answers are reused, a server error or a missing
+    authentication is probed again on the next call.
+
+    :param resource: url of a NetCDF resource
+    :return bool: True if the resource can be opened remotely
+    """
+    parsed = urlparse.urlparse(resource)
+    if parsed.scheme not in ('http', 'https'):
+        return True
+
+    prefix = (parsed.scheme, parsed.netloc, os.path.dirname(parsed.path))
+    if prefix not in _OPENDAP_PREFIXES:
         try:
-            nc = Dataset(output_file, 'r')
-            nc.close()
-        except:
-            raise IOError("This does not appear to be a valid NetCDF file.")
-        return output_file
-    return resource
+            response = requests.get(resource + '.dds', cookies=auth_tkt_cookie, stream=True,
+                                    timeout=_PROBE_TIMEOUT)
+        except requests.RequestException:
+            return False
+        try:
+            if response.status_code == 200:
+                head = next(response.iter_content(64), b'')
+                _OPENDAP_PREFIXES[prefix] = head.lstrip().startswith(b'Dataset')
+            elif response.status_code in (400, 404):
+                _OPENDAP_PREFIXES[prefix] = False
+            else:
+                # Authentication or server errors, the answer may differ later.
+                return False
+        finally:
+            response.close()
+    return _OPENDAP_PREFIXES[prefix]
+
+
+def stage_resources(resources, auth_tkt_cookie={}, output_path=None, threads=None, progress=None):
+    """Run `opendap_or_download` on resources with a pool of threads.
+
+    :param resources: urls of NetCDF resources
+    :param output_path: where to save the non-OPEnDAP resources
+    :param threads: number of concurrent stagings, defaults to `config.staging_threads()`
+    :param progress: function called with the number of resources staged so far and the number of resources
+    :return list: the original url or path of saved file of each resource, in order
+    """
+    if threads is None:
+        threads = config.staging_threads()
+
+    def stage(resource):
+        try:
+            return opendap_or_download(resource, auth_tkt_cookie=auth_tkt_cookie, output_path=output_path), None
+        except Exception:
+            return None, traceback.format_exc()
+
+    staged = []
+    pool = ThreadPool(max(1, min(threads, len(resources))))
+    try:
+        for path, error in pool.imap(stage, resources):
+            if error is not None:
+                raise Exception(error)
+            staged.append(path)
+            if progress is not None:
+                progress(len(staged), len(resources))
+    finally:
+        pool.terminate()
+    return staged
 
 
 class CookieNetCDFTransfer:
-    def __init__(self, request, opendap_hostnames=[]):
+    """Make the authentication cookie of a request available to netCDF.
+
+    netCDF reads the cookie jar named in the `.daprc` file of the working
+    directory. Both files are written to a working directory of the request,
+    which is the working directory of the process during the transfer.
+    Requests executed in their own process, as pywps does for asynchronous
+    requests, therefore never share credentials and run concurrently. The
+    working directory being shared by the threads of a process, transfers
+    from threads of a same process run one at a time.
+
+    :param request: pywps request
+    :param opendap_hostnames: hosts receiving the cookie
+    :param workdir: working directory of the request, a temporary directory by default
+    """
+    def __init__(self, request, opendap_hostnames=[], workdir=None):
         self.request = request
         self.cookie = None
         self.daprc_fn = '.daprc'
         self.auth_cookie_fn = 'auth_cookie'
         self.opendap_hostnames = opendap_hostnames
+        self.workdir = workdir
+        self._tmpdir = None
+        self._curdir = None
 
     def __enter__(self):
         self.cookie = get_auth_cookie(self.request)
 
         if self.cookie:
-            with open(self.daprc_fn, 'w') as f:
-                f.write('HTTP.COOKIEJAR = auth_cookie')
-
-            with open(self.auth_cookie_fn, 'w') as f:
-                for opendap_hostname in self.opendap_hostnames:
-                    for key, value in self.cookie.items():
-                        f.write('{domain}\t{access_flag}\t{path}\t{secure}\t{expiration}\t{name}\t{value}\n'.format(
-                            domain=opendap_hostname,
-                            access_flag='FALSE',
-                            path='/',
-                            secure='FALSE',
-                            expiration=0,
-                            name=key,
-                            value=value))
+            _TRANSFER_LOCK.acquire()
+            try:
+                if self.workdir is None:
+                    self.workdir = self._tmpdir = tempfile.mkdtemp(prefix='opendap_')
+                self.daprc_fn = os.path.join(self.workdir, '.daprc')
+                self.auth_cookie_fn = os.path.join(self.workdir, 'auth_cookie')
+                with open(self.auth_cookie_fn, 'w') as f:
+                    for opendap_hostname in self.opendap_hostnames:
+                        for key, value in self.cookie.items():
+                            f.write('{domain}\t{access_flag}\t{path}\t{secure}\t{expiration}\t{name}\t{value}\n'.format(
+                                domain=opendap_hostname,
+                                access_flag='FALSE',
+                                path='/',
+                                secure='FALSE',
+                                expiration=0,
+                                name=key,
+                                value=value))
+
+                with open(self.daprc_fn, 'w') as f:
+                    f.write('HTTP.COOKIEJAR = {}'.format(self.auth_cookie_fn))
+
+                self._curdir = os.getcwd()
+                os.chdir(self.workdir)
+            except Exception:
+                self.__exit__(None, None, None)
+                raise
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.cookie:
-            os.remove(self.daprc_fn)
-            os.remove(self.auth_cookie_fn)
+            try:
+                if self._curdir is not None:
+                    os.chdir(self._curdir)
+                    self._curdir = None
+                for fn in (self.daprc_fn, self.auth_cookie_fn):
+                    if os.path.exists(fn):
+                        os.remove(fn)
+                if self._tmpdir is not None:
+                    shutil.rmtree(self._tmpdir, ignore_errors=True)
+                    self.workdir = self._tmpdir = None
+            finally:
+                _TRANSFER_LOCK.release()
 
 
 def get_auth_cookie(pywps_request):
@@ -1,6 +1,10 @@
-import statsmodels.api as sm
-from numpy import tile, empty, linspace
+from multiprocessing import Pool
+import os
 
+import numpy as np
+from numpy import tile, linspace
+
+from flyingpigeon import config
 from flyingpigeon import utils
 from flyingpigeon.ocgis_module import call
 from tempfile import mkstemp
@@ -24,12 +28,126 @@ _TIMEREGIONS_ = {'JJA': {'month': [6, 7, 8]},
                  'all': None}
 
 
-def _smooth(ts_latlon):
-    y = tile(ts_latlon,3)
-    ts = len(ts_latlon)
+def lowess(y, x, frac=2. / 3, it=3, block=512):
+    """
+    Locally weighted linear regression of several series sharing the same x values.
+
+    This is the algorithm of `statsmodels.nonparametric.lowess` (with `delta=0`),
+    vectorized over the series. The neighbourhoods and their tricube weights only
+    depend on x, so they are computed once, and the weighted sums of all series are
+    matrix products with the weights matrix.
+
+    :param y: array (series, n) of values, series containing nan are returned as nan
+    :param x: increasing array (n,) of x values
+    :param frac: fraction of the data used when estimating each value
+    :param it: number of residual-based reweightings
+    :param block: number of series smoothed at once
+
+    :returns array: (series, n) smoothed values
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    k = min(max(int(frac * n + 1e-10), 2), n)
+
+    # Tricube weights of the k nearest neighbours of each point.
+    weights = np.zeros((n, n))
+    left = 0
+    for i in range(n):
+        while left + k < n and x[i] > (x[left] + x[left + k]) / 2.:
+            left += 1
+        radius = max(x[i] - x[left], x[left + k - 1] - x[i])
+        dist = np.abs(x[left:left + k] - x[i]) / radius
+        weights[i, left:left + k] = (1 - dist ** 3) ** 3
+    nonzero = (weights > 1e-12).astype(float)
+
+    # Centering x does not change the fits and avoids cancellations.
+    xc = x - x.mean()
+    out = np.empty_like(y)
+    for start in range(0, len(y), block):
+        yb = y[start:start + block]
+        rw = np.ones_like(yb)
+        for _ in range(it + 1):
+            s0, s1, s2, t0, t1 = np.split(np.concatenate([rw, rw * xc, rw * xc ** 2, rw * yb, rw * xc * yb])
+                                          .dot(weights.T), 5)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = s1 / s0
+                var = np.maximum(s2 / s0 - mean ** 2, 1e-12)
+                fit = t0 / s0 + (xc - mean) / var * (t1 / s0 - mean * t0 / s0)
+
+            # Regressions need at least two points with positive weight.
+            ok = (rw > 1e-12).astype(float).dot(nonzero.T) >= 2
+            fit = np.where(ok, fit, yb)
+
+            # Bisquare weights of the residuals.
+            resid = np.abs(yb - fit)
+            median = np.median(resid, axis=1)[:, np.newaxis]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                scaled = np.where(median == 0, resid > 0, resid / (6 * median))
+            rw = (1 - np.minimum(scaled, 1) ** 2) ** 2
+        out[start:start + block] = fit
+    out[np.isnan(y).any(axis=1)] = np.nan
+    return out
+
+
+def smooth_annual_cycle(values, frac=0.2, processes=1):
+    """
+    Smooth the annual cycle of all grid cells at once.
+
+    The annual cycle is repeated three times to avoid edge effects, smoothed with `lowess`,
+    and the middle repetition is returned. With several processes, the grid cells are
+    written to a memory-mapped file and each process smooths a block of its rows in place.
+
+    :param values: array (time, ...) of the annual cycle
+    :param frac: Number between 0-1 for strength of smoothing
+    :param processes: number of processes
+
+    :returns array: smoothed annual cycle, same shape as values
+    """
+    values = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    ts = values.shape[0]
+    cells = values.reshape(ts, -1).T
+    if processes <= 1 or len(cells) < 2:
+        return _smooth_cells(cells, frac).T.reshape(values.shape)
+
+    fd, path = mkstemp(suffix='.dat')
+    os.close(fd)
+    try:
+        mm = np.memmap(path, dtype=float, mode='w+', shape=cells.shape)
+        mm[:] = cells
+        mm.flush()
+        del mm
+
+        step = int(np.ceil(len(cells) / float(processes)))
+        blocks = [(path, cells.shape, frac, start, min(start + step, len(cells)))
+                  for start in range(0, len(cells), step)]
+        pool = Pool(processes=len(blocks))
+        try:
+            pool.map(_smooth_block, blocks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        out = np.array(np.memmap(path, dtype=float, mode='r', shape=cells.shape))
+    finally:
+        os.remove(path)
+    return out.T.reshape(values.shape)
+
+
+def _smooth_cells(cells, frac):
+    """Smooth annual cycles (cells, time) tiled three times, returning the middle repetition."""
+    ts = cells.shape[1]
     x = linspace(1, ts*3, num=ts*3, endpoint=True)
-    ys = sm.nonparametric.lowess(y, x, frac=0.2)[ts:ts*2, 1]
-    return ys
+    return lowess(tile(cells, 3), x, frac=frac)[:, ts:ts*2]
+
+
+def _smooth_block(args):
+    """Smooth in place rows [start, stop) of the memory-mapped annual cycles."""
+    path, shape, frac, start, stop = args
+    mm = np.memmap(path, dtype=float, mode='r+', shape=shape)
+    mm[start:stop] = _smooth_cells(np.array(mm[start:stop]), frac)
+    mm.flush()
+
 
 def get_anomalies(nc_file, frac=0.2, reference=None, method='ocgis', sseas='serial', variable=None):
     """
@@ -104,55 +222,18 @@ def get_anomalies(nc_file, frac=0.2, reference=None, method='ocgis', sseas='seri
         # variable = utils.get_variable(nc_file)
         ds = Dataset(nc_anual_cycle, mode='a')
         vals = ds.variables[variable]
-        vals_sm = empty(vals.shape)
-        ts = vals.shape[0]
-        x = linspace(1, ts*3, num=ts*3, endpoint=True)
 
         if ('serial' not in sseas):
-            # Multiprocessing =======================
-
-            from multiprocessing import Pool
-            pool = Pool()
-
-            valex = [0.]
-            valex = valex*vals.shape[1]*vals.shape[2]
-
-            # TODO redo with reshape
-            ind = 0
-            for lat in range(vals.shape[1]):
-                for lon in range(vals.shape[2]):
-                    valex[ind] = vals[:, lat, lon]
-                    ind += 1
-
-            LOGGER.debug('Start smoothing with multiprocessing')
-            # TODO fraction option frac=... is not used here
-            tmp_sm = pool.map(_smooth, valex)
-            pool.close()
-            pool.join()
-
-            # TODO redo with reshape
-            ind=0
-            for lat in range(vals.shape[1]):
-                for lon in range(vals.shape[2]):
-                    vals_sm[:, lat, lon] = tmp_sm[ind]
-                    ind+=1
+            # Multiprocessing over blocks of grid cells =======
+            processes = config.anomalies_processes()
+            LOGGER.debug('Start smoothing with %s processes' % processes)
+            vals_sm = smooth_annual_cycle(vals[:], frac=frac, processes=processes)
         else:
-            # Serial ==================================
-            vals_sm = empty(vals.shape)
-            for lat in range(vals.shape[1]):
-                for lon in range(vals.shape[2]):
-                    try:
-                        y = tile(vals[:, lat, lon], 3)
-                        # ys = smooth(y, window_size=91, order=2, deriv=0, rate=1)[ts:ts*2]
-                        ys = sm.nonparametric.lowess(y, x, frac=frac)[ts:ts*2, 1]
-                        vals_sm[:, lat, lon] = ys
-                    except:
-                        msg = 'failed for lat %s lon %s' % (lat, lon)
-                        LOGGER.exception(msg)
-                        raise Exception(msg)
-                LOGGER.debug('done for %s - %s ' % (lat, lon))
-
-        vals[:, :, :] = vals_sm[:, :, :]
+            # Serial, vectorized over the grid cells ===
+            vals_sm = smooth_annual_cycle(vals[:], frac=frac)
+
+        # Cells with missing values are smoothed to NaN, write them as missing.
+        vals[:, :, :] = np.ma.masked_invalid(vals_sm)
         ds.close()
         LOGGER.info('smothing of annual cycle done')
     except:
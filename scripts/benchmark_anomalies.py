@@ -0,0 +1,58 @@
+"""
+Benchmark of the annual cycle smoothing of `weatherregimes.get_anomalies`.
+
+The annual cycle is synthetic, on the NCEP reanalysis 2.5 degree grid over
+the default North Atlantic domain of the weather regimes processes
+(-80,50,20,70), with 366 days.
+
+    $ python scripts/benchmark_anomalies.py
+"""
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import statsmodels.api as sm
+
+from flyingpigeon import weatherregimes as wr
+
+
+def annual_cycle(days=366, lon=(-80, 50), lat=(20, 70), step=2.5):
+    """Return a noisy annual cycle of sea level pressure (days, lat, lon)."""
+    np.random.seed(0)
+    nlat = int((lat[1] - lat[0]) / step) + 1
+    nlon = int((lon[1] - lon[0]) / step) + 1
+    cycle = 1000 * np.cos(2 * np.pi * np.arange(days) / days)[:, np.newaxis, np.newaxis]
+    return 101325 + cycle * np.random.rand(1, nlat, nlon) + 300 * np.random.randn(days, nlat, nlon)
+
+
+def statsmodels_cells(values, frac):
+    """Per cell smoothing as implemented before the vectorized LOWESS."""
+    ts = values.shape[0]
+    x = np.linspace(1, ts * 3, num=ts * 3, endpoint=True)
+    out = np.empty(values.shape)
+    for lat in range(values.shape[1]):
+        for lon in range(values.shape[2]):
+            out[:, lat, lon] = sm.nonparametric.lowess(np.tile(values[:, lat, lon], 3), x, frac=frac)[ts:ts * 2, 1]
+    return out
+
+
+def smoothing(frac=.2, processes=(1, 2, 4)):
+    values = annual_cycle()
+    print('Annual cycle smoothing, shape={}, frac={}'.format(values.shape, frac))
+    print('{:>24} {:>10} {:>12}'.format('method', 'time (s)', 'max. diff.'))
+
+    tic = time.time()
+    reference = statsmodels_cells(values, frac)
+    print('{:>24} {:>10.2f} {:>12}'.format('statsmodels per cell', time.time() - tic, '-'))
+
+    for n in processes:
+        tic = time.time()
+        out = wr.smooth_annual_cycle(values, frac=frac, processes=n)
+        duration = time.time() - tic
+        print('{:>24} {:>10.2f} {:>12.2e}'.format('vectorized, {} proc.'.format(n), duration,
+                                                  np.abs(out - reference).max()))
+
+
+if __name__ == '__main__':
+    smoothing()
@@ -0,0 +1,91 @@
+"""
+Benchmarks for the dissimilarity metrics.
+
+Each case runs in a fresh process so that the peak resident memory reported
+by the operating system only reflects that case.
+
+    $ python scripts/benchmark_dissimilarity.py
+"""
+from __future__ import print_function
+
+import resource
+import time
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from flyingpigeon import dissimilarity as dd
+
+
+def ks_apply_along_axis(x, y):
+    """Kolmogorov-Smirnov statistic as implemented before the chunked quadrant counts."""
+    def pivot(x, y):
+        nx, d = x.shape
+        ny, d = y.shape
+        mf = (2 ** np.arange(d)).reshape(1, d, 1)
+        nquad = 2 ** d
+        ix = ((x.T <= np.atleast_3d(x)) * mf).sum(1)
+        iy = ((x.T <= np.atleast_3d(y)) * mf).sum(1)
+        cx = 1. * np.apply_along_axis(np.bincount, 0, ix, minlength=nquad) / nx
+        cy = 1. * np.apply_along_axis(np.bincount, 0, iy, minlength=nquad) / ny
+        return np.max(np.abs(cx - cy))
+
+    return max(pivot(x, y), pivot(y, x))
+
+
+def run(args):
+    """Return the metric value, duration and peak memory of one case."""
+    func, n, d = args
+    np.random.seed(0)
+    x = np.random.randn(n, d)
+    y = np.random.randn(n, d) + .1
+
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tic = time.time()
+    out = func(x, y)
+    duration = time.time() - tic
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+    return out, duration, peak / 1024.
+
+
+def kolmogorov_smirnov(sizes=(1000, 2000, 4000, 8000), d=2):
+    print('Kolmogorov-Smirnov, d={}'.format(d))
+    print('{:>6} {:>12} {:>12} {:>12} {:>12}'.format('n', 'before (s)', 'before (MB)', 'after (s)', 'after (MB)'))
+    for n in sizes:
+        row = []
+        for func in [ks_apply_along_axis, dd.kolmogorov_smirnov]:
+            pool = Pool(1, maxtasksperchild=1)
+            try:
+                out, duration, peak = pool.apply(run, ((func, n, d),))
+            except MemoryError:
+                duration, peak = np.nan, np.nan
+            finally:
+                pool.close()
+                pool.join()
+            row.extend([duration, peak])
+        print('{:>6} {:>12.2f} {:>12.1f} {:>12.2f} {:>12.1f}'.format(n, *row))
+
+
+def approximate_neighbors(n=20000, d=4, eps=(0, .5, 1, 2)):
+    """Compare the approximate nearest neighbour searches to the exact ones."""
+    for name in ['nearest_neighbor', 'kldiv']:
+        print('{}, n={}, d={}'.format(name, n, d))
+        print('{:>6} {:>12} {:>12} {:>14}'.format('eps', 'value', 'time (s)', 'rel. error (%)'))
+        exact = None
+        for e in eps:
+            func = partial(getattr(dd, name), eps=e)
+            pool = Pool(1, maxtasksperchild=1)
+            try:
+                out, duration, peak = pool.apply(run, ((func, n, d),))
+            finally:
+                pool.close()
+                pool.join()
+            if exact is None:
+                exact = out
+            print('{:>6} {:>12.4f} {:>12.2f} {:>14.2f}'.format(e, out, duration, 100. * abs(out - exact) / abs(exact)))
+
+
+if __name__ == '__main__':
+    kolmogorov_smirnov()
+    approximate_neighbors()